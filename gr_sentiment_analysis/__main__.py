@@ -1,26 +1,14 @@
-import sys
-import books_db
-import gr_book_info
-import gr_features
-import gr_reviews
+import gr_pipeline
 
 def main():
-    # Create database
-    books_db.build_db()
-
-    # Get book info from Goodreads for 100,000 random books
-    # this step might take a while
-    gr_book_info.get_book_info(100000)
-
-    # Clean up book info data
-    gr_book_info.clean_book_info()
-    
-    # get reviews for eligable books
-    gr_reviews.get_reviews()
-
-    # extract features
-    gr_features.extract_features()
+    # Runs every stage in order: create the database, get book info from Goodreads for 100,000 random
+    # books (this step might take a while), clean up the book info, get reviews for eligable books and
+    # extract features, with features extracted while the reviews are still coming in. Progress is
+    # checkpointed in books.db, so after an interruption `run --resume` carries on where it stopped.
+    # See gr_pipeline for selecting stages and the timing report, and for the build-db, scrape-books,
+    # scrape-reviews, features and score subcommands, which only import the modules they use
+    gr_pipeline.main()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,10 +1,17 @@
 import sqlite3
 import os
-import re
-import pandas as pd
+import sys
+import time
+import datetime
+import itertools
+import numpy as np
+
+import gr_lexicon
+import gr_metrics
 
 # This script is used for creating the SQLite database and tables which are used for data storage for this project.
-# The script also imports the sentiment lexicons from flat files into database tables
+# The script also imports the sentiment lexicons from flat files into database tables, and compiles them into
+# the lexicon file used for scoring, see gr_lexicon
 
 # Create table SQL DDL
 bookinfo_tbl = '''CREATE TABLE IF NOT EXISTS book_info (
@@ -27,7 +34,7 @@ bookinfo_tbl = '''CREATE TABLE IF NOT EXISTS book_info (
 '''
 
 bookinfo_clean_tbl = '''CREATE TABLE IF NOT EXISTS book_info_clean (
-    id INT PRIMARY KEY NOT NULL,
+    id INTEGER PRIMARY KEY NOT NULL,
     title TEXT, 
     author TEXT,
     published DATE,
@@ -44,8 +51,12 @@ bookinfo_clean_tbl = '''CREATE TABLE IF NOT EXISTS book_info_clean (
     )
 '''
 
+book_info_clean_columns = ['id', 'title', 'author', 'published', 'language', 'avg_rating', 'ratings_count',
+    'review_count', 'genre_1', 'genre_2', 'genre_3', 'to_read', 'currently_reading', 'favorites']
+
+# review_id is the rowid, so lookups by review ID go straight to the table with no separate index
 reviews_tbl = '''CREATE TABLE IF NOT EXISTS reviews (
-    review_id INT PRIMARY KEY NOT NULL,
+    review_id INTEGER PRIMARY KEY NOT NULL,
     book_id INT NOT NULL,
     review_date DATE,
     rating INT,
@@ -53,120 +64,614 @@ reviews_tbl = '''CREATE TABLE IF NOT EXISTS reviews (
     )
 '''
 
+# words are stored once in vocabulary, and each review's words as a single blob of word IDs,
+# see pack_tokens. This replaced review_words, which held one (review_id, word) row per word
+vocabulary_tbl = '''CREATE TABLE IF NOT EXISTS vocabulary (
+    word_id INTEGER PRIMARY KEY NOT NULL,
+    word TEXT NOT NULL UNIQUE
+    )
+'''
 
-review_words_tbl = '''CREATE TABLE IF NOT EXISTS review_words (
-    review_id INT NOT NULL,
-    word TEXT NOT NULL
+review_tokens_tbl = '''CREATE TABLE IF NOT EXISTS review_tokens (
+    review_id INTEGER PRIMARY KEY NOT NULL,
+    token_ids BLOB NOT NULL
     )
 '''
 
 review_features_tbl = '''CREATE TABLE IF NOT EXISTS review_features (
-        review_id INT NOT NULL PRIMARY KEY,
-        cap_words_count INT, 
+        review_id INTEGER NOT NULL PRIMARY KEY,
+        cap_words_count INT,
         exclamation_count INT
-        )
+        ) WITHOUT ROWID
+'''
+
+# lexicon tables. Words can appear more than once in a lexicon (MPQA lists some words once per part of
+# speech), and scoring counts every entry, so word can't be a key
+afinn_lexicon_tbl = '''CREATE TABLE IF NOT EXISTS afinn_lexicon (
+    word TEXT,
+    score INTEGER
+    )
+'''
+
+bing_lexicon_tbl = '''CREATE TABLE IF NOT EXISTS bing_lexicon (
+    word TEXT,
+    sentiment INTEGER
+    )
+'''
+
+mpqa_lexicon_tbl = '''CREATE TABLE IF NOT EXISTS mpqa_lexicon (
+    word TEXT,
+    polarity INTEGER
+    )
 '''
 
+inquirer_lexicon_tbl = '''CREATE TABLE IF NOT EXISTS inquirer_lexicon (
+    word TEXT,
+    polarity INTEGER
+    )
+'''
+
+# secondary indexes for the pipeline's lookups: reviews already fetched per book in
+# gr_reviews.get_reviews, book_info by ID, and lexicon entries by word
+indexes = [
+    'CREATE INDEX IF NOT EXISTS reviews_book_id ON reviews (book_id)',
+    'CREATE INDEX IF NOT EXISTS book_info_id ON book_info (id)',
+    'CREATE INDEX IF NOT EXISTS afinn_lexicon_word ON afinn_lexicon (word)',
+    'CREATE INDEX IF NOT EXISTS bing_lexicon_word ON bing_lexicon (word)',
+    'CREATE INDEX IF NOT EXISTS mpqa_lexicon_word ON mpqa_lexicon (word)',
+    'CREATE INDEX IF NOT EXISTS inquirer_lexicon_word ON inquirer_lexicon (word)',
+    ]
+
+# lookups of book_info rows and book_info_clean rows by cleaned up title, the original title where there is
+# one, for gr_book_info.clean_book_info
+clean_title_indexes = [
+    'CREATE INDEX IF NOT EXISTS book_info_title ON book_info (IFNULL(orig_title, title))',
+    'CREATE INDEX IF NOT EXISTS book_info_clean_title ON book_info_clean (title)',
+    ]
+
+# pragmas applied to every connection. WAL lets readers carry on while a writer commits, and
+# with WAL synchronous=NORMAL only syncs at checkpoints, which is safe against corruption
+connection_pragmas = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    # negative cache size is in KiB, so this is 256 MB of page cache
+    'PRAGMA cache_size=-262144',
+    # pipeline stages can write at the same time (see gr_pipeline), so wait for the lock rather than fail
+    'PRAGMA busy_timeout=60000',
+    ]
+
+def db_path():
+    dir = os.path.dirname(__file__)
+    return os.path.join(dir, 'data/books.db')
+
+def connect(db_file=None, check_same_thread=True):
+    """Opens the books database, creating the file if it doesn't exist, with the pipeline's pragmas applied.
+    Turn check_same_thread off for a connection handed to another thread, used by one thread at a time"""
+    conn = sqlite3.connect(db_file or db_path(), check_same_thread=check_same_thread)
+    for pragma in connection_pragmas:
+        conn.execute(pragma)
+    return conn
+
+def to_sql_value(value):
+    """Converts numpy, pandas and datetime values to types sqlite3 can store, the same way
+    DataFrame.to_sql does. NaN and NaT become NULL"""
+    if value is None or isinstance(value, (str, bytes)):
+        return value
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return None if value != value else value
+    # only pandas makes NaT and NA, so there's nothing to check for when it isn't loaded
+    pd = sys.modules.get('pandas')
+    if pd is not None and pd.isnull(value):
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f' if value.microsecond else '%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+class bulk_writer:
+    """Buffers rows for a table and inserts them with executemany, one transaction per flush. Replaces
+    per-record DataFrame.to_sql calls, which pay pandas and transaction overhead for every record"""
+
+    def __init__(self, conn, table, columns, buffer_rows=50000, replace=False):
+        self.conn = conn
+        self.table = table
+        self.columns = list(columns)
+        self.buffer_rows = buffer_rows
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT'
+        self.sql = '{0} INTO {1} ({2}) VALUES ({3})'.format(verb, table, ', '.join(self.columns),
+            ', '.join('?' * len(self.columns)))
+        self.buffer = []
+        self.rows = 0
+        self.elapsed = 0.0
+
+    def add(self, row):
+        """Adds a row given as a tuple of values in column order. Values must already be types sqlite3
+        accepts"""
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def add_many(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def add_frame(self, df):
+        """Adds every row of a DataFrame, converting numpy and pandas values like to_sql does"""
+        self.add_many([tuple(to_sql_value(v) for v in row) for row in df[self.columns].itertuples(index=False, name=None)])
+
+    def flush(self):
+        """Writes all buffered rows in a single transaction"""
+        if not self.buffer:
+            return
+        time_start = time.perf_counter()
+        with self.conn:
+            self.conn.executemany(self.sql, self.buffer)
+        elapsed = time.perf_counter() - time_start
+        self.elapsed += elapsed
+        self.rows += len(self.buffer)
+        gr_metrics.inc('rows_written_total', len(self.buffer), table=self.table)
+        gr_metrics.observe('write_seconds', elapsed, table=self.table)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self):
+        return '{0}: {1} rows written in {2:.2f} seconds, {3:.0f} rows/sec'.format(
+            self.table, self.rows, self.elapsed, self.rows_per_sec())
+
+
+def database_file(conn):
+    return conn.execute('PRAGMA database_list').fetchone()[2]
+
+def connect_like(conn, check_same_thread=True):
+    """Opens a second connection to the same database file as conn, e.g. to keep a long read open
+    while conn commits"""
+    return connect(database_file(conn), check_same_thread)
+
+# word IDs are stored as little-endian unsigned 32-bit integers, so a review's blob can be read
+# straight into a numpy array without copying
+token_dtype = np.dtype('<u4')
+
+def pack_tokens(word_ids):
+    return np.asarray(word_ids, dtype=token_dtype).tobytes()
+
+def unpack_tokens(blob):
+    return np.frombuffer(blob, dtype=token_dtype)
+
+
+class vocabulary:
+    """Maps words to the integer IDs in the vocabulary table. Words not seen before get the next
+    free ID and are written on flush. Flush before storing tokens that use the new IDs, so stored
+    tokens never refer to a word that isn't saved"""
+
+    def __init__(self, conn):
+        conn.execute(vocabulary_tbl)
+        self.ids = dict((word, word_id) for word_id, word in conn.execute('SELECT word_id, word FROM vocabulary'))
+        # IDs start at 1, leaving 0 free
+        self.next_id = max(self.ids.values(), default=0) + 1
+        self.writer = bulk_writer(conn, 'vocabulary', ['word_id', 'word'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, word):
+        word_id = self.next_id
+        self.next_id += 1
+        self.ids[word] = word_id
+        self.writer.add((word_id, word))
+        return word_id
+
+    def word_id(self, word):
+        word_id = self.ids.get(word)
+        return self.add(word) if word_id is None else word_id
+
+    def encode(self, words):
+        """Returns the list of IDs for a list of words, adding any new words"""
+        ids = self.ids
+        return [ids[word] if word in ids else self.add(word) for word in words]
+
+    def flush(self):
+        self.writer.flush()
+
+
+def convert_review_words(conn, chunk_size=10000):
+    """Moves an old review_words table, with one row per word, into vocabulary and review_tokens,
+    then drops it and compacts the database file. Does nothing if there's no review_words table"""
+    if not table_exists(conn, 'review_words'):
+        return
+    vocab = vocabulary(conn)
+    conn.execute(review_tokens_tbl)
+    writer = bulk_writer(conn, 'review_tokens', ['review_id', 'token_ids'])
+
+    # review_words was always written a whole review at a time, so each review's words are one
+    # consecutive run of rows in storage order
+    read_conn = connect_like(conn)
+    rows = read_conn.execute('SELECT review_id, word FROM review_words')
+    for review_id, words in itertools.groupby(rows, key=lambda row: row[0]):
+        writer.buffer.append((review_id, pack_tokens(vocab.encode([row[1] for row in words]))))
+        if len(writer.buffer) >= chunk_size:
+            vocab.flush()
+            writer.flush()
+    vocab.flush()
+    writer.flush()
+    read_conn.close()
+
+    conn.execute('DROP TABLE review_words')
+    conn.commit()
+    conn.execute('VACUUM')
+    print('review_words converted: {0} reviews, {1} distinct words'.format(writer.rows, len(vocab)))
+
+
+# per-review sentiment statistics, written by gr_features. Column order matches the original
+# pandas-built table, which the prediction notebooks read with SELECT *
+review_stats_columns = ['review_id', 'rating', 'word_count',
+    'afinn_mean', 'bing_mean', 'mpqa_mean', 'inq_mean',
+    'afinn_median', 'bing_median', 'mpqa_median', 'inq_median',
+    'afinn_sum', 'bing_sum', 'mpqa_sum', 'inq_sum',
+    'pos_afinn_count', 'neg_afinn_count', 'pos_bing_count', 'neg_bing_count',
+    'pos_mpqa_count', 'neg_mpqa_count', 'pos_inq_count', 'neg_inq_count',
+    'total_afinn_count', 'total_bing_count', 'total_mpqa_count', 'total_inq_count',
+    'pos_afinn_ratio', 'pos_bing_ratio', 'pos_mpqa_ratio', 'pos_inq_ratio',
+    'neg_afinn_ratio', 'neg_bing_ratio', 'neg_mpqa_ratio', 'neg_inq_ratio',
+    'pos_afinn_density', 'pos_bing_density', 'pos_mpqa_density', 'pos_inq_density',
+    'neg_afinn_density', 'neg_bing_density', 'neg_mpqa_density', 'neg_inq_density',
+    'afinn_words_ratio', 'bing_words_ratio', 'mpqa_words_ratio',
+    'cap_words_count', 'exclamation_count', 'all_caps_density']
+
+review_stats_tbl = '''CREATE TABLE IF NOT EXISTS review_stats (
+    review_id INTEGER PRIMARY KEY NOT NULL,
+    rating INTEGER,
+    word_count INTEGER,
+    {0}
+    )
+'''.format(',\n    '.join('{0} REAL'.format(c) for c in review_stats_columns[3:]))
+
+# rating predictions of the review_stats rows, written by gr_train.batch_predict
+review_predictions_tbl = '''CREATE TABLE IF NOT EXISTS review_predictions (
+    review_id INTEGER PRIMARY KEY NOT NULL,
+    model_version TEXT,
+    predicted_rating INTEGER
+    )
+'''
+
+# runs of the pipeline and the progress of each of their stages, see gr_pipeline. A stage's checkpoint is
+# a JSON object with what it needs to resume after an interruption
+pipeline_runs_tbl = '''CREATE TABLE IF NOT EXISTS pipeline_runs (
+    run_id INTEGER PRIMARY KEY NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT
+    )
+'''
+
+pipeline_stages_tbl = '''CREATE TABLE IF NOT EXISTS pipeline_stages (
+    run_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    items INTEGER,
+    checkpoint TEXT,
+    error TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    PRIMARY KEY (run_id, stage)
+    ) WITHOUT ROWID
+'''
+
+# Incremental feature extraction. A trigger logs every review inserted or edited in review_changes,
+# and processing_state holds, for each gr_features stage (words, features, stats), the last change
+# that stage has processed. AUTOINCREMENT keeps seq from being reused once old changes are pruned
+review_changes_tbl = '''CREATE TABLE IF NOT EXISTS review_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    review_id INT NOT NULL
+    )
+'''
+
+review_changes_triggers = [
+    '''CREATE TRIGGER IF NOT EXISTS review_inserted AFTER INSERT ON reviews BEGIN
+        INSERT INTO review_changes (review_id) VALUES (NEW.review_id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS review_updated AFTER UPDATE OF rating, review_text ON reviews BEGIN
+        INSERT INTO review_changes (review_id) VALUES (NEW.review_id);
+    END''',
+    ]
+
+processing_state_tbl = '''CREATE TABLE IF NOT EXISTS processing_state (
+    stage TEXT PRIMARY KEY NOT NULL,
+    watermark INTEGER NOT NULL,
+    reviews_processed INTEGER NOT NULL,
+    updated_at TEXT
+    )
+'''
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+def track_review_changes(conn):
+    """Creates the change log, its triggers and the processing state table if they're missing. A new
+    log starts out with every review already in the database"""
+    new_log = not table_exists(conn, 'review_changes')
+    with conn:
+        conn.execute(review_changes_tbl)
+        for sql in review_changes_triggers:
+            conn.execute(sql)
+        conn.execute(processing_state_tbl)
+        if new_log:
+            conn.execute('INSERT INTO review_changes (review_id) SELECT review_id FROM reviews ORDER BY rowid')
+
+def last_review_change(conn):
+    """The seq of the latest change logged, which stays put after the log is pruned"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'review_changes'").fetchone()
+    return row[0] if row else 0
+
+def stage_watermark(conn, stage):
+    """The last change processed by a stage, or 0 if the stage has never run"""
+    row = conn.execute('SELECT watermark FROM processing_state WHERE stage = ?', (stage,)).fetchone()
+    return row[0] if row else 0
+
+def set_stage_watermark(conn, stage, watermark, reviews=0):
+    """Records that a stage has processed every change up to watermark, and reviews more reviews"""
+    with conn:
+        conn.execute('''INSERT INTO processing_state (stage, watermark, reviews_processed, updated_at)
+            VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT (stage) DO UPDATE SET watermark = excluded.watermark,
+                reviews_processed = reviews_processed + excluded.reviews_processed, updated_at = excluded.updated_at''',
+            (stage, watermark, reviews))
+
+def reset_stage(conn, stage):
+    """Makes a stage start over from every review on its next run"""
+    with conn:
+        conn.execute('DELETE FROM processing_state WHERE stage = ?', (stage,))
+
+def pending_reviews_sql(watermark, upto):
+    """Subquery giving (review_id, seq) for each review changed after watermark and up to upto, with
+    the review's latest change. A stage that has never run (watermark 0) gets every review, with a
+    NULL seq"""
+    if watermark == 0:
+        # NOT INDEXED keeps the scan in review_id order, rather than over the smaller reviews_book_id index,
+        # so the stages' lookups by review_id go through each table in order
+        return 'SELECT review_id, NULL AS seq FROM reviews NOT INDEXED'
+    return '''SELECT review_id, MAX(seq) AS seq FROM review_changes WHERE seq > {0} AND seq <= {1}
+        GROUP BY review_id'''.format(int(watermark), int(upto))
+
+def prune_review_changes(conn, stages):
+    """Deletes changes every one of stages has processed"""
+    watermarks = [stage_watermark(conn, stage) for stage in stages]
+    with conn:
+        conn.execute('DELETE FROM review_changes WHERE seq <= ?', (min(watermarks),))
+
+# Schema migrations. PRAGMA user_version holds the number of migrations applied to a database, and
+# migrate() applies the rest in order. Databases created before migrations existed are at version 0,
+# so every migration must also work on a database that already has some or all of its changes. Add
+# new migrations to the end of the list, and never change one that has been released
+
+def table_sql(conn, table):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row[0] if row else None
+
+def rebuild_table(conn, table, ddl, columns):
+    """Recreates table with the layout in ddl, copying columns over, unless it already has that layout.
+    The first column must be the key. Rows with a duplicate key keep the last copy. Caller must be in a transaction, and recreate any
+    indexes and triggers on the table"""
+    current = table_sql(conn, table)
+    if current is None or current.strip() == ddl.replace('IF NOT EXISTS ', '').strip():
+        return
+    existing = [row[1] for row in conn.execute('PRAGMA table_info({0})'.format(table))]
+    columns = [c for c in columns if c in existing]
+    conn.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(table))
+    conn.execute(ddl)
+    conn.execute('INSERT OR REPLACE INTO {0} ({1}) SELECT {1} FROM {0}_old ORDER BY {2}'.format(table, ', '.join(columns), columns[0]))
+    conn.execute('DROP TABLE {0}_old'.format(table))
+
+def create_tables(conn):
+    """Creates every table that doesn't exist yet, in its current layout"""
+    for ddl in [bookinfo_tbl, bookinfo_clean_tbl, reviews_tbl, vocabulary_tbl, review_tokens_tbl, review_features_tbl,
+            review_stats_tbl, afinn_lexicon_tbl, bing_lexicon_tbl, mpqa_lexicon_tbl, inquirer_lexicon_tbl]:
+        conn.execute(ddl)
+
+def migration_1(conn):
+    """Base schema, review_words converted to review_tokens, review change log"""
+    create_tables(conn)
+    conn.commit()
+    convert_review_words(conn)
+    track_review_changes(conn)
+
+def migration_2(conn):
+    """Integer primary keys, review_features without rowid, secondary indexes
+
+    reviews and book_info_clean get INTEGER PRIMARY KEY keys, which are their rowids, in place of an
+    INT key with a separate index"""
+    rebuild_table(conn, 'reviews', reviews_tbl, ['review_id', 'book_id', 'review_date', 'rating', 'review_text'])
+    # dropping the old reviews table dropped its triggers
+    for sql in review_changes_triggers:
+        conn.execute(sql)
+    rebuild_table(conn, 'book_info_clean', bookinfo_clean_tbl, book_info_clean_columns)
+    rebuild_table(conn, 'review_features', review_features_tbl, ['review_id', 'cap_words_count', 'exclamation_count'])
+    for sql in indexes:
+        conn.execute(sql)
+    conn.execute('ANALYZE')
+
+def migration_3(conn):
+    """Title indexes for incremental clean_book_info"""
+    for sql in clean_title_indexes:
+        conn.execute(sql)
+
+# (migration, runs in a single transaction). migration_1 commits as it goes, and each of its steps
+# checks for work already done
+migrations = [
+    (migration_1, False),
+    (migration_2, True),
+    (migration_3, True),
+    ]
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn, version=None):
+    """Brings the database schema up to date, or up to version. Returns the number of migrations applied"""
+    applied = 0
+    for version, (migration, atomic) in list(enumerate(migrations, 1))[:version]:
+        if schema_version(conn) >= version:
+            continue
+        time_start = time.perf_counter()
+        if atomic:
+            # BEGIN IMMEDIATE takes the write lock up front, so the version can't change under us
+            conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            try:
+                migration(conn)
+                conn.execute('PRAGMA user_version = {0}'.format(version))
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        else:
+            migration(conn)
+            conn.execute('PRAGMA user_version = {0}'.format(version))
+            conn.commit()
+        applied += 1
+        print('Migrated books.db to version {0} in {1:.2f} seconds: {2}'.format(version, time.perf_counter() - time_start,
+            migration.__doc__.split('\n')[0]))
+    return applied
+
+def benchmark_query_list():
+    """The (name, sql) pairs timed by benchmark_queries: the lookups made by gr_reviews.get_reviews and
+    gr_features.extract_features"""
+    import gr_reviews
+    import gr_features
+    pending = pending_reviews_sql(1, 1 << 62)
+    everything = pending_reviews_sql(0, 1 << 62)
+    return [
+        ('books without reviews', gr_reviews.books_without_reviews_sql),
+        ('vocabulary', 'SELECT word, word_id FROM vocabulary'),
+        ('words stage, incremental', gr_features.pending_text_sql.format(pending, 'ORDER BY c.seq')),
+        ('words stage, full', gr_features.pending_text_sql.format(everything, '')),
+        ('stats stage, incremental', gr_features.pending_scoring_sql.format(pending, 'ORDER BY c.seq')),
+        ('stats stage, full', gr_features.pending_scoring_sql.format(everything, '')),
+        ('pending review IDs', gr_features.pending_ids_sql.format(pending)),
+        ('worker shard', gr_features.shard_sql.replace('BETWEEN ? AND ?', 'BETWEEN 1 AND 5000000')),
+        ]
+
+def time_queries(conn, queries, repeat):
+    """Returns the query plan and best of repeat run time, fetching every row, of each (name, sql)"""
+    ret = []
+    for name, sql in queries:
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+        best = None
+        for i in range(repeat):
+            time_start = time.perf_counter()
+            rows = len(conn.execute(sql).fetchall())
+            elapsed = time.perf_counter() - time_start
+            best = elapsed if best is None else min(best, elapsed)
+        ret.append((name, plan, rows, best))
+    return ret
+
+def benchmark_queries(db_file=None, repeat=5, edits=1000):
+    """Prints the query plan and run time of each pipeline query on a copy of db_file, first with the
+    version 1 schema and then migrated to the latest version. A database already past version 1 is only
+    measured as it is. edits random reviews are logged as changed so the incremental queries have work"""
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        copy_file = os.path.join(directory, 'books.db')
+        source = connect(db_file)
+        copy = sqlite3.connect(copy_file)
+        source.backup(copy)
+        source.close()
+        copy.close()
+
+        conn = connect(copy_file)
+        if schema_version(conn) < 1:
+            migrate(conn, 1)
+        with conn:
+            conn.execute('''INSERT INTO review_changes (review_id)
+                SELECT review_id FROM reviews ORDER BY random() LIMIT ?''', (edits,))
+        results = []
+        if schema_version(conn) < len(migrations):
+            results.append(('version {0}'.format(schema_version(conn)), time_queries(conn, benchmark_query_list(), repeat)))
+            migrate(conn)
+        results.append(('version {0}'.format(schema_version(conn)), time_queries(conn, benchmark_query_list(), repeat)))
+        conn.close()
+
+    for label, timings in results:
+        print('\n' + label)
+        for name, plan, rows, best in timings:
+            print('{0}: {1} rows in {2:.1f} ms'.format(name, rows, best * 1000))
+            for detail in plan:
+                print('    ' + detail)
+    if len(results) == 2:
+        print()
+        for (name, plan, rows, before), (name, plan, rows, after) in zip(*[timings for label, timings in results]):
+            print('{0}: {1:.1f} ms -> {2:.1f} ms, {3:.2f}x'.format(name, before * 1000, after * 1000, before / after))
+    return results
+
+def load_lexicon(conn, table, df):
+    """Replaces the contents of a lexicon table with df, keeping the table's layout and indexes"""
+    with conn:
+        conn.execute('DELETE FROM {0}'.format(table))
+    df.to_sql(con=conn, name=table, index=False, if_exists='append')
+
+def load_lexicon_tables(conn, data_dir=None):
+    """Reads each lexicon's source file to a DF and loads it to its database table. Returns the rows read,
+    per lexicon, see gr_lexicon.frame_rows"""
+    data_dir = data_dir or os.path.join(os.path.dirname(__file__), 'data')
+    lexicon_rows = []
+    for reader, (name, table, column), label in zip(gr_lexicon.lexicon_readers, gr_lexicon.lexicon_tables,
+            ['AFINN-111.txt', 'Opinion Lexicon file', 'MPQA file', 'Harvard Inquirer file']):
+        try:
+            df = reader(data_dir)
+            load_lexicon(conn, table, df)
+            lexicon_rows.append(gr_lexicon.frame_rows(df))
+        except Exception as e:
+            print('Error importing {0}:\n {1}'.format(label, e))
+            quit()
+    return lexicon_rows
+
 def build_db():
     # create connection. Creates DB file if doesn't exist
-    dir = os.path.dirname(__file__)
-    db_file = os.path.join(dir, 'data/books.db')
-    conn = sqlite3.connect(db_file)
-    
-    # Build database tables
-    conn.execute(bookinfo_tbl)
-    conn.execute(bookinfo_clean_tbl)
-    conn.execute(reviews_tbl)
-    conn.execute(review_words_tbl)
-    conn.execute(review_features_tbl)
+    conn = connect()
     
+    # Build database tables, or bring an existing database's tables up to date
+    migrate(conn)
     
-    # read AFINN words list to DF and load to database table
-    try:
-    	afinn_file = os.path.join(dir, 'data/AFINN-111.txt')
-    	afinn = pd.read_csv(afinn_file, sep='\t', names=['word', 'score'])
-    	# convert score column to int
-    	afinn['score'] = afinn['score'].astype('int')
-    	# create table and load
-    	afinn.to_sql(con = conn, name='afinn_lexicon', index=False, if_exists='replace')
-    except Exception as e:
-    	print("Error importing AFINN-111.txt:\n {0}".format(e))
-    	quit()
     
-    # read Opinion Lexicon data into database
-    try:
-    	pos_words_file = os.path.join(dir, 'data/bing-positive-words.txt')
-    	neg_words_file = os.path.join(dir, 'data/bing-negative-words.txt')
-    	
-    	positive_words = pd.read_csv(pos_words_file, names=['word'], encoding='latin-1', header=None, skiprows=34)
-    	negative_words = pd.read_csv(neg_words_file, names=['word'], encoding='latin-1', header=None, skiprows=34)
-    	# set positive words to a score of 1, and negative to -1
-    	positive_words['sentiment'] = 1
-    	negative_words['sentiment'] = 0
-    	# merge positive and negatives into a signle DF
-    	opinion_lexicon_df = pd.merge(positive_words, negative_words, how='outer')
-    	opinion_lexicon_df.sort_values('word', inplace=True)
-    	opinion_lexicon_df.reset_index(inplace=True, drop=True)
-    	# create table and load
-    	opinion_lexicon_df.to_sql(con=conn, name='bing_lexicon', index=False, if_exists='replace')
-    except Exception as e:
-    	print('Error importing Opinion Lexicon file:\n {0}'.format(e))
-    	quit()
-    
-    # read MPQA lexicon data into database
-    try:
-        mpqa_df = pd.DataFrame(columns=['word', 'polarity'])
-        mpqa_file = os.path.join(dir, 'data/subjclueslen1-HLTEMNLP05.tff')
-        with open(mpqa_file, mode='r') as file:
-            words = []
-            polarities = []
-            for line in file.readlines():
-            	# extract the words and sentiment polarity score from each line of the input file
-            	words.append(re.search(".*word1=(.*)\s{1}pos1",line).group(1))
-            	polarities.append(1 if re.search('.*priorpolarity=(.*)',line).group(1) == 'positive' else 0)
-
-            mpqa_df['word'] = words
-            mpqa_df['polarity'] = polarities
-            mpqa_df.to_sql(con=conn, name='mpqa_lexicon', index=False, if_exists='replace')
-    except Exception as e:
-        print('Error importing MPQA file:\n {0}'.format(e))
-        quit()
-    
-    # Read Harvard Inquirer lexicon data into database
-    try:
-    	inquirer_file = os.path.join(dir, 'data/inquirerbasic.xls')
-    	inquirer_df = pd.read_excel(inquirer_file)
-    	
-    	inquirer_df_new = pd.DataFrame(columns=['word', 'polarity'])
-    	inquirer_df_new['word'] = inquirer_df['Entry'].str.lower()
-    	
-    	# define function for setting polarity value based on Positiv and Negativ column values
-    	def get_inquirer_polarity(row):
-    		if row['Positiv'] == 'Positiv':
-    			return 1
-    		elif row['Negativ'] == 'Negativ':
-    			return 0
-    		else:
-    			return -1
-    	
-    	# then create a polarity column by applying our function to the original DF
-    	inquirer_df_new['polarity'] = inquirer_df.apply(get_inquirer_polarity, axis=1)
-    	
-    	# drop words with a polarity of -1 (i.e. neither postivie nor negative)
-    	inquirer_df_new = inquirer_df_new[inquirer_df_new['polarity'] != -1]
-    	
-    	# get rid of #s in the words and remove duplicates
-    	inquirer_df_new['word'] = inquirer_df_new['word'].str.replace(r'#\d+', '')
-    	inquirer_df_new.drop_duplicates('word', inplace=True)
-    	
-    	# then  write that to a table
-    	inquirer_df_new.to_sql(con=conn, name='inquirer_lexicon', index=False, if_exists='replace')
-    except Exception as e:
-    	print('Error importing Harvard Inquirer file:\n {0}'.format(e))
-    	quit()
+    # load each lexicon's source file to its database table
+    lexicon_rows = load_lexicon_tables(conn)
+
+    # then merge all four into the compiled lexicon file the scorers use
+    version = gr_lexicon.write_lexicons(gr_lexicon.lexicon_file(), *gr_lexicon.compile_lexicons(lexicon_rows), source='files',
+        source_digest=gr_lexicon.rows_digest(lexicon_rows))
+    print('Compiled lexicons to {0}, version {1}'.format(gr_lexicon.lexicon_file(), version))
     
 def main():
-    build_db()
+    # books_db.py benchmark [db file] compares the query plans before and after the indexes migration
+    if sys.argv[1:2] == ['benchmark']:
+        benchmark_queries(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        build_db()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,119 @@
+import asyncio
+import time
+import aiohttp
+from urllib.parse import urlsplit
+
+import gr_config
+from gr_fetch import RETRY_STATUSES, backoff_delay, default_cache, fetch_stats, retry_budget
+
+# asyncio based page fetcher. Pulls many pages at once while keeping the number of requests in
+# flight and the request rate per host under the configured limits. Retries follow the same
+# backoff and budget rules as the synchronous fetcher in gr_fetch, and pages are cached or
+# replayed the same way.
+
+class host_rate_limiter:
+    """Spaces out request start times so that no more than `rate` requests per second are
+    started against any single host"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = {}
+
+    async def wait(self, host):
+        if self.interval == 0:
+            return
+        # reserve the next free slot for this host. There is no await between reading and
+        # updating the slot, so no lock is needed within a single event loop
+        now = time.monotonic()
+        slot = max(now, self.next_slot.get(host, now))
+        self.next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class async_fetcher:
+    """Fetches lists of URLs concurrently. Keeps running totals of pages, bytes and time spent
+    so throughput can be reported across several calls"""
+
+    def __init__(self, concurrency=None, rate_limit=None, timeout=30, max_retries=3, backoff_base=1.0, backoff_max=60.0, budget=None,
+                 cache=None, replay=None):
+        self.concurrency = concurrency or gr_config.CONCURRENCY
+        self.rate_limit = gr_config.RATE_LIMIT if rate_limit is None else rate_limit
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.budget = budget or retry_budget()
+        self.stats = fetch_stats(fetcher='aiohttp')
+        self.elapsed = 0.0
+        self.cache = cache or default_cache()
+        self.replay = gr_config.REPLAY if replay is None else replay
+        # successful pages waiting to be written to the cache, as (url, final url, text)
+        self.to_cache = []
+
+    async def __fetch(self, session, url, semaphore, limiter):
+        """gets a single page, retrying on connection errors, timeouts and retryable status
+        codes. Returns the page text or None"""
+        host = urlsplit(url).netloc
+        attempt = 0
+        while True:
+            async with semaphore:
+                await limiter.wait(host)
+                time_start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        html_source = await response.text()
+                        self.stats.request_done(time.perf_counter() - time_start, len(html_source))
+                        if response.status not in RETRY_STATUSES:
+                            if response.status == 200:
+                                self.to_cache.append((url, str(response.url), html_source))
+                            return html_source
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+            if attempt >= self.max_retries or not self.budget.allows(self.stats):
+                self.stats.failed()
+                return None
+            # wait outside of the semaphore so other requests can use the slot
+            self.stats.retried()
+            await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            attempt += 1
+
+    async def fetch_all(self, urls):
+        """Fetches all URLs concurrently. Returns a list of page text in the same order as the
+        input, with None for pages that could not be retrieved"""
+        if self.replay:
+            return [self.cache.get(url) for url in urls]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = host_rate_limiter(self.rate_limit)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+        # count new connections so reuse shows up in the stats
+        async def on_connection_create_end(session, context, params):
+            self.stats.connection_opened()
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+
+        time_start = time.monotonic()
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector, trace_configs=[trace_config]) as session:
+            pages = await asyncio.gather(*[self.__fetch(session, url, semaphore, limiter) for url in urls])
+        self.elapsed += time.monotonic() - time_start
+
+        # write to the cache after the batch so disk writes don't hold up the event loop
+        if self.cache is not None:
+            for url, final_url, html_source in self.to_cache:
+                self.cache.store(url, html_source, final_url=final_url)
+        self.to_cache = []
+        return pages
+
+    def fetch(self, urls):
+        """Blocking wrapper around fetch_all for use from synchronous code"""
+        return asyncio.run(self.fetch_all(urls))
+
+    def pages_per_sec(self):
+        return self.stats.requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self):
+        return '{0:.2f} pages/sec, {1:.1f} MB. {2}'.format(
+            self.pages_per_sec(), self.stats.bytes / 1e6, self.stats.report())
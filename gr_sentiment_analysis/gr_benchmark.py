@@ -0,0 +1,403 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import gr_config
+
+# Performance benchmarks, run on synthetic Goodreads-like pages and reviews so they need no network, no
+# saved pages and no books.db. Each benchmark reports a throughput (higher is better):
+#
+#   parse.<backend>.<kind>  book, shelves and review pages parsed per second, with each parser backend
+#   tokenize.words_to_list  reviews per second through the original per-review tokenizer
+#   tokenize.batch          reviews per second through tokenize_batch
+#   score.lexicons          tokenized reviews scored against the compiled lexicons per second
+#   db.insert_reviews       reviews rows written per second with bulk_writer, change triggers included
+#   features.extract        reviews per second through a full extract_features run into review_stats
+#
+# `run` saves the results as JSON in gr_config.BENCHMARK_DIR, named by time and git commit, and
+# `compare` checks one result file against another for regressions. `importtime` checks how long each
+# CLI subcommand takes to import its modules, and that it doesn't load the heavy ones it has no use for.
+#
+# The pipeline modules are imported by the benchmarks that use them, so this module loads quickly too.
+
+# words the synthetic reviews are made of, besides lexicon words
+filler_words = ['the', 'a', 'book', 'story', 'and', 'it', 'was', 'characters', 'plot', "didn't", 'well-written',
+    'I', 'LOVED', 'OK', 'café', '5/5', 'e-book', 'Tolkien', '(spoilers)', 'WOW!!', 'boring...', 'chapter']
+
+rating_texts = ['did not like it', 'it was ok', 'liked it', 'really liked it', 'it was amazing']
+
+def review_texts(count, seed=0, lexicon_words=None, lexicon_share=0.3, min_words=5, max_words=300):
+    """Builds count review texts of min_words to max_words words, lexicon_share of them drawn from
+    lexicon_words and the rest filler with capitals, punctuation and accented letters"""
+    rng = random.Random(seed)
+    lexicon_words = lexicon_words or filler_words
+    texts = []
+    for i in range(count):
+        words = [rng.choice(lexicon_words) if rng.random() < lexicon_share else rng.choice(filler_words)
+            for j in range(rng.randint(min_words, max_words))]
+        texts.append(' '.join(words) + '!' * rng.randint(0, 3))
+    return texts
+
+def book_page(book_id, rng):
+    """A book page with every field the parsers extract"""
+    first_published = ('<nobr class="greyText">(first published {0} {1}th {2})</nobr>'.format(
+        rng.choice(['January', 'March', 'July']), rng.randint(4, 28), rng.randint(1900, 2017)) if rng.random() < 0.5 else '')
+    genres = ''.join('<a class="actionLinkLite bookPageGenreLink" href="/genres/{0}">{0}</a>'.format(genre)
+        for genre in rng.sample(['Fantasy', 'Fiction', 'Young Adult', 'Magic', 'Romance', 'History', 'Classics'], 4))
+    # real pages are mostly markup the parsers skip over
+    filler = ''.join('<div class="u-anchorTarget"><span class="greyText">{0}</span></div>'.format(' '.join(
+        rng.choice(filler_words) for j in range(20))) for i in range(rng.randint(20, 60)))
+    return '''<!DOCTYPE html><html><head><meta property="al:ios:url" content="com.goodreads.https://book/show/{id}">
+</head><body>{filler}
+<h1 id="bookTitle" class="gr-h1">  The Book of {word} {id} (Series #{series})
+</h1><div id="bookAuthors"><span>by</span><span itemprop="author"><a href="/author/show/{id}"><span itemprop="name">A. Author</span></a></span></div>
+<div id="bookMeta"><span class="value rating"><span class="average"> {rating:.2f}</span></span>
+<span class="votes value-title" title=" {ratings} "></span><span class="count value-title" title="{reviews}"></span></div>
+<div id="details"><div class="row">Paperback, {pages} pages</div><div class="row">Published May 3rd 2009 by Pub
+{first_published}</div></div>
+<div id="bookDataBox"><div class="clearFloats"><div class="infoBoxRowTitle">Original Title</div><div class="infoBoxRowItem">The {word} &amp; {id}</div></div>
+<div class="clearFloats"><div class="infoBoxRowTitle">Language</div><div class="infoBoxRowItem" itemprop='inLanguage'>English</div></div></div>
+<div class="rightContainer"><div>{genres}</div></div>{filler}
+</body></html>'''.format(id=book_id, word=rng.choice(filler_words), series=rng.randint(1, 9), rating=rng.uniform(2, 5),
+        ratings=rng.randint(10, 100000), reviews=rng.randint(0, 5000), pages=rng.randint(100, 900),
+        first_published=first_published, genres=genres, filler=filler)
+
+def shelves_page(book_id, rng):
+    """A shelves page listing to-read, currently-reading, favorites and other shelves"""
+    shelves = ['to-read', 'currently-reading', 'favorites'] + ['shelf-{0}'.format(i) for i in range(rng.randint(20, 100))]
+    rng.shuffle(shelves)
+    links = ''.join('<div class="shelfStat"><a class="mediumText actionLinkLite" href="/genres/{0}">{0}</a>'
+        '<a rel="nofollow" href="/shelf/users?shelf={0}">{1:,} people</a></div>'.format(shelf, rng.randint(1, 100000))
+        for shelf in shelves)
+    return '<html><body><div class="leftContainer">{0}</div><a class="next_page" rel="next" href="/book/shelves/{1}?page=2">next</a></body></html>'.format(
+        links, book_id)
+
+def reviews_page(book_id, rng, texts):
+    """A review page with a review per text, escaped like the javascript Goodreads sends"""
+    reviews = []
+    for i, text in enumerate(texts):
+        action = rng.choice(['rated it', 'added it', 'marked it'])
+        reviews.append('''<div class="review" id="review_{id}" itemprop="reviews">
+<div class="reviewHeader uitext stacked"><a class="reviewDate createdAt right" href="#">Jan {day:02d}, 2017</a>
+<span itemprop="author">Reader {i}</span> {action} <span class=" staticStars notranslate" title="x"><span class="staticStar p10">{rating}</span></span></div>
+<div class="reviewText stacked"><span>{text}</span></div></div>'''.format(id=book_id * 1000 + i, day=rng.randint(1, 28), i=i,
+            action=action, rating=rng.choice(rating_texts) if action == 'rated it' else '', text=text))
+    page = '<html><body><div id="bookReviews">{0}</div></body></html>'.format(''.join(reviews))
+    return page.encode('ascii', 'backslashreplace').decode('ascii')
+
+def synthetic_pages(count, seed=0, reviews_per_page=30):
+    """Returns count book, shelves and review pages, as a dict of page kind to a list of pages"""
+    rng = random.Random(seed)
+    texts = review_texts(count * reviews_per_page, seed, max_words=150)
+    return {
+        'book': [book_page(i, rng) for i in range(1, count + 1)],
+        'shelves': [shelves_page(i, rng) for i in range(1, count + 1)],
+        'reviews': [reviews_page(i, rng, texts[(i - 1) * reviews_per_page:i * reviews_per_page]) for i in range(1, count + 1)],
+        }
+
+def load_lexicons():
+    """The compiled lexicons. Without a compiled file they are compiled from the source files to a temporary
+    one, as the benchmarks leave every file outside their temporary directories as they found it"""
+    import gr_lexicon
+    try:
+        return gr_lexicon.compiled_lexicons(gr_lexicon.lexicon_file())
+    except (OSError, ValueError):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lexicons.bin')
+            gr_lexicon.compile_sources(path)
+            return gr_lexicon.compiled_lexicons(path)
+
+def lexicon_words():
+    return list(load_lexicons().words())
+
+
+def timed(run, repeat):
+    """Best time of repeat calls of run"""
+    best = None
+    for i in range(repeat):
+        time_start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - time_start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def result(items, seconds, unit):
+    return {'value': items / seconds if seconds > 0 else 0.0, 'unit': unit, 'items': items, 'seconds': seconds}
+
+def benchmark_parsing(scale, repeat):
+    import gr_parsers
+    pages = synthetic_pages(max(1, int(100 * scale)))
+    results = {}
+    for name in gr_parsers.backends:
+        parser = gr_parsers.get_parser(name)
+        for kind, kind_pages in pages.items():
+            seconds = timed(lambda: [gr_parsers.parse_page(parser, kind, page) for page in kind_pages], repeat)
+            results['parse.{0}.{1}'.format(name, kind)] = result(len(kind_pages), seconds, 'pages/sec')
+    return results
+
+def benchmark_tokenizing(scale, repeat):
+    import gr_features
+    texts = review_texts(max(1, int(20000 * scale)))
+    return {
+        'tokenize.words_to_list': result(len(texts), timed(lambda: [gr_features.words_to_list(text) for text in texts],
+            repeat), 'reviews/sec'),
+        'tokenize.batch': result(len(texts), timed(lambda: gr_features.tokenize_batch(texts), repeat), 'reviews/sec'),
+        }
+
+def benchmark_scoring(scale, repeat):
+    import gr_features
+    import gr_matcher
+    import gr_scoring
+    lexicons = load_lexicons()
+    vocab = gr_scoring.lexicon_vocabulary(lexicons)
+    scorer = gr_features.lexicon_scorer(None, vocab, lexicons)
+    texts = review_texts(max(1, int(20000 * scale)), lexicon_words=list(lexicons.words()), min_words=30)
+    token_arrays = [vocab.encode(words) for words, cap_count, excl_count in gr_features.tokenize_batch(texts)]
+    matcher = gr_matcher.lexicon_matcher.from_lexicons(lexicons)
+    reviews = [(i, 0, text) for i, text in enumerate(texts)]
+    return {'score.lexicons': result(len(texts), timed(lambda: scorer.stats(*scorer.score(token_arrays)), repeat),
+            'reviews/sec'),
+        'score.matcher': result(len(texts), timed(lambda: matcher.review_stats_rows(reviews), repeat), 'reviews/sec')}
+
+def review_rows(texts, seed=0):
+    rng = random.Random(seed)
+    return [(1000 + i, rng.randint(1, 5000), '2017-01-01', rng.randint(0, 5), text) for i, text in enumerate(texts)]
+
+def benchmark_database(scale, repeat):
+    import books_db
+    import gr_features
+    texts = review_texts(max(1, int(20000 * scale)), lexicon_words=lexicon_words())
+    rows = review_rows(texts)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        db_file = os.path.join(directory, 'books.db')
+
+        def insert_reviews():
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_file + suffix):
+                    os.remove(db_file + suffix)
+            conn = books_db.connect(db_file)
+            books_db.migrate(conn)
+            time_start = time.perf_counter()
+            writer = books_db.bulk_writer(conn, 'reviews', ['review_id', 'book_id', 'review_date', 'rating', 'review_text'])
+            writer.add_many(rows)
+            writer.flush()
+            elapsed = time.perf_counter() - time_start
+            conn.close()
+            return elapsed
+
+        results['db.insert_reviews'] = result(len(rows), min(insert_reviews() for i in range(repeat)), 'rows/sec')
+
+        # the same lexicon tables build_db loads, for extract_features to score against
+        conn = books_db.connect(db_file)
+        books_db.load_lexicon_tables(conn)
+        conn.close()
+
+        def extract_features():
+            conn = books_db.connect(db_file)
+            # forget all progress so every review is processed again
+            conn.execute('DELETE FROM processing_state')
+            conn.commit()
+            conn.close()
+            gr_features.extract_features(workers=1, db_file=db_file, export=False)
+
+        results['features.extract'] = result(len(rows), timed(extract_features, repeat), 'reviews/sec')
+    return results
+
+benchmarks = {
+    'parse': benchmark_parsing,
+    'tokenize': benchmark_tokenizing,
+    'score': benchmark_scoring,
+    'db': benchmark_database,
+    }
+
+def git_commit():
+    """Short hash of the checked out commit, marked -dirty with uncommitted changes, or 'unknown'"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory,
+            stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory,
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+def run_benchmarks(names=None, scale=1.0, repeat=3):
+    """Runs the benchmarks in names, of benchmarks (default all), on data sized by scale. Each takes its
+    best time of repeat runs. Returns the results document"""
+    results = {}
+    for name in names or benchmarks:
+        time_start = time.perf_counter()
+        results.update(benchmarks[name](scale, repeat))
+        print('{0} benchmarks took {1:.1f} seconds'.format(name, time.perf_counter() - time_start))
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': scale,
+        'repeat': repeat,
+        'results': results,
+        }
+
+def save_results(document, path=None):
+    """Writes a results document to path, by default <time>-<commit>.json in gr_config.BENCHMARK_DIR"""
+    if path is None:
+        created_at = datetime.datetime.fromisoformat(document['created_at'])
+        path = os.path.join(gr_config.BENCHMARK_DIR, '{0}-{1}.json'.format(created_at.strftime('%Y%m%d-%H%M%S'),
+            document['commit']))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(document, file, indent=2, sort_keys=True)
+    return path
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+def result_files():
+    """Saved result files, oldest first"""
+    return sorted(glob.glob(os.path.join(gr_config.BENCHMARK_DIR, '*.json')))
+
+def format_results(document):
+    lines = ['commit {0}, {1}, Python {2}, scale {3}'.format(document['commit'], document['created_at'],
+        document['python'], document['scale'])]
+    for name, values in sorted(document['results'].items()):
+        lines.append('  {0:<28} {1:>14,.0f} {2}'.format(name, values['value'], values['unit']))
+    return '\n'.join(lines)
+
+def compare_results(old, new, threshold=None):
+    """Compares two results documents. Returns a list of (name, old value, new value, ratio) for the
+    benchmarks in both, and the names of those that got more than threshold slower"""
+    threshold = gr_config.BENCHMARK_THRESHOLD if threshold is None else threshold
+    rows = []
+    regressions = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        old_value = old['results'][name]['value']
+        new_value = new['results'][name]['value']
+        ratio = new_value / old_value if old_value else float('inf')
+        rows.append((name, old_value, new_value, ratio))
+        if ratio < 1 - threshold:
+            regressions.append(name)
+    if old.get('scale') != new.get('scale'):
+        print('Warning: comparing results at scale {0} with scale {1}'.format(old.get('scale'), new.get('scale')))
+    return rows, regressions
+
+def print_comparison(old, new, threshold=None):
+    """Prints the change in every benchmark from old to new. Returns the names of the regressions"""
+    rows, regressions = compare_results(old, new, threshold)
+    print('{0} -> {1}'.format(old['commit'], new['commit']))
+    for name, old_value, new_value, ratio in rows:
+        print('  {0:<28} {1:>14,.0f} {2:>14,.0f} {3:>7.2f}x{4}'.format(name, old_value, new_value, ratio,
+            '  REGRESSION' if name in regressions else ''))
+    if regressions:
+        print('{0} regressions: {1}'.format(len(regressions), ', '.join(regressions)))
+    return regressions
+
+
+# modules each CLI subcommand imports before it starts work (see gr_pipeline.main), the most milliseconds
+# the imports may take, and heavy modules they mustn't load. Stage modules load pandas, bs4 and the
+# like only inside the functions that use them
+import_budgets = {
+    'cli': (['gr_pipeline'], 400),
+    'build-db': (['gr_pipeline', 'books_db'], 400),
+    'features': (['gr_pipeline', 'gr_features'], 400),
+    'score': (['gr_pipeline', 'gr_scoring'], 500),
+    'scrape-books': (['gr_pipeline', 'gr_book_info'], 1000),
+    'scrape-reviews': (['gr_pipeline', 'gr_reviews'], 1500),
+    }
+
+never_imported = ['matplotlib', 'seaborn', 'scipy', 'sklearn']
+scraping_modules = ['pandas', 'bs4', 'dateutil', 'requests', 'aiohttp']
+
+def forbidden_modules(command):
+    return never_imported + ([] if command.startswith('scrape') else scraping_modules)
+
+importtime_re = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+def import_time(modules, repeat=3):
+    """Imports modules in a fresh interpreter with -X importtime, repeat times. Returns the best total
+    milliseconds and the set of top-level packages loaded"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)], cwd=directory,
+            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True).stderr.decode()
+        total = 0
+        loaded = set()
+        for line in output.splitlines():
+            match = importtime_re.match(line)
+            if match is None:
+                continue
+            loaded.add(match.group(4).split('.')[0])
+            # only top-level imports, whose cumulative times include everything they import
+            if len(match.group(3)) == 1:
+                total += int(match.group(2))
+        best = total / 1000 if best is None else min(best, total / 1000)
+    return best, loaded
+
+def check_import_budgets(commands=None, budget_scale=1.0):
+    """Checks each subcommand's import time against its budget, scaled by budget_scale for slower
+    machines, and that it loads none of its forbidden modules. Returns the failures"""
+    failures = []
+    for command in commands or import_budgets:
+        modules, budget = import_budgets[command]
+        milliseconds, loaded = import_time(modules)
+        forbidden = sorted(set(forbidden_modules(command)) & loaded)
+        ok = milliseconds <= budget * budget_scale and not forbidden
+        print('{0:<16} {1:>7.1f} ms of {2:.0f} ms{3}{4}'.format(command, milliseconds, budget * budget_scale,
+            ', loads ' + ', '.join(forbidden) if forbidden else '', '' if ok else '  FAILED'))
+        if not ok:
+            failures.append(command)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks parsing, tokenizing, scoring and the database on synthetic data')
+    subparsers = parser.add_subparsers(dest='command')
+    run = subparsers.add_parser('run', help='run the benchmarks and save the results')
+    run.add_argument('benchmarks', nargs='*', help='benchmarks to run, of {0} (default all)'.format(', '.join(benchmarks)))
+    run.add_argument('--scale', type=float, default=1.0, help='size of the synthetic data, 1 is 20,000 reviews and 100 pages of each kind')
+    run.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best is kept')
+    run.add_argument('--out', default=None, help='results file (default GR_BENCHMARK_DIR/<time>-<commit>.json)')
+    run.add_argument('--compare', action='store_true', help='compare with the latest saved results, failing on a regression')
+    compare = subparsers.add_parser('compare', help='compare two results files (default the latest two)')
+    compare.add_argument('files', nargs='*')
+    compare.add_argument('--threshold', type=float, default=None, help='slowdown that counts as a regression (default GR_BENCHMARK_THRESHOLD)')
+    importtime = subparsers.add_parser('importtime', help='check the CLI subcommands\' import times against their budgets')
+    importtime.add_argument('commands', nargs='*', help='subcommands to check, of {0} (default all)'.format(', '.join(import_budgets)))
+    importtime.add_argument('--budget-scale', type=float, default=1.0, help='multiplies every budget')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        for name in args.benchmarks:
+            if name not in benchmarks:
+                parser.error('unknown benchmark {0}, choose from {1}'.format(name, ', '.join(benchmarks)))
+        previous = result_files()
+        document = run_benchmarks(args.benchmarks, args.scale, args.repeat)
+        print(format_results(document))
+        print('Saved to {0}'.format(save_results(document, args.out)))
+        if args.compare and previous:
+            sys.exit(1 if print_comparison(load_results(previous[-1]), document) else 0)
+    elif args.command == 'compare':
+        files = args.files or result_files()[-2:]
+        if len(files) != 2:
+            parser.error('need two results files to compare')
+        sys.exit(1 if print_comparison(load_results(files[0]), load_results(files[1]), args.threshold) else 0)
+    elif args.command == 'importtime':
+        sys.exit(1 if check_import_budgets(args.commands, args.budget_scale) else 0)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -1,163 +1,48 @@
-import requests
-import os
-import re
+import itertools
+import sys
 import time
-import sqlite3
-import pandas as pd
-import numpy as np
-from bs4 import BeautifulSoup
 from collections import OrderedDict
-from datetime import datetime
-from dateutil.parser import parse
+
+import books_db
+import gr_cache
+import gr_config
+import gr_fetch
+import gr_metrics
+import gr_parsers
+from gr_async_fetch import async_fetcher
 
 class gr_book_info:
 
+    # columns of the info dict, in book_info table order
+    columns = ('id', 'title', 'orig_title', 'author', 'published', 'language', 'avg_rating', 'ratings_count',
+        'review_count', 'genre_1', 'genre_2', 'genre_3', 'to_read', 'currently_reading', 'favorites')
+
     info = OrderedDict()
 
-    def __init__(self, id):
-        url = self.__build_url(id)
-        self.info = self.__extract_book_info(url)
+    def __init__(self, id, parser=None, html_source=None, fetch_html=None, page=None):
+        """Gets the book info for a book ID or 'random'. parser is the name of the gr_parsers
+        backend to use, defaulting to the one in gr_config. html_source can hold an already
+        fetched book page, and page one already parsed with parse_book_page, in which case id
+        is ignored. fetch_html gets the shelves pages, default gr_fetch.get_html"""
+        self.parser = gr_parsers.get_parser(parser)
+        self.fetch_html = fetch_html or gr_fetch.get_html
+        if page is None:
+            if html_source is None:
+                html_source = gr_fetch.get_html(self.__build_url(id))
+            page = self.parser.parse_book_page(html_source)
+        self.info = self.__extract_book_info(page)
 
     def __build_url(self, id):
         # Build URL from id value. Can accept specific book ID or 'random' for a random GR page
         url = ''
         if id == 'random':
-            url = 'https://www.goodreads.com/book/random'
+            url = '{0}/book/random'.format(gr_config.BASE_URL)
         elif str.isnumeric(id):
-            url = 'https://www.goodreads.com/book/show/{0}'.format(str(id))
+            url = '{0}/book/show/{1}'.format(gr_config.BASE_URL, str(id))
         else:
             raise ValueError("Invalid book ID. Must be numeric value or 'random'")
         return url
 
-    def __get_html_source(self, url, retries=0):
-        """gets HTML page from URL and returns a BeautifulSoup object"""
-        try:
-            html_source = requests.get(url).text
-            soup = BeautifulSoup(html_source, 'html.parser')
-            return soup
-        except requests.exceptions.ConnectionError:
-            # retry up to 3 times
-            if retries < 3:
-                retry = retries + 1
-                time.sleep(5)
-                self.__get_html_source(url, retry)
-            else:
-                raise
-    
-    def __extract_title(self, soup):
-        """Gets the book title from a Goodreads page BeautifulSoup object"""
-        try:
-            title = (soup.select('#bookTitle'))[0].get_text()
-            # Strip out Series Identifiers in parentheses
-            title = re.sub(r'(\(|\[)(.*)(\)|\])','', title).strip()
-            return title
-        except IndexError:
-            return ''
-
-    def __extract_orig_title(self, soup):
-        """gets the book original title from a Goodreads page BeautifulSoup object"""
-        try:
-            box_title = (soup.select('#bookDataBox > div:nth-of-type(1) > div.infoBoxRowTitle'))[0].get_text().strip()
-            if box_title == 'Original Title':
-                orig_title = (soup.select('#bookDataBox > div:nth-of-type(1) > div.infoBoxRowItem'))[0].get_text().strip()
-                return orig_title
-            else:
-                return ''
-        except IndexError:
-            return ''
-
-    def __extract_book_id(self, soup):
-        """Gets the Goodreads book ID from a Goodreads page BeautifulSoup object"""
-        try:
-            book_id = soup.find('meta', attrs={'property':'al:ios:url'}).get('content')
-            book_id = re.sub('com.goodreads.https://book/show/', '', book_id)
-            return book_id.strip()
-        except AttributeError:
-            return ''
-    
-    def __extract_author(self, soup):
-        """Gets the book author from a Goodreads page BeautifulSoup object"""
-        try:
-            author = (soup.select('#bookAuthors > span:nth-of-type(2) > a > span'))[0].get_text()
-            return author.strip()
-        except IndexError:
-            return ''
-    
-    def __extract_book_language(self, soup):
-        """Gets the book's language from a Goodreads page BeautifulSoup object"""
-        try:
-            databox = soup.select('#bookDataBox')
-            language = databox[0].find('div', attrs={'class':'infoBoxRowItem', 'itemprop':'inLanguage'}).get_text()
-            return language.strip()
-        except (IndexError, AttributeError):
-            return ''
-
-    def __extract_pub_date(self, soup):
-        """Gets the book's publication date from a Goodreads page BeautifulSoup object"""
-        # check for a First Published date and if none, use the Published date. This is for books
-        # with multiple editions.
-        try:
-            pub_date = (soup.select('#details > div:nth-of-type(2) > nobr'))[0].get_text()
-            pub_date = re.sub('[()]|first published', '', pub_date).strip()
-        except IndexError:
-            # If there's no 'First Published', choose the Published date value
-            try:
-                pub_date = (soup.select('#details > div:nth-of-type(2)'))[0].get_text()
-                pub_date = re.sub('Published|by[\s\S]*$', '', pub_date).strip()
-            except IndexError:
-                return ''
-        # convert day from ordinal
-        try:
-            pub_date = parse(pub_date)
-            pub_date = datetime.strftime(pub_date, '%Y-%m-%d')
-            return pub_date
-        except (TypeError, ValueError):
-            return ''
-        
-    
-    def __extract_avg_rating(self, soup):
-        """Gets the book's avearge review score from a Goodreads page BeautifulSoup object"""
-        try:
-            rating = (soup.select('#bookMeta > span.value.rating > span'))[0].get_text()
-            return rating.strip()
-        except IndexError:
-            return ''
-    
-    def __extract_ratings_count(self, soup):
-        """Gets the number of reviews a book has from a Goodreads page BeautifulSoup object"""
-        try:
-            ratings_count = soup.find('span', attrs={'class':'votes value-title'}).get('title')
-            return ratings_count.strip()
-        except AttributeError:
-            return ''
-    
-    def __extract_reviews_count(self, soup):
-        """Gets the number of reviews a book has from a Goodreads page BeautifulSoup object"""
-        try:
-            review_count = soup.find('span', attrs={'class':'count value-title'}).get('title')
-            return review_count.strip()
-        except AttributeError:
-            return ''
-
-    def __extract_top_genres(self, soup):
-        """Gets the top 3 genres for a book from a Goodreads page Beautiful soup object. Returns 
-        a list. If there are less than three top genres, empty strings will be in the position 
-        that no value is present"""
-        # create a list of 3 empty strings
-        ret = ['', '', '']
-        try:
-            right_container = soup.select('div.rightContainer')
-            # figure out how to search through only the right container to improve performance
-            top_genres = right_container[0].find_all('a', attrs={'class':'actionLinkLite bookPageGenreLink'})
-            for i in range(len(top_genres)):
-                # Only want the top 3, so if there are more than 3 top genres, break after the third
-                if i > 2:
-                    break
-                ret[i] = top_genres[i].get_text()
-            return ret
-        except (IndexError, AttributeError):
-            return ret
-
     def __extract_top_shelves(self, id, page = 1):
         """Gets the counts for shelfs favorites, to-read, and have-read. Returns a dict"""
         ret = {
@@ -166,71 +51,43 @@ class gr_book_info:
             'favorites':'',
             }
 
-        url = 'https://www.goodreads.com/book/shelves/{0}'.format(id)
-        soup = self.__get_html_source(url)
+        shelves = self.parser.parse_shelves_page(self.fetch_html(shelves_url(id)))
 
-        ret = self.__pop_shelves(ret, soup)
+        ret = self.__pop_shelves(ret, shelves)
 
         # if all values not found on first page of shelves, try the second page.
         if not all(v != '' for v in ret.values()):
             try:
-                workurl = soup.find('a', attrs={'rel':'next'}).get('href')
-                soup = self.__get_html_source('https://www.goodreads.com' + workurl)
-                ret = self.__pop_shelves(ret, soup)
+                workurl = shelves['next']
+                shelves = self.parser.parse_shelves_page(self.fetch_html(gr_config.BASE_URL + workurl))
+                ret = self.__pop_shelves(ret, shelves)
             except:
                 pass
 
         return ret
 
-    def __pop_shelves(self, dict, soup):
-        """Populates the shelves dictionary values"""
-        try:
-            pattern = re.compile('.shelf=to-read$')
-            to_read = soup.find('a', attrs={'rel':'nofollow', 'href':pattern}).get_text()
-            if dict['to-read'] == '':
-                dict['to-read'] = re.sub('[^\d]', '', to_read)
-        except AttributeError:
-            pass
-        try:
-            pattern = re.compile('.shelf=currently-reading$')
-            currently_reading = soup.find('a', attrs={'rel':'nofollow', 'href':pattern}).get_text()
-            if dict['currently-reading'] == '':
-                dict['currently-reading'] = re.sub('[^\d]', '', currently_reading)
-        except AttributeError:
-            pass
-        try:
-            pattern = re.compile('.shelf=favorites$')
-            favorites = soup.find('a', attrs={'rel':'nofollow', 'href':pattern}).get_text()
-            if dict['favorites'] == '':
-                dict['favorites'] = re.sub('[^\d]', '', favorites)
-        except AttributeError:
-            pass
+    def __pop_shelves(self, dict, shelves):
+        """Populates the shelves dictionary values that are still empty"""
+        for shelf in dict:
+            if dict[shelf] == '':
+                dict[shelf] = shelves[shelf]
         return dict
         
-    def __extract_book_info(self, url):
+    def __extract_book_info(self, page):
         """Gets the book title, book ID, author, genre, pages, number of reviews, and average rating. Returns a dict"""
-        soup = self.__get_html_source(url)
-
         try:
-            book_id = self.__extract_book_id(soup)
-            book_title = self.__extract_title(soup)
-            book_orig_title = self.__extract_orig_title(soup)
-            book_author = self.__extract_author(soup)
-            page_language = self.__extract_book_language(soup)
-            first_published = self.__extract_pub_date(soup)
-            avg_rating = self.__extract_avg_rating(soup)
-            ratings_count = self.__extract_ratings_count(soup)
-            reviews_count = self.__extract_reviews_count(soup)
+            book_id = page['id']
+            reviews_count = page['review_count']
             
             ret_dict = OrderedDict({
                 'id':[book_id],
-                'title':[book_title],
-                'orig_title':[book_orig_title],
-                'author':[book_author],
-                'published':[first_published],
-                'language':[page_language],
-                'avg_rating':[avg_rating],
-                'ratings_count':[ratings_count],
+                'title':[page['title']],
+                'orig_title':[page['orig_title']],
+                'author':[page['author']],
+                'published':[page['published']],
+                'language':[page['language']],
+                'avg_rating':[page['avg_rating']],
+                'ratings_count':[page['ratings_count']],
                 'review_count':[reviews_count],
                 'genre_1':[''],
                 'genre_2':[''],
@@ -243,7 +100,7 @@ class gr_book_info:
             # get genres and shelves only if the book has more than 200 ratings. This is to improve performance
             # by not getting info for books with too low ratings.
             if int(reviews_count) >= 40:
-                top_genres = self.__extract_top_genres(soup)
+                top_genres = page['genres']
                 top_shelves = self.__extract_top_shelves(book_id)
 
                 ret_dict['genre_1'] = [top_genres[0]]
@@ -258,83 +115,203 @@ class gr_book_info:
             raise
             #return None
 
+def shelves_url(id):
+	return '{0}/book/shelves/{1}'.format(gr_config.BASE_URL, id)
+
 def get_book_info(book_count):
 	# set database connection
-	dir = os.path.dirname(__file__)
-	db_file = os.path.join(dir, 'data/books.db')
-	conn = sqlite3.connect(db_file)
+	conn = books_db.connect()
 	
-	# create table for raw book info
-	bookinfo_tbl = '''CREATE TABLE IF NOT EXISTS book_info (
-		id INT NOT NULL,
-		title TEXT,
-		orig_title TEXT,
-		author TEXT,
-		published DATE,
-		language TEXT,
-		avg_rating REAL,
-		ratings_count INT,
-		review_count INT,
-		genre_1 TEXT,
-		genre_2 TEXT,
-		genre_3 TEXT,
-		to_read INT,
-		currently_reading INT,
-		favorites INT
-		)
-	'''
-	conn.execute(bookinfo_tbl)
+	# create the tables, including book_info for raw book info, or bring them up to date
+	books_db.migrate(conn)
 	
-	# get info for book_count random books    
-	for i in range(book_count):
+	# get info for book_count random books. In replay mode, re-parse up to book_count book pages
+	# from the page cache instead
+	if gr_config.REPLAY:
+		cached_pages = gr_cache.get_cache().pages(['%/book/random', '%/book/show/%'])
+		book_pages = (html_source for url, fetched_at, html_source in itertools.islice(cached_pages, book_count))
+	else:
+		book_pages = (None for i in range(book_count))
+
+	# buffer a few books per insert. Small enough that little is lost if the run is interrupted
+	writer = books_db.bulk_writer(conn, 'book_info', list(gr_book_info.columns), buffer_rows=100)
+
+	for html_source in book_pages:
 		try:
-			book_info = gr_book_info('random')
+			book_info = gr_book_info('random', html_source=html_source)
 		except:
 			# if there's a problem reading a book info, skip and go to next
 			continue
 		if book_info.info != None:
-			book_info_df = pd.DataFrame.from_dict(book_info.info)
-			book_info_df.to_sql(con=conn, name='book_info', if_exists='append', index=False)
-	
-def clean_book_info():
-	#open connection to SQLite database
-	dir = os.path.dirname(__file__)
-	db_file = os.path.join(dir, 'data/books.db')
-	conn = sqlite3.connect(db_file)
-	
-	# Get raw book info data from database.
-	book_info_raw = pd.read_sql('SELECT * FROM book_info', con = conn)
-	
-	# filter reviews where review count is >= 40
-	book_info_40 = book_info_raw.loc[book_info_raw['review_count'] >=40]
-	# set is_copy to False to suppress SettingWithCopyWarning
-	book_info_40.is_copy = False
-	
-	# replace missing values in shelves with zeros
-	book_info_40[['favorites', 'to_read', 'currently_reading']] = book_info_40[['favorites', 'to_read', 'currently_reading']].replace(np.nan, 0)
-	
-	# Replace "Original Title" with "Title" where missing, else use Original Title
-	book_info_40[['orig_title']] = np.where(pd.isnull(book_info_40['orig_title']), book_info_40['title'], book_info_40['orig_title'])
-	
-	# now drop the 'title' column and rename 'orig_title' to 'title'
-	book_info_40.drop('title', axis=1, inplace=True)
-	book_info_40.columns = ['title' if x == 'orig_title' else x for x in book_info_40.columns]
-	
-	# sort the rows by the shelves, and keep only the rows with the max values and then sort by title
-	book_info_40 = book_info_40.sort_values(['title','to_read', 'currently_reading', 'favorites'], ascending=False).drop_duplicates('title')
-	book_info_40 = book_info_40.sort_values('title')
-	
-	# reindex
-	book_info_40 = book_info_40.reset_index()
-	
-	# insert cleaned data into database
-	try:
-		book_info_40.to_sql(con=conn, name='book_info_clean', index=False, if_exists='replace')
-	except:
-		pass
+			writer.add(tuple(book_info.info[column][0] for column in writer.columns))
+
+	writer.flush()
+	print(writer.report())
+	print(gr_fetch.get_fetcher().report())
 	
+# Concurrent harvester. Random book pages are fetched a batch at a time with gr_async_fetch, and books
+# already in book_info, or already drawn in this run, are skipped before any of their shelves pages are
+# requested. Only books with at least 40 reviews, the ones clean_book_info keeps, get their shelves
+# fetched, again a batch at a time
+
+shelf_names = ('to-read', 'currently-reading', 'favorites')
+
+def fetch_shelves_pages(fetcher, parser, book_ids):
+	"""Fetches the shelves pages of books concurrently, with the second page where gr_book_info would
+	read it. Returns a dict of URL to page, for gr_book_info's fetch_html"""
+	urls = [shelves_url(book_id) for book_id in book_ids]
+	pages = dict(zip(urls, fetcher.fetch(urls)))
+	next_urls = []
+	for url in urls:
+		try:
+			shelves = parser.parse_shelves_page(pages[url])
+		except:
+			continue
+		if not all(shelves[shelf] != '' for shelf in shelf_names) and shelves['next']:
+			next_urls.append(gr_config.BASE_URL + shelves['next'])
+	pages.update(zip(next_urls, fetcher.fetch(next_urls)))
+	return pages
+
+def harvest_book_info(book_count, max_draws=None, batch_size=None, concurrency=None, rate_limit=None):
+	"""Gets the info of book_count random books that aren't in book_info yet, drawing at most max_draws
+	random pages (default twice book_count), batch_size at a time (default 4 per request in flight).
+	Returns the number of books added"""
+	if gr_config.REPLAY:
+		# the cache has a single page for /book/random, so replay the cached book pages instead
+		get_book_info(book_count)
+		return None
+	time_start = time.perf_counter()
+	max_draws = max_draws or 2 * book_count
+	fetcher = async_fetcher(concurrency, rate_limit)
+	batch_size = batch_size or fetcher.concurrency * 4
+	parser = gr_parsers.get_parser()
+
+	conn = books_db.connect()
+	books_db.migrate(conn)
+	seen = set(row[0] for row in conn.execute('SELECT DISTINCT id FROM book_info'))
+	writer = books_db.bulk_writer(conn, 'book_info', list(gr_book_info.columns), buffer_rows=100)
+	random_url = '{0}/book/random'.format(gr_config.BASE_URL)
+	draws = duplicates = failed = kept = 0
+
+	while writer.rows + len(writer.buffer) < book_count and draws < max_draws:
+		count = min(batch_size, max_draws - draws)
+		draws += count
+		books = []
+		drawn = set()
+		for html_source in fetcher.fetch([random_url] * count):
+			try:
+				page = parser.parse_book_page(html_source)
+				book_id = int(page['id'])
+				review_count = int(page['review_count'])
+			except:
+				failed += 1
+				continue
+			if book_id in seen or book_id in drawn:
+				duplicates += 1
+				continue
+			drawn.add(book_id)
+			books.append((book_id, page, review_count >= 40))
+		books = books[:book_count - writer.rows - len(writer.buffer)]
+
+		shelves_pages = fetch_shelves_pages(fetcher, parser, [book_id for book_id, page, keep in books if keep])
+		for book_id, page, keep in books:
+			try:
+				book_info = gr_book_info('random', page=page, fetch_html=shelves_pages.get)
+			except:
+				failed += 1
+				continue
+			writer.add(tuple(book_info.info[column][0] for column in writer.columns))
+			# only books written count as seen, so ones cut from the batch or unreadable can be drawn again
+			seen.add(book_id)
+			kept += keep
+		writer.flush()
+
+	elapsed = time.perf_counter() - time_start
+	for result, count in (('new', writer.rows), ('seen', duplicates), ('unreadable', failed)):
+		gr_metrics.inc('random_books_total', count, result=result)
+	print(writer.report())
+	print(fetcher.report())
+	print('{0} new books from {1} random pages ({2} already seen, {3} unreadable), {4} with 40+ reviews and their '
+		'shelves, in {5:.1f} seconds: {6:.0f} unique books/min'.format(writer.rows, draws, duplicates, failed, kept,
+		elapsed, writer.rows / elapsed * 60 if elapsed > 0 else 0.0))
+	conn.close()
+	return writer.rows
+
+# Clean up of book_info into book_info_clean, in SQLite. Books with at least 40 reviews are kept, with the
+# original title as the title where there is one and missing shelf counts as 0, and of the books sharing a
+# title only the one with the most to-read, then currently-reading, then favorites shelvings is kept (the
+# latest fetched on a tie). book_info only ever has rows added, so the clean up is incremental: the
+# 'book_info_clean' entry of processing_state holds the last book_info rowid done, and a run only redoes
+# the titles of rows added since, a chunk of rows per transaction. A book with no title at all is only
+# picked up by a full rebuild
+
+clean_title_sql = 'IFNULL(orig_title, title)'
+
+# the kept row of each title in book_info b. {0} is the FROM clause, which can restrict the titles
+clean_books_sql = '''SELECT {columns} FROM (
+    SELECT b.id, IFNULL(b.orig_title, b.title) AS title, b.author, b.published, b.language, b.avg_rating, b.ratings_count,
+        b.review_count, b.genre_1, b.genre_2, b.genre_3, IFNULL(b.to_read, 0) AS to_read,
+        IFNULL(b.currently_reading, 0) AS currently_reading, IFNULL(b.favorites, 0) AS favorites,
+        ROW_NUMBER() OVER (PARTITION BY IFNULL(b.orig_title, b.title) ORDER BY IFNULL(b.to_read, 0) DESC,
+            IFNULL(b.currently_reading, 0) DESC, IFNULL(b.favorites, 0) DESC, b.rowid DESC) AS title_rank
+    FROM {{0}}
+    WHERE b.review_count >= 40)
+WHERE title_rank = 1'''.format(columns=', '.join(books_db.book_info_clean_columns))
+
+# title has no type, so no affinity, for its comparison with the IFNULL() expression to use book_info_title
+changed_titles_tbl = '''CREATE TEMP TABLE IF NOT EXISTS changed_titles (
+    title PRIMARY KEY NOT NULL
+    ) WITHOUT ROWID
+'''
+
+def clean_book_info(rebuild=False, chunk_rows=100000, db_file=None):
+	"""Updates book_info_clean with the book_info rows added since the last run, or with rebuild, or on
+	the first run, rebuilds it. Returns the number of book_info rows processed"""
+	conn = books_db.connect(db_file)
+	books_db.migrate(conn)
+	time_start = time.perf_counter()
+	insert_sql = 'INSERT OR REPLACE INTO book_info_clean ({0}) '.format(', '.join(books_db.book_info_clean_columns))
+	watermark = 0 if rebuild else books_db.stage_watermark(conn, 'book_info_clean')
+	last_rowid = conn.execute('SELECT IFNULL(MAX(rowid), 0) FROM book_info').fetchone()[0]
+
+	if watermark == 0:
+		# everything at once: SQLite sorts the partitions in its temp store, not in memory
+		with conn:
+			conn.execute('DELETE FROM book_info_clean')
+			conn.execute(insert_sql + clean_books_sql.format('book_info b'))
+		books_db.reset_stage(conn, 'book_info_clean')
+		books_db.set_stage_watermark(conn, 'book_info_clean', last_rowid, last_rowid)
+		processed = last_rowid
+	else:
+		conn.execute(changed_titles_tbl)
+		processed = 0
+		for low in range(watermark, last_rowid, chunk_rows):
+			high = min(low + chunk_rows, last_rowid)
+			with conn:
+				conn.execute('DELETE FROM changed_titles')
+				conn.execute('''INSERT OR IGNORE INTO changed_titles SELECT {0} FROM book_info
+					WHERE rowid > ? AND rowid <= ? AND review_count >= 40 AND {0} IS NOT NULL'''.format(clean_title_sql), (low, high))
+				# replace the kept book of every title the chunk touches, which may now be a different book
+				conn.execute('DELETE FROM book_info_clean WHERE title IN (SELECT title FROM changed_titles)')
+				# CROSS JOIN keeps changed_titles as the outer loop, looking up each title's rows by index
+				conn.execute(insert_sql + clean_books_sql.format(
+					'changed_titles c CROSS JOIN book_info b ON IFNULL(b.orig_title, b.title) = c.title'))
+			books_db.set_stage_watermark(conn, 'book_info_clean', high, high - low)
+			processed += high - low
+
+	clean_rows = conn.execute('SELECT COUNT(*) FROM book_info_clean').fetchone()[0]
+	conn.close()
+	print('Cleaned {0} book_info rows {1} in {2:.2f} seconds, {3} books in book_info_clean'.format(processed,
+		'incrementally' if watermark else 'in a full rebuild', time.perf_counter() - time_start, clean_rows))
+	return processed
+
 def main():
-    get_book_info()
+    # gr_book_info.py [book count] harvests book_count new books, default 100,000, then cleans up book_info.
+    # gr_book_info.py clean [rebuild] only cleans up
+    if sys.argv[1:2] == ['clean']:
+        clean_book_info(rebuild=sys.argv[2:3] == ['rebuild'])
+        return
+    harvest_book_info(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
     clean_book_info()
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import gr_config
+
+# On-disk cache of every page fetched from Goodreads. Page bodies are stored gzip compressed
+# under the SHA-256 of their content, so identical pages are only stored once. A small SQLite
+# index maps each (URL, fetch time) to the content it returned. With gr_config.REPLAY set, the
+# fetchers serve pages from here and never touch the network, so the extractors can be re-run
+# over everything scraped so far after a parser fix.
+
+cache_index_tbl = '''CREATE TABLE IF NOT EXISTS pages (
+    url TEXT NOT NULL,
+    final_url TEXT,
+    fetched_at REAL NOT NULL,
+    digest TEXT NOT NULL
+    )
+'''
+
+cache_blobs_tbl = '''CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY NOT NULL,
+    size INT NOT NULL
+    )
+'''
+
+cache_indexes = [
+    'CREATE INDEX IF NOT EXISTS pages_url ON pages (url, fetched_at)',
+    'CREATE INDEX IF NOT EXISTS pages_final_url ON pages (final_url, fetched_at)',
+    'CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest)',
+    ]
+
+class page_not_cached(LookupError):
+    """Raised in replay mode for a page that was never fetched"""
+    pass
+
+
+class page_cache:
+    """Content addressed store of fetched pages with size based eviction. Safe to share between
+    threads"""
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or gr_config.CACHE_DIR
+        self.max_bytes = gr_config.CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.directory, 'index.db'), check_same_thread=False)
+        self.conn.execute(cache_index_tbl)
+        self.conn.execute(cache_blobs_tbl)
+        for sql in cache_indexes:
+            self.conn.execute(sql)
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT IFNULL(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def __blob_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest + '.gz')
+
+    def store(self, url, html_source, final_url=None, fetched_at=None):
+        """Saves the page text fetched from url. final_url is the URL after redirects, e.g. the
+        book page that /book/random led to"""
+        data = html_source.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.__blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # write to a temporary file first so a crash never leaves a truncated blob behind
+            tmp_path = '{0}.{1}.tmp'.format(blob_path, threading.get_ident())
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as file:
+                file.write(data)
+            os.replace(tmp_path, blob_path)
+
+        with self.lock:
+            inserted = self.conn.execute('INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)',
+                (digest, os.path.getsize(blob_path))).rowcount
+            if inserted:
+                self.total_bytes += os.path.getsize(blob_path)
+            self.conn.execute('INSERT INTO pages (url, final_url, fetched_at, digest) VALUES (?, ?, ?, ?)',
+                (url, final_url if final_url != url else None, fetched_at or time.time(), digest))
+            self.conn.commit()
+            if self.total_bytes > self.max_bytes:
+                self.__evict(self.max_bytes * 0.9)
+        return digest
+
+    def __read(self, digest):
+        with gzip.open(self.__blob_path(digest), 'rb') as file:
+            return file.read().decode('utf-8')
+
+    def get(self, url):
+        """Returns the most recently fetched text for url, matching either the requested or the
+        redirected URL, or None if the page isn't cached"""
+        with self.lock:
+            row = self.conn.execute('''SELECT digest FROM pages WHERE url = ? OR final_url = ?
+                ORDER BY fetched_at DESC LIMIT 1''', (url, url)).fetchone()
+        if row is None:
+            return None
+        try:
+            return self.__read(row[0])
+        except FileNotFoundError:
+            return None
+
+    def pages(self, url_patterns):
+        """Yields (url, fetched_at, text) for every cached fetch of a URL matching one of the SQL LIKE
+        patterns, oldest first. Each fetch is returned, so a URL like /book/random gives back every
+        page it led to"""
+        where = ' OR '.join('url LIKE ?' for p in url_patterns)
+        with self.lock:
+            rows = self.conn.execute('SELECT url, fetched_at, digest FROM pages WHERE {0} ORDER BY fetched_at'.format(where),
+                list(url_patterns)).fetchall()
+        for url, fetched_at, digest in rows:
+            try:
+                yield url, fetched_at, self.__read(digest)
+            except FileNotFoundError:
+                continue
+
+    def __evict(self, target_bytes):
+        """Deletes the pages fetched longest ago until the stored content is under target_bytes.
+        Caller must hold the lock"""
+        rows = self.conn.execute('''SELECT b.digest, b.size FROM blobs b
+            JOIN (SELECT digest, MAX(fetched_at) AS last_fetched FROM pages GROUP BY digest) p ON p.digest = b.digest
+            ORDER BY p.last_fetched''').fetchall()
+        for digest, size in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(self.__blob_path(digest))
+            except FileNotFoundError:
+                pass
+            self.conn.execute('DELETE FROM pages WHERE digest = ?', (digest,))
+            self.conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            self.total_bytes -= size
+        self.conn.commit()
+
+    def evict(self, target_bytes=None):
+        with self.lock:
+            self.__evict(self.max_bytes if target_bytes is None else target_bytes)
+
+    def stats(self):
+        with self.lock:
+            pages, urls = self.conn.execute('SELECT COUNT(*), COUNT(DISTINCT url) FROM pages').fetchone()
+            blobs = self.conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]
+        return {'fetches': pages, 'urls': urls, 'unique_pages': blobs, 'bytes': self.total_bytes}
+
+    def export_fixtures(self, directory, url_patterns=('%',)):
+        """Writes the latest copy of each cached URL as a gr_stub_server fixture. Returns the number
+        of pages written"""
+        from gr_stub_server import save_fixture
+        latest = {}
+        for url, fetched_at, html_source in self.pages(url_patterns):
+            latest[url] = html_source
+        for url, html_source in latest.items():
+            parts = urlsplit(url)
+            save_fixture(directory, parts.path + ('?' + parts.query if parts.query else ''), html_source)
+        return len(latest)
+
+
+# cache shared by every fetcher in the process, created on first use
+shared_cache = None
+shared_cache_lock = threading.Lock()
+
+def get_cache():
+    global shared_cache
+    with shared_cache_lock:
+        if shared_cache is None:
+            shared_cache = page_cache()
+        return shared_cache
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    cache = get_cache()
+    if command == 'stats':
+        stats = cache.stats()
+        print('{0} fetches of {1} URLs, {2} unique pages, {3:.1f} MB on disk'.format(
+            stats['fetches'], stats['urls'], stats['unique_pages'], stats['bytes'] / 1e6))
+    elif command == 'evict':
+        cache.evict()
+    elif command == 'export':
+        print('{0} pages exported'.format(cache.export_fixtures(sys.argv[2], sys.argv[3:] or ('%',))))
+    else:
+        print('Usage: gr_cache.py [stats | evict | export <fixture dir> [url patterns]]')
+
+if __name__ == '__main__':
+    main()
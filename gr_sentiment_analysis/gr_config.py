@@ -0,0 +1,85 @@
+import os
+
+# Settings shared by the scraping and feature extraction modules. Each value can be overridden
+# with an environment variable of the same name prefixed with GR_, e.g. GR_CONCURRENCY=32
+
+# Root URL for all Goodreads requests. Point this at a local stub server to run the scrapers
+# against saved HTML fixtures.
+BASE_URL = os.environ.get('GR_BASE_URL', 'https://www.goodreads.com')
+
+# maximum number of page requests in flight at once
+CONCURRENCY = int(os.environ.get('GR_CONCURRENCY', 16))
+
+# maximum number of requests started per second against a single host. 0 disables the limit
+RATE_LIMIT = float(os.environ.get('GR_RATE_LIMIT', 5))
+
+# number of books whose review pages are fetched together before being written to the database
+BOOKS_PER_BATCH = int(os.environ.get('GR_BOOKS_PER_BATCH', 20))
+
+# review batches fetched ahead of the scorer in streaming mode, see gr_reviews.stream_reviews. Fetching
+# waits once this many are queued, which bounds the memory used to about this many batches of reviews
+STREAM_QUEUE_BATCHES = int(os.environ.get('GR_STREAM_QUEUE_BATCHES', 4))
+
+# HTML extraction backend, see gr_parsers. 'lxml' (fast, single pass) or 'bs4' (BeautifulSoup with html.parser)
+PARSER = os.environ.get('GR_PARSER', 'lxml')
+
+# raw page cache, see gr_cache. Every page fetched is saved under CACHE_DIR unless CACHE_PAGES is
+# off, and the oldest pages are evicted once the cache grows past CACHE_MAX_MB
+CACHE_DIR = os.environ.get('GR_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'data/page_cache'))
+CACHE_PAGES = os.environ.get('GR_CACHE_PAGES', '1') != '0'
+CACHE_MAX_MB = int(os.environ.get('GR_CACHE_MAX_MB', 4096))
+
+# replay mode: serve every page from the cache and never touch the network
+REPLAY = os.environ.get('GR_REPLAY', '0') == '1'
+
+# worker processes for feature extraction, see gr_features. 1 runs every stage in a single process
+WORKERS = int(os.environ.get('GR_WORKERS', 1))
+
+# compiled sentiment lexicons, see gr_lexicon
+LEXICON_FILE = os.environ.get('GR_LEXICON_FILE', os.path.join(os.path.dirname(__file__), 'data/lexicons.bin'))
+
+# online scoring service, see gr_scoring. MODEL_FILE is the pickled rating model used for predictions,
+# SCORING_MAX_BATCH the most texts accepted in one request, and SCORING_P99_MS the latency target the
+# load test checks
+MODEL_FILE = os.environ.get('GR_MODEL_FILE', os.path.join(os.path.dirname(__file__), 'data/models/rating_model.pkl'))
+SCORING_MAX_BATCH = int(os.environ.get('GR_SCORING_MAX_BATCH', 256))
+SCORING_P99_MS = float(os.environ.get('GR_SCORING_P99_MS', 100))
+
+# cached cross-validation fold results of the hyperparameter searches, see gr_search
+SEARCH_CACHE = os.environ.get('GR_SEARCH_CACHE', os.path.join(os.path.dirname(__file__), 'data/models/search_cache.db'))
+
+# columnar export of review_stats and review_tokens, see gr_export. With EXPORT on, extract_features
+# rewrites the export after every run. EXPORT_FORMAT is 'parquet' or 'arrow'
+EXPORT = os.environ.get('GR_EXPORT', '0') == '1'
+EXPORT_DIR = os.environ.get('GR_EXPORT_DIR', os.path.join(os.path.dirname(__file__), 'data/export'))
+EXPORT_FORMAT = os.environ.get('GR_EXPORT_FORMAT', 'parquet')
+
+# benchmark results, see gr_benchmark. A result more than BENCHMARK_THRESHOLD slower than the one it's
+# compared with counts as a regression
+BENCHMARK_DIR = os.environ.get('GR_BENCHMARK_DIR', os.path.join(os.path.dirname(__file__), 'data/benchmarks'))
+BENCHMARK_THRESHOLD = float(os.environ.get('GR_BENCHMARK_THRESHOLD', 0.1))
+
+# metrics and profiles of pipeline runs, see gr_metrics and gr_profile. METRICS_FILE is Prometheus text,
+# or JSON if it ends in .json
+METRICS_FILE = os.environ.get('GR_METRICS_FILE', os.path.join(os.path.dirname(__file__), 'data/metrics.prom'))
+PROFILE_DIR = os.environ.get('GR_PROFILE_DIR', os.path.join(os.path.dirname(__file__), 'data/profiles'))
+
+# single pass lexicon matching, see gr_matcher. MATCHER_PHRASES matches multi-word lexicon entries,
+# MATCHER_NEGATION_WINDOW flips entries up to that many words after a negation (0 for none), and
+# MATCHER_INQUIRER_SENSES keeps the polarity of every Inquirer sense
+MATCHER_PHRASES = os.environ.get('GR_MATCHER_PHRASES', '0') == '1'
+MATCHER_NEGATION_WINDOW = int(os.environ.get('GR_MATCHER_NEGATION_WINDOW', 0))
+MATCHER_INQUIRER_SENSES = os.environ.get('GR_MATCHER_INQUIRER_SENSES', '0') == '1'
+
+# hashed n-gram features of the tokenized reviews, see gr_hashing. HASHED_FEATURES is the number of
+# columns the n-grams are hashed into, and HASHED_NGRAMS the longest n-gram
+HASHED_DIR = os.environ.get('GR_HASHED_DIR', os.path.join(os.path.dirname(__file__), 'data/hashed'))
+HASHED_FEATURES = int(os.environ.get('GR_HASHED_FEATURES', 2 ** 18))
+HASHED_NGRAMS = int(os.environ.get('GR_HASHED_NGRAMS', 2))
+
+# nearest neighbour index for KNN rating prediction, see gr_neighbors. NEIGHBORS_K is the number of
+# neighbours that vote, NEIGHBORS_METHOD the search method, and NEIGHBORS_NPROBE the IVF lists searched
+NEIGHBORS_DIR = os.environ.get('GR_NEIGHBORS_DIR', os.path.join(os.path.dirname(__file__), 'data/models/neighbors'))
+NEIGHBORS_K = int(os.environ.get('GR_NEIGHBORS_K', 15))
+NEIGHBORS_METHOD = os.environ.get('GR_NEIGHBORS_METHOD', 'ivf')
+NEIGHBORS_NPROBE = int(os.environ.get('GR_NEIGHBORS_NPROBE', 8))
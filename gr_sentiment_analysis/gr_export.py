@@ -0,0 +1,218 @@
+import argparse
+import os
+import shutil
+import time
+import numpy as np
+
+import books_db
+import gr_config
+
+# Columnar export of review_stats and the tokenized reviews, for the notebooks and training jobs. Each
+# table is written as a dataset directory of Parquet files (or uncompressed Arrow IPC files, which can
+# be memory mapped with no decoding at all) that readers load through pyarrow.dataset, reading only the
+# columns they ask for and skipping files and row groups a filter rules out:
+#
+#   review_stats/rating=<n>/part-<i>.parquet        one partition per rating
+#   review_tokens/bucket=<n>/part-<i>.parquet       review_id, token_ids as a list of word IDs, in
+#                                                   buckets of bucket_size review IDs
+#   vocabulary.parquet                              word_id, word
+#
+# pyarrow is only needed here, and is imported when a function uses it.
+
+bucket_size = 1000000
+
+def arrow_modules():
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+    return pyarrow, pyarrow.dataset, pyarrow.parquet
+
+def export_dir():
+    return gr_config.EXPORT_DIR
+
+def file_format(dataset_format):
+    """pyarrow.dataset format for 'parquet' or 'arrow'"""
+    pa, ds, pq = arrow_modules()
+    if dataset_format == 'parquet':
+        return ds.ParquetFileFormat()
+    elif dataset_format == 'arrow':
+        return ds.IpcFileFormat()
+    raise ValueError('unknown dataset format {0}'.format(dataset_format))
+
+def review_stats_schema():
+    pa, ds, pq = arrow_modules()
+    return pa.schema([(column, pa.int64() if column in ('review_id', 'rating', 'word_count') else pa.float64())
+        for column in books_db.review_stats_columns])
+
+def review_tokens_schema():
+    pa, ds, pq = arrow_modules()
+    return pa.schema([('review_id', pa.int64()), ('token_ids', pa.list_(pa.uint32())), ('bucket', pa.int64())])
+
+def review_stats_batches(conn, chunk_size):
+    """Reads review_stats through a read connection as Arrow record batches, in review_id order"""
+    read_conn = books_db.connect_like(conn, check_same_thread=False)
+    cursor = read_conn.execute('SELECT {0} FROM review_stats ORDER BY review_id'.format(', '.join(books_db.review_stats_columns)))
+    return stats_batches(read_conn, cursor, chunk_size)
+
+def stats_batches(read_conn, cursor, chunk_size):
+    # pyarrow pulls the batches from its own threads, one at a time
+    pa, ds, pq = arrow_modules()
+    schema = review_stats_schema()
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        # NULLs come through as None, which Arrow keeps as nulls
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)],
+            schema=schema)
+    read_conn.close()
+
+def review_tokens_batches(conn, chunk_size):
+    """Reads review_tokens as Arrow record batches with the packed word IDs as list arrays"""
+    read_conn = books_db.connect_like(conn, check_same_thread=False)
+    cursor = read_conn.execute('SELECT review_id, token_ids FROM review_tokens ORDER BY review_id')
+    return tokens_batches(read_conn, cursor, chunk_size)
+
+def tokens_batches(read_conn, cursor, chunk_size):
+    pa, ds, pq = arrow_modules()
+    schema = review_tokens_schema()
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        review_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        tokens = [books_db.unpack_tokens(row[1]) if row[1] else np.zeros(0, dtype=books_db.token_dtype) for row in rows]
+        offsets = np.zeros(len(tokens) + 1, dtype=np.int32)
+        np.cumsum([len(t) for t in tokens], out=offsets[1:])
+        values = pa.array(np.concatenate(tokens).astype(np.uint32), type=pa.uint32())
+        yield pa.RecordBatch.from_arrays([pa.array(review_ids), pa.ListArray.from_arrays(pa.array(offsets), values),
+            pa.array(review_ids // bucket_size)], schema=schema)
+    read_conn.close()
+
+def write_dataset(batches, schema, path, partition_column, dataset_format, rows_per_group):
+    """Writes record batches to a dataset directory partitioned on partition_column, replacing any
+    earlier export in a single rename once it's complete"""
+    pa, ds, pq = arrow_modules()
+    temp_path = path + '.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    options = {}
+    if dataset_format == 'parquet':
+        options['file_options'] = file_format(dataset_format).make_write_options(compression='zstd')
+    ds.write_dataset(batches, temp_path, schema=schema, format=file_format(dataset_format),
+        partitioning=ds.partitioning(pa.schema([schema.field(partition_column)]), flavor='hive'),
+        basename_template='part-{i}.' + dataset_format, max_rows_per_group=rows_per_group,
+        min_rows_per_group=min(rows_per_group, 10000), **options)
+    # nothing is written for an empty table, but readers still expect the directory
+    os.makedirs(temp_path, exist_ok=True)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+
+def export_features(conn=None, out_dir=None, dataset_format=None, chunk_size=50000, rows_per_group=100000):
+    """Exports review_stats, review_tokens and the vocabulary to out_dir. Returns the rows written"""
+    pa, ds, pq = arrow_modules()
+    out_dir = out_dir or export_dir()
+    dataset_format = dataset_format or gr_config.EXPORT_FORMAT
+    close = conn is None
+    conn = conn or books_db.connect()
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    time_start = time.perf_counter()
+    if books_db.table_exists(conn, 'review_stats'):
+        write_dataset(review_stats_batches(conn, chunk_size), review_stats_schema(), os.path.join(out_dir, 'review_stats'),
+            'rating', dataset_format, rows_per_group)
+        counts['review_stats'] = conn.execute('SELECT COUNT(*) FROM review_stats').fetchone()[0]
+    write_dataset(review_tokens_batches(conn, chunk_size), review_tokens_schema(), os.path.join(out_dir, 'review_tokens'),
+        'bucket', dataset_format, rows_per_group)
+    counts['review_tokens'] = conn.execute('SELECT COUNT(*) FROM review_tokens').fetchone()[0]
+    words = conn.execute('SELECT word_id, word FROM vocabulary ORDER BY word_id').fetchall()
+    pq.write_table(pa.table({'word_id': pa.array([row[0] for row in words], type=pa.int64()),
+        'word': pa.array([row[1] for row in words], type=pa.string())}), os.path.join(out_dir, 'vocabulary.parquet'))
+    counts['vocabulary'] = len(words)
+    if close:
+        conn.close()
+    print('Exported {0} to {1} as {2} in {3:.2f} seconds'.format(
+        ', '.join('{0} {1} rows'.format(count, table) for table, count in counts.items()), out_dir, dataset_format,
+        time.perf_counter() - time_start))
+    return counts
+
+
+def open_dataset(name, path=None, dataset_format=None, memory_map=False):
+    """Opens an exported dataset, review_stats or review_tokens. memory_map maps the files rather than
+    reading them, which for Arrow files means the columns are used in place"""
+    pa, ds, pq = arrow_modules()
+    import pyarrow.fs
+    dataset_format = dataset_format or gr_config.EXPORT_FORMAT
+    return ds.dataset(os.path.join(path or export_dir(), name), format=file_format(dataset_format), partitioning='hive',
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=memory_map))
+
+def to_expression(filters):
+    """Filters as a pyarrow expression. Takes an expression, or pandas read_parquet style (column, op,
+    value) tuples that must all hold, e.g. [('rating', '!=', 0), ('word_count', '>=', 100)]"""
+    pa, ds, pq = arrow_modules()
+    if filters is None or isinstance(filters, ds.Expression):
+        return filters
+    return pq.filters_to_expression(filters)
+
+def load_review_stats(columns=None, filters=None, path=None, dataset_format=None, memory_map=False, pandas=True):
+    """Loads review_stats from the export, only reading columns (default all) and the partitions and row
+    groups that can match filters. Returns a DataFrame, or an Arrow table with pandas off"""
+    dataset = open_dataset('review_stats', path, dataset_format, memory_map)
+    table = dataset.to_table(columns=columns, filter=to_expression(filters))
+    return table.to_pandas() if pandas else table
+
+def load_review_tokens(review_ids=None, path=None, dataset_format=None, memory_map=False):
+    """Loads the exported word IDs, of the reviews in review_ids if given. Returns the Arrow table"""
+    pa, ds, pq = arrow_modules()
+    dataset = open_dataset('review_tokens', path, dataset_format, memory_map)
+    expression = None
+    if review_ids is not None:
+        review_ids = np.asarray(review_ids, dtype=np.int64)
+        # the bucket test prunes whole partitions before the row level test
+        expression = (ds.field('bucket').isin(np.unique(review_ids // bucket_size).tolist())
+            & ds.field('review_id').isin(pa.array(review_ids)))
+    return dataset.to_table(columns=['review_id', 'token_ids'], filter=expression)
+
+
+def benchmark(db_file=None, path=None, dataset_format=None, repeat=3):
+    """Times loading review_stats from SQLite as the notebooks do against the export, whole and with the
+    training columns and filter"""
+    import pandas as pd
+    import gr_scoring
+    import gr_train
+    conn = books_db.connect(db_file)
+    columns = ['rating'] + list(gr_scoring.feature_columns)
+    filters = [('rating', '!=', 0)] + [('total_{0}_count'.format(name), '!=', 0) for name in ('afinn', 'bing', 'mpqa', 'inq')]
+    runs = [
+        ('SQLite, SELECT *', lambda: pd.read_sql_query('SELECT * FROM review_stats', con=conn)),
+        ('SQLite, training query', lambda: pd.read_sql_query(gr_train.training_sql, con=conn)),
+        ('export, all columns', lambda: load_review_stats(path=path, dataset_format=dataset_format)),
+        ('export, training columns and filter', lambda: load_review_stats(columns, filters, path, dataset_format)),
+        ('export, training columns and filter, memory mapped', lambda: load_review_stats(columns, filters, path,
+            dataset_format, memory_map=True)),
+        ]
+    for name, run in runs:
+        best = None
+        for i in range(repeat):
+            time_start = time.perf_counter()
+            df = run()
+            elapsed = time.perf_counter() - time_start
+            best = elapsed if best is None else min(best, elapsed)
+        print('{0}: {1} rows x {2} columns in {3:.3f} seconds'.format(name, len(df), len(df.columns), best))
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports review_stats and review_tokens as Parquet or Arrow datasets')
+    parser.add_argument('command', nargs='?', default='export', choices=['export', 'benchmark'])
+    parser.add_argument('--db', default=None, help='database file (default data/books.db)')
+    parser.add_argument('--out', default=None, help='export directory (default GR_EXPORT_DIR)')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default=None, help='file format (default GR_EXPORT_FORMAT)')
+    args = parser.parse_args()
+    if args.command == 'export':
+        conn = books_db.connect(args.db)
+        export_features(conn, args.out, args.format)
+        conn.close()
+    else:
+        benchmark(args.db, args.out, args.format)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
-import pandas as pd
 import numpy as np
 import string
 import sqlite3
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
-import sqlite3
+import re
+import time
+import random
+import multiprocessing
+import argparse
+
+import books_db
+import gr_config
+import gr_lexicon
+import gr_metrics
 
 
 def words_to_list(str):
@@ -23,6 +29,7 @@ def words_to_list(str):
 
 def words_to_rows(review_text, id):
     """ Convert review text words for the given ID to a list. Exclude reviews with fewer than 30 words. Returns a dataframe."""
+    import pandas as pd
     if type(review_text) == float:
         return pd.DataFrame()
     words = words_to_list(review_text)
@@ -39,6 +46,7 @@ def words_to_rows(review_text, id):
 def review_features(row):
     """For use with apply, takes a row from the reviews table and returns the number of uppercase words with a length > 1 and number of 
     exclamation points. Returns as a pandas Series"""
+    import pandas as pd
     letter_set = set(string.ascii_uppercase + " ")
     upper_words = ''.join(c for c in row[1] if c in letter_set).split(' ')
     upper_words = [w for w in upper_words if len(w) > 1]
@@ -46,176 +54,507 @@ def review_features(row):
     ret = pd.Series({'review_id':row[0], 'cap_words_count':len(upper_words), 'exclamation_count':exclamation_count})
     return ret
 
-def extract_features():
-    # set up database connection and get data
-    dir = os.path.dirname(__file__)
-    db_file = os.path.join(dir, 'data/books.db')
-    conn = sqlite3.connect(db_file)
-            
-    # get review words for each review and return as a table of words
-    sql = '''SELECT review_id, review_text FROM reviews 
-        WHERE review_id > (SELECT IFNULL(MAX(review_id), 0) FROM review_words) 
-        AND review_text IS NOT NULL
-        AND review_id NOT IN (SELECT DISTINCT review_id FROM review_words)
-        ORDER BY review_id'''
-        
-    reviews_df = pd.read_sql_query(sql, con=conn, chunksize=10000)
-
-    for chunk in reviews_df:
-        for row in chunk.itertuples(index=False):
-            rev_id = row[0]
-            rev_text = row[1]
-
-            df = words_to_rows(rev_text, int(rev_id))
-            if len(df) > 0:
-                df.to_sql(con=conn, name='review_words', index=False, if_exists='append')
-
-    # get features (num of cap words, num of ! characters) from review text
-
-    sql = '''SELECT review_id, review_text FROM reviews 
-        WHERE review_id > (SELECT IFNULL(MAX(review_id), 0) FROM review_features) 
-        AND review_text IS NOT NULL 
-        AND review_id NOT IN (SELECT DISTINCT review_id FROM review_features) 
-        ORDER BY review_id'''
-
-    reviews_df = pd.read_sql_query(sql,con=conn,chunksize=10000)
-    
-    for chunk in reviews_df:
-        result = chunk.apply(review_features, axis='columns')
-        result.to_sql(con=conn, name='review_features', index=False, if_exists='append')
-
-    # now that we have all our words and all our sentiment scores in the database, now is the time to actually pull the data out and do some computations
-    word_sentiment_sql = word_sentiment_sql = '''SELECT rw.review_id, 
-			a.score AS afinn_score, 
-			o.sentiment AS bing_sentiment,
-			m.polarity AS mpqa_polarity,
-			i.polarity AS inq_polarity
-        FROM review_words rw
-        LEFT JOIN afinn_lexicon a ON a.word = rw.word
-        LEFT JOIN bing_lexicon o ON o.word = rw.word
-        LEFT JOIN mpqa_lexicon m ON m.word = rw.word
-        LEFT JOIN inquirer_lexicon i ON i.word = rw.word
-        '''
-
-    word_sentiment_df = pd.read_sql_query(word_sentiment_sql, con=conn)
-    # group by review ID
-    words_by_id = word_sentiment_df.groupby('review_id')
-    
-    # get mean, median, and sum
-    words_mean = words_by_id[['afinn_score', 'bing_sentiment', 'mpqa_polarity', 'inq_polarity']].mean()
-    words_mean.columns = ['afinn_mean', 'bing_mean', 'mpqa_mean', 'inq_mean']
-    
-    words_median = words_by_id[['afinn_score', 'bing_sentiment', 'mpqa_polarity', 'inq_polarity']].median()
-    words_median.columns = ['afinn_median', 'bing_median', 'mpqa_median', 'inq_median']
-    
-    words_sum = words_by_id[['afinn_score', 'bing_sentiment', 'mpqa_polarity', 'inq_polarity']].sum()
-    words_sum.columns = ['afinn_sum', 'bing_sum', 'mpqa_sum', 'inq_sum']
-    
-    pos_afinn_count = word_sentiment_df[word_sentiment_df['afinn_score'] > 0].groupby('review_id')[['review_id']].count()
-    pos_afinn_count.columns = ['pos_afinn_count']
-    
-    neg_afinn_count = word_sentiment_df[word_sentiment_df['afinn_score'] < 0].groupby('review_id')[['review_id']].count()
-    neg_afinn_count.columns = ['neg_afinn_count']
-    
-    pos_bing_count = word_sentiment_df[word_sentiment_df['bing_sentiment'] == 1].groupby('review_id')[['review_id']].count()
-    pos_bing_count.columns = ['pos_bing_count']
-    
-    neg_bing_count = word_sentiment_df[word_sentiment_df['bing_sentiment'] == 0].groupby('review_id')[['review_id']].count()
-    neg_bing_count.columns = ['neg_bing_count']   
-    
-    pos_mpqa_count = word_sentiment_df[word_sentiment_df['mpqa_polarity'] == 1].groupby('review_id')[['review_id']].count()
-    pos_mpqa_count.columns = ['pos_mpqa_count']
-    
-    neg_mpqa_count = word_sentiment_df[word_sentiment_df['mpqa_polarity'] == 0].groupby('review_id')[['review_id']].count()
-    neg_mpqa_count.columns = ['neg_mpqa_count']   
-    
-    pos_inq_count = word_sentiment_df[word_sentiment_df['inq_polarity'] == 1].groupby('review_id')[['review_id']].count()
-    pos_inq_count.columns = ['pos_inq_count']
-    
-    neg_inq_count = word_sentiment_df[word_sentiment_df['inq_polarity'] == 0].groupby('review_id')[['review_id']].count()
-    neg_inq_count.columns = ['neg_inq_count']   
-
-    word_counts = words_by_id[['review_id']].count()
-    word_counts.columns = ['word_count']
-            
-    # join results together
-    review_stats = pd.read_sql('SELECT review_id, rating FROM reviews WHERE review_id IN (SELECT DISTINCT review_id FROM review_words)', con=conn)
-    review_stats = review_stats.join(word_counts, on='review_id', how='left')
-    review_stats = review_stats.join(words_mean, on='review_id', how='left')
-    review_stats = review_stats.join(words_median, on='review_id', how='left')
-    review_stats = review_stats.join(words_sum, on='review_id', how='left')
-    review_stats = review_stats.join(pos_afinn_count, on='review_id', how='left')
-    review_stats = review_stats.join(neg_afinn_count, on='review_id', how='left')
-    review_stats = review_stats.join(pos_bing_count, on='review_id', how='left')
-    review_stats = review_stats.join(neg_bing_count, on='review_id', how='left')
-    review_stats = review_stats.join(pos_mpqa_count, on='review_id', how='left')
-    review_stats = review_stats.join(neg_mpqa_count, on='review_id', how='left')
-    review_stats = review_stats.join(pos_inq_count, on='review_id', how='left')
-    review_stats = review_stats.join(neg_inq_count, on='review_id', how='left')
-
-    # replace NaNs in the pos/neg count columns with zeros 
-    review_stats['pos_afinn_count'].fillna(0, inplace=True)
-    review_stats['neg_afinn_count'].fillna(0, inplace=True)
-    review_stats['pos_bing_count'].fillna(0, inplace=True)
-    review_stats['neg_bing_count'].fillna(0, inplace=True)
-    review_stats['pos_mpqa_count'].fillna(0, inplace=True)
-    review_stats['neg_mpqa_count'].fillna(0, inplace=True)
-    review_stats['pos_inq_count'].fillna(0, inplace=True)
-    review_stats['neg_inq_count'].fillna(0, inplace=True)
-
-    # add totals columns
-    review_stats['total_afinn_count'] = review_stats['pos_afinn_count'] + review_stats['neg_afinn_count']
-    review_stats['total_bing_count'] = review_stats['pos_bing_count'] + review_stats['neg_bing_count']
-    review_stats['total_mpqa_count'] = review_stats['pos_mpqa_count'] + review_stats['neg_mpqa_count']
-    review_stats['total_inq_count'] = review_stats['pos_inq_count'] + review_stats['neg_inq_count']
-
-    # include ratios of positive to negative counts for AFINN score and Bing sentiment
-    review_stats['pos_afinn_ratio'] = review_stats['pos_afinn_count'] / review_stats['total_afinn_count']
-    review_stats['pos_bing_ratio'] = review_stats['pos_bing_count'] / review_stats['total_bing_count']
-    review_stats['pos_mpqa_ratio'] = review_stats['pos_mpqa_count'] / review_stats['total_mpqa_count']
-    review_stats['pos_inq_ratio'] = review_stats['pos_inq_count'] / review_stats['total_inq_count']
-    
-    review_stats['neg_afinn_ratio'] = review_stats['neg_afinn_count'] / review_stats['total_afinn_count']
-    review_stats['neg_bing_ratio'] = review_stats['neg_bing_count'] / review_stats['total_afinn_count']
-    review_stats['neg_mpqa_ratio'] = review_stats['neg_mpqa_count'] / review_stats['total_mpqa_count']
-    review_stats['neg_inq_ratio'] = review_stats['neg_inq_count'] / review_stats['total_inq_count']
-
-    # replace inf values resultsint from division by 
-    review_stats['pos_afinn_ratio'].replace(np.inf, np.NaN, inplace=True)
-    review_stats['neg_afinn_ratio'].replace(np.inf, np.NaN, inplace=True)
-    review_stats['pos_bing_ratio'].replace(np.inf, np.NaN, inplace=True)
-    review_stats['neg_bing_ratio'].replace(np.inf, np.NaN, inplace=True)
-    review_stats['pos_mpqa_ratio'].replace(np.inf, np.NaN, inplace=True)
-    review_stats['neg_mpqa_ratio'].replace(np.inf, np.NaN, inplace=True)
-    review_stats['pos_inq_ratio'].replace(np.inf, np.NaN, inplace=True)
-    review_stats['neg_inq_ratio'].replace(np.inf, np.NaN, inplace=True)
-
-    # other calculated columns
-    review_stats['pos_afinn_density'] = review_stats['pos_afinn_count'] / review_stats['word_count']
-    review_stats['pos_bing_density'] = review_stats['pos_bing_count'] / review_stats['word_count']
-    review_stats['pos_mpqa_density'] = review_stats['pos_mpqa_count'] / review_stats['word_count']
-    review_stats['pos_inq_density'] = review_stats['pos_inq_count'] / review_stats['word_count']
-    
-    review_stats['neg_afinn_density'] = review_stats['neg_afinn_count'] / review_stats['word_count']
-    review_stats['neg_bing_density'] = review_stats['neg_bing_count'] / review_stats['word_count']
-    review_stats['neg_mpqa_density'] = review_stats['neg_mpqa_count'] / review_stats['word_count']
-    review_stats['neg_inq_density'] = review_stats['neg_inq_count'] / review_stats['word_count']
-    
-    review_stats['afinn_words_ratio'] = review_stats['afinn_sum'] / review_stats['word_count']
-    review_stats['bing_words_ratio'] = review_stats['bing_sum'] / review_stats['word_count']
-    review_stats['mpqa_words_ratio'] = review_stats['mpqa_sum'] / review_stats['word_count']
-    review_stats['afinn_words_ratio'] = review_stats['inq_sum'] / review_stats['word_count']
-
-    # add in review features data of ! and all caps word counts
-    review_features = pd.read_sql('SELECT review_id, cap_words_count, exclamation_count FROM review_features', con=conn)
-    review_stats = pd.merge(review_stats, review_features, on='review_id', how='left')
-    review_stats['all_caps_density'] = review_stats['cap_words_count'] / review_stats['word_count']
-    
-    # insert into database
-    review_stats.to_sql(con=conn, name='review_stats', index=False, if_exists='replace')
+# Byte tables for tokenize_batch. words_to_list and review_features only keep ASCII letters, ' - and
+# spaces, so a review can be encoded to ASCII (dropping everything else) and filtered with
+# bytes.translate, which lower-cases and deletes in a single C-level pass
+ascii_bytes = bytes(range(128))
+word_bytes = (string.ascii_letters + "'- ").encode('ascii')
+upper_bytes = (string.ascii_uppercase + ' ').encode('ascii')
+delete_non_word = bytes(c for c in ascii_bytes if c not in word_bytes)
+delete_non_upper = bytes(c for c in ascii_bytes if c not in upper_bytes)
+to_lower = bytes.maketrans(string.ascii_uppercase.encode('ascii'), string.ascii_lowercase.encode('ascii'))
+cap_words = re.compile(rb'[A-Z]{2,}')
+
+def tokenize_batch(texts):
+    """Tokenizes a chunk of review texts at once. Returns a list with a (words, cap_words_count, exclamation_count)
+    tuple per text, where words is the same list words_to_list returns and the counts match review_features.
+    Missing texts give no words and zero counts"""
+    time_start = time.perf_counter()
+    find_cap_words = cap_words.findall
+    ret = []
+    for text in texts:
+        if not isinstance(text, str):
+            ret.append(([], 0, 0))
+            continue
+        raw = text.encode('ascii', 'ignore')
+        # after deleting, spaces are the only whitespace left, so split() drops the blanks the same
+        # way filtering split(' ') does. Runs of 2+ capitals between spaces are the upper case words
+        # longer than one letter
+        ret.append((raw.translate(to_lower, delete_non_word).decode('ascii').split(),
+            len(find_cap_words(raw.translate(None, delete_non_upper))),
+            text.count('!')))
+    gr_metrics.observe('tokenize_seconds', time.perf_counter() - time_start)
+    gr_metrics.inc('reviews_tokenized_total', len(ret))
+    return ret
+
+def is_positive(lexicon, value):
+    """AFINN scores are positive above zero. The other lexicons use 1 for positive and 0 for negative"""
+    return value > 0 if lexicon == 'afinn' else value == 1
+
+def is_negative(lexicon, value):
+    return value < 0 if lexicon == 'afinn' else value == 0
+
+
+class lexicon_scorer:
+    """Scores reviews, given as arrays of word IDs, against the four sentiment lexicons.
+
+    Results match a LEFT JOIN of the words against all four lexicon tables followed by a group by review.
+    The compiled lexicons (see gr_lexicon) hold each word's number of joined rows and how many of them
+    have each score, and these are laid out here by word ID: row_counts, and a row of counts with one
+    column per (lexicon, score) pair in columns. lexicons defaults to the compiled lexicon file"""
+
+    def __init__(self, conn, vocab, lexicons=None):
+        if lexicons is None:
+            lexicons = gr_lexicon.load_lexicons(conn)
+        self.version = lexicons.version
+        self.columns = lexicons.columns
+
+        # resolve lexicon words to word IDs. The last row is shared by every word ID past the end of the
+        # arrays, i.e. words added to the vocabulary later, which can't be lexicon words
+        word_ids = np.array([vocab.word_id(word) for word in lexicons.words()], dtype=np.int64)
+        self.size = int(word_ids.max(initial=0)) + 2
+        self.row_counts = np.ones(self.size, dtype=np.int64)
+        self.counts = np.zeros((self.size, len(self.columns)), dtype=np.int64)
+        self.in_lexicon = np.zeros(self.size, dtype=bool)
+        self.row_counts[word_ids] = lexicons.row_counts
+        self.counts[word_ids] = lexicons.counts
+        self.in_lexicon[word_ids] = True
+
+    def score(self, token_arrays):
+        """Scores a list of non-empty word ID arrays, one per review. Returns the joined row count of each
+        review and a matrix of histogram counts with a row per review and a column per self.columns"""
+        lengths = np.array([len(tokens) for tokens in token_arrays])
+        ids = np.minimum(np.concatenate(token_arrays), self.size - 1)
+        review_index = np.repeat(np.arange(len(token_arrays)), lengths)
+
+        # only lexicon words change the counts, so drop the rest before summing per review
+        in_lexicon = self.in_lexicon[ids]
+        ids = ids[in_lexicon]
+        review_index = review_index[in_lexicon]
+        word_counts = lengths + np.bincount(review_index, weights=self.row_counts[ids] - 1,
+            minlength=len(lengths)).astype(np.int64)
+        histograms = np.zeros((len(lengths), len(self.columns)), dtype=np.int64)
+        np.add.at(histograms, review_index, self.counts[ids])
+        return word_counts, histograms
+
+    def stats(self, word_counts, histograms):
+        """Computes the review_stats columns from means through mpqa_words_ratio for scored reviews, as a
+        float matrix with a row per review. Missing values are NaN"""
+        return lexicon_stats(self.columns, word_counts, histograms)
+
+def lexicon_stats(columns, word_counts, histograms):
+    """Computes the review_stats columns from means through mpqa_words_ratio for scored reviews from their
+    joined row counts and histograms over columns, (lexicon index, score) pairs with scores ascending within
+    each lexicon. Returns a float matrix with a row per review. Missing values are NaN"""
+    means = []
+    medians = []
+    sums = []
+    pos = []
+    neg = []
+    for i, name in enumerate(gr_lexicon.lexicon_names):
+        in_lexicon = [j for j, (lexicon, score) in enumerate(columns) if lexicon == i]
+        scores = np.array([columns[j][1] for j in in_lexicon], dtype=np.float64)
+        counts = histograms[:, in_lexicon]
+        n = counts.sum(axis=1)
+        total = counts @ scores
+        # median from the cumulative counts, averaging the middle two scores for an even count
+        cumulative = counts.cumsum(axis=1)
+        lower = scores[(cumulative > ((n - 1) // 2)[:, None]).argmax(axis=1)] if len(scores) else np.zeros(len(n))
+        upper = scores[(cumulative > (n // 2)[:, None]).argmax(axis=1)] if len(scores) else np.zeros(len(n))
+        means.append(np.where(n > 0, total / np.maximum(n, 1), np.nan))
+        medians.append(np.where(n > 0, (lower + upper) / 2, np.nan))
+        sums.append(total)
+        pos.append(counts[:, [is_positive(name, score) for score in scores]].sum(axis=1).astype(np.float64))
+        neg.append(counts[:, [is_negative(name, score) for score in scores]].sum(axis=1).astype(np.float64))
+    totals = [p + n for p, n in zip(pos, neg)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = means + medians + sums
+        for p, n in zip(pos, neg):
+            values += [p, n]
+        values += totals
+        values += [p / t for p, t in zip(pos, totals)]
+        # neg_bing_ratio has always been divided by the AFINN total. Kept as is so the models' inputs don't change
+        values += [neg[0] / totals[0], neg[1] / totals[0], neg[2] / totals[2], neg[3] / totals[3]]
+        values += [p / word_counts for p in pos]
+        values += [n / word_counts for n in neg]
+        # likewise afinn_words_ratio has always held the Inquirer sum, and there is no inq_words_ratio
+        values += [sums[3] / word_counts, sums[1] / word_counts, sums[2] / word_counts]
+    ret = np.column_stack(values)
+    # the old pandas code turned inf from dividing by zero into NaN
+    ret[np.isinf(ret)] = np.nan
+    return ret
+
+# stage queries, for run_stage. Each selects from the pending reviews subquery, {0}, and {1} is the ORDER BY
+pending_text_sql = '''SELECT c.review_id, c.seq, r.review_text FROM ({0}) c
+    JOIN reviews r ON r.review_id = c.review_id {1}'''
+
+pending_scoring_sql = '''SELECT c.review_id, c.seq, r.rating, t.token_ids, f.cap_words_count, f.exclamation_count
+    FROM ({0}) c
+    JOIN reviews r ON r.review_id = c.review_id
+    LEFT JOIN review_tokens t ON t.review_id = c.review_id
+    LEFT JOIN review_features f ON f.review_id = c.review_id {1}'''
+
+def run_stage(conn, stage, sql, process_chunk, upto, chunk_size=10000):
+    """Runs process_chunk over chunks of the reviews a stage hasn't processed yet, up to change upto, and
+    records the stage's progress. sql selects from the pending reviews subquery, as {0} aliased c, with
+    c.review_id and c.seq as its first two columns and {1} for the ORDER BY. Returns the number of reviews
+    processed.
+
+    A stage that has never run goes over every review unsorted, and only records its progress at the end.
+    Otherwise changes are handled in order and progress is saved after each chunk, so an interrupted run
+    carries on where it stopped. Reprocessing a review just overwrites its rows"""
+    watermark = books_db.stage_watermark(conn, stage)
+    # read through a second connection so committing each chunk doesn't disturb the open query
+    read_conn = books_db.connect_like(conn)
+    rows = read_conn.execute(sql.format(books_db.pending_reviews_sql(watermark, upto),
+        'ORDER BY c.seq' if watermark else ''))
+    processed = 0
+    recorded = 0
+    while True:
+        chunk = rows.fetchmany(chunk_size)
+        if not chunk:
+            break
+        process_chunk(chunk)
+        processed += len(chunk)
+        if watermark:
+            books_db.set_stage_watermark(conn, stage, chunk[-1][1], processed - recorded)
+            recorded = processed
+    read_conn.close()
+    books_db.set_stage_watermark(conn, stage, upto, processed - recorded)
+    return processed
+
+def delete_reviews(conn, table, review_ids):
+    """Removes rows left over from an earlier version of reviews that no longer produce any"""
+    if review_ids:
+        with conn:
+            conn.executemany('DELETE FROM {0} WHERE review_id = ?'.format(table), [(i,) for i in review_ids])
+
+def tokenize_reviews(conn, vocab, upto):
+    """words stage: stores the words of new and edited reviews with at least 30 words as word IDs"""
+    writer = books_db.bulk_writer(conn, 'review_tokens', ['review_id', 'token_ids'], replace=True)
+
+    def process_chunk(chunk):
+        # tokenize the whole chunk and queue the words of reviews with at least 30 words
+        short = []
+        for (review_id, seq, review_text), (words, cap_count, excl_count) in zip(chunk, tokenize_batch([row[2] for row in chunk])):
+            if len(words) >= 30:
+                writer.add((review_id, books_db.pack_tokens(vocab.encode(words))))
+            else:
+                short.append(review_id)
+        # new words go first so no stored tokens refer to a missing word
+        vocab.flush()
+        delete_reviews(conn, 'review_tokens', short)
+        writer.flush()
+
+    run_stage(conn, 'words', pending_text_sql, process_chunk, upto)
+    print(writer.report())
+
+def count_review_features(conn, upto):
+    """features stage: counts all caps words and ! characters in new and edited reviews"""
+    writer = books_db.bulk_writer(conn, 'review_features', ['review_id', 'cap_words_count', 'exclamation_count'], replace=True)
+
+    def process_chunk(chunk):
+        writer.add_many([(review_id, cap_count, excl_count)
+            for (review_id, seq, review_text), (words, cap_count, excl_count) in zip(chunk, tokenize_batch([row[2] for row in chunk]))
+            if review_text is not None])
+        delete_reviews(conn, 'review_features', [row[0] for row in chunk if row[2] is None])
+        writer.flush()
+
+    run_stage(conn, 'features', pending_text_sql, process_chunk, upto)
+    print(writer.report())
+
+def review_stats_rows(scorer, reviews):
+    """Scores reviews given as (review_id, rating, word ID array, cap_words_count, exclamation_count) and
+    returns their review_stats rows"""
+    if not reviews:
+        return []
+    time_start = time.perf_counter()
+    word_counts, histograms = scorer.score([tokens for review_id, rating, tokens, cap_count, excl_count in reviews])
+    stats = scorer.stats(word_counts, histograms)
+    gr_metrics.observe('score_seconds', time.perf_counter() - time_start)
+    gr_metrics.inc('reviews_scored_total', len(reviews))
+    return stats_rows([(review_id, rating, cap_count, excl_count) for review_id, rating, tokens, cap_count, excl_count in reviews],
+        word_counts, stats)
+
+def stats_rows(reviews, word_counts, stats):
+    """Assembles review_stats rows from each review's (review_id, rating, cap_words_count, exclamation_count),
+    joined row count and row of lexicon stats"""
+    ret = []
+    for (review_id, rating, cap_words_count, exclamation_count), word_count, values in zip(
+            reviews, word_counts.tolist(), stats.tolist()):
+        all_caps_density = cap_words_count / word_count if cap_words_count is not None else None
+        # store NaN as NULL, as to_sql did
+        ret.append((review_id, rating, word_count) + tuple(None if v != v else v for v in values)
+            + (cap_words_count, exclamation_count, all_caps_density))
+    return ret
+
+def review_rows(vocab, scorer, reviews):
+    """Tokenizes, counts and scores reviews held in memory, given as (review_id, rating, review_text), the
+    way the three stages would once they're in the database. Returns their review_tokens, review_features
+    and review_stats rows. New words are added to vocab, which must be flushed before the tokens are stored"""
+    tokens_rows = []
+    features_rows = []
+    scored = []
+    for (review_id, rating, review_text), (words, cap_count, excl_count) in zip(reviews, tokenize_batch([row[2] for row in reviews])):
+        if review_text is None:
+            continue
+        features_rows.append((review_id, cap_count, excl_count))
+        if len(words) >= 30:
+            tokens = np.array(vocab.encode(words), dtype=np.int64)
+            tokens_rows.append((review_id, books_db.pack_tokens(tokens)))
+            scored.append((review_id, rating, tokens, cap_count, excl_count))
+    return tokens_rows, features_rows, review_stats_rows(scorer, scored)
+
+def score_reviews(conn, vocab=None, rebuild=False):
+    """stats stage: scores reviews whose words or features changed and upserts their review_stats rows.
+    The first run, or one with rebuild set (e.g. after the lexicons change), rebuilds review_stats from
+    every review. Only changes both earlier stages have processed are scored"""
+    if rebuild:
+        books_db.reset_stage(conn, 'stats')
+    if books_db.stage_watermark(conn, 'stats') == 0:
+        conn.execute('DROP TABLE IF EXISTS review_stats')
+    conn.execute(books_db.review_stats_tbl)
+    upto = min(books_db.stage_watermark(conn, 'words'), books_db.stage_watermark(conn, 'features'))
+    scorer = lexicon_scorer(conn, vocab or books_db.vocabulary(conn))
+    writer = books_db.bulk_writer(conn, 'review_stats', books_db.review_stats_columns, replace=True)
+    time_scoring = [0.0]
+
+    def process_chunk(chunk):
+        # reviews too short to have tokens get no stats
+        delete_reviews(conn, 'review_stats', [row[0] for row in chunk if not row[3]])
+        time_start = time.perf_counter()
+        rows = review_stats_rows(scorer, [(review_id, rating, books_db.unpack_tokens(blob), cap_count, excl_count)
+            for review_id, seq, rating, blob, cap_count, excl_count in chunk if blob])
+        time_scoring[0] += time.perf_counter() - time_start
+        writer.add_many(rows)
+        writer.flush()
+
+    run_stage(conn, 'stats', pending_scoring_sql, process_chunk, upto)
+    print('Scored reviews in {0:.2f} seconds. {1}'.format(time_scoring[0], writer.report()))
+
+
+# Process pool mode. The reviews to process are split into review_id ranges, and each worker process
+# tokenizes, counts and scores a whole range at a time from its own read-only connection. The parent
+# process is the only writer: it assigns IDs to new words and commits each range's results, so the
+# workers never wait on SQLite's write lock
+
+# the pending review IDs to split into shards, and the reviews of one shard
+pending_ids_sql = 'SELECT review_id FROM ({0}) ORDER BY review_id'
+shard_sql = 'SELECT review_id, rating, review_text FROM reviews WHERE review_id BETWEEN ? AND ?'
+
+# per worker process state, set up by init_worker
+worker_state = {}
+
+def init_worker(db_file, pending_sql):
+    """Opens the worker's read connection and loads the vocabulary and lexicons once per worker.
+    pending_sql is the pending reviews subquery, or None to process every review in a shard"""
+    conn = books_db.connect(db_file)
+    vocab = books_db.vocabulary(conn)
+    worker_state['conn'] = conn
+    worker_state['ids'] = vocab.ids
+    worker_state['scorer'] = lexicon_scorer(conn, vocab)
+    worker_state['pending_sql'] = pending_sql
+
+def process_shard(shard):
+    """Tokenizes, counts and scores the pending reviews with review_id in the inclusive range shard.
+    Words missing from the worker's vocabulary are given negative IDs, -1 for the first entry of the
+    returned new_words and so on, for the writer to replace"""
+    ids = worker_state['ids']
+    new_ids = {}
+    sql = shard_sql
+    if worker_state['pending_sql']:
+        sql += ' AND review_id IN (SELECT review_id FROM ({0}))'.format(worker_state['pending_sql'])
+    rows = worker_state['conn'].execute(sql, shard).fetchall()
+
+    ret = {'tokens': [], 'features': [], 'stats': [], 'short': [], 'no_text': []}
+    scored = []
+    for (review_id, rating, review_text), (words, cap_count, excl_count) in zip(rows, tokenize_batch([row[2] for row in rows])):
+        if review_text is None:
+            ret['no_text'].append(review_id)
+            continue
+        ret['features'].append((review_id, cap_count, excl_count))
+        if len(words) < 30:
+            ret['short'].append(review_id)
+            continue
+        tokens = np.array([ids.get(word) or new_ids.setdefault(word, -len(new_ids) - 1) for word in words], dtype=np.int64)
+        ret['tokens'].append((review_id, tokens))
+        # new words can't be lexicon words, which were all added before the workers started, so they are
+        # scored as the unused word ID 0
+        scored.append((review_id, rating, np.maximum(tokens, 0), cap_count, excl_count))
+    ret['stats'] = review_stats_rows(worker_state['scorer'], scored)
+    ret['new_words'] = list(new_ids)
+    # the shard's tokenize and score times, for the parent's metrics
+    ret['metrics'] = gr_metrics.collect()
+    return ret
+
+def shard_ranges(review_ids, shard_size):
+    """Splits a sorted array of review IDs into inclusive (low, high) ranges of about shard_size reviews"""
+    return [(int(review_ids[i]), int(review_ids[min(i + shard_size, len(review_ids)) - 1]))
+        for i in range(0, len(review_ids), shard_size)]
+
+def extract_features_parallel(conn, vocab, workers, rebuild_stats=False, shard_size=5000):
+    """Runs all three stages in one pass over the changed reviews with a pool of worker processes. Starts
+    from the least advanced stage, and records all three as done at the end"""
+    if rebuild_stats:
+        books_db.reset_stage(conn, 'stats')
+    stages = ['words', 'features', 'stats']
+    watermark = min(books_db.stage_watermark(conn, stage) for stage in stages)
+    upto = books_db.last_review_change(conn)
+    if books_db.stage_watermark(conn, 'stats') == 0:
+        conn.execute('DROP TABLE IF EXISTS review_stats')
+    conn.execute(books_db.review_stats_tbl)
+
+    # register the lexicon words before the workers load their copy of the vocabulary
+    lexicon_scorer(conn, vocab)
+    vocab.flush()
+
+    pending_sql = books_db.pending_reviews_sql(watermark, upto)
+    review_ids = np.array([row[0] for row in conn.execute(pending_ids_sql.format(pending_sql))], dtype=np.int64)
+    shards = shard_ranges(review_ids, shard_size)
+
+    tokens_writer = books_db.bulk_writer(conn, 'review_tokens', ['review_id', 'token_ids'], replace=True)
+    features_writer = books_db.bulk_writer(conn, 'review_features', ['review_id', 'cap_words_count', 'exclamation_count'], replace=True)
+    stats_writer = books_db.bulk_writer(conn, 'review_stats', books_db.review_stats_columns, replace=True)
+    time_start = time.perf_counter()
+    # a stage that has never run processes every review, so there's nothing to filter on
+    initargs = (books_db.database_file(conn), pending_sql if watermark else None)
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+        for result in pool.imap_unordered(process_shard, shards):
+            # give the shard's new words their real IDs, saved before the tokens that use them
+            new_ids = np.array([vocab.word_id(word) for word in result['new_words']] or [0], dtype=np.int64)
+            vocab.flush()
+            for review_id, tokens in result['tokens']:
+                new = tokens < 0
+                tokens[new] = new_ids[-tokens[new] - 1]
+                tokens_writer.add((review_id, books_db.pack_tokens(tokens)))
+            features_writer.add_many(result['features'])
+            stats_writer.add_many(result['stats'])
+            gr_metrics.merge(result['metrics'])
+            removed = result['short'] + result['no_text']
+            delete_reviews(conn, 'review_tokens', removed)
+            delete_reviews(conn, 'review_stats', removed)
+            delete_reviews(conn, 'review_features', result['no_text'])
+            tokens_writer.flush()
+            features_writer.flush()
+            stats_writer.flush()
+    elapsed = time.perf_counter() - time_start
+
+    for stage in stages:
+        books_db.set_stage_watermark(conn, stage, upto, len(review_ids))
+    print(tokens_writer.report())
+    print(features_writer.report())
+    print(stats_writer.report())
+    print('{0} workers: {1} reviews in {2:.2f} seconds, {3:.0f} reviews/sec'.format(
+        workers, len(review_ids), elapsed, len(review_ids) / elapsed if elapsed > 0 else 0.0))
+    return len(review_ids), elapsed
+
+def extract_features(rebuild_stats=False, workers=None, db_file=None, export=None):
+    """Runs the words, features and stats stages over reviews added or edited since the last run. With
+    more than one worker the stages run together in a process pool, see extract_features_parallel. With
+    export on (default gr_config.EXPORT), review_stats and review_tokens are then exported, see gr_export"""
+    workers = workers or gr_config.WORKERS
+    conn = books_db.connect(db_file)
+    books_db.migrate(conn)
+    vocab = books_db.vocabulary(conn)
+
+    if workers > 1:
+        extract_features_parallel(conn, vocab, workers, rebuild_stats=rebuild_stats)
+    else:
+        upto = books_db.last_review_change(conn)
+        tokenize_reviews(conn, vocab, upto)
+        count_review_features(conn, upto)
+        # now that we have all our words in the database, score the changed reviews against the lexicons
+        score_reviews(conn, vocab, rebuild=rebuild_stats)
+    books_db.prune_review_changes(conn, ['words', 'features', 'stats'])
+    if gr_config.EXPORT if export is None else export:
+        import gr_export
+        gr_export.export_features(conn)
+    conn.close()
+
+def benchmark_workers(db_file, worker_counts=(1, 2, 4, 8)):
+    """Times a full feature extraction of a copy of db_file with each number of workers. One worker
+    runs the stages in a single process, as without the process pool"""
+    import tempfile
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in worker_counts:
+            copy_file = os.path.join(directory, 'books.db')
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(copy_file + suffix):
+                    os.remove(copy_file + suffix)
+            source = books_db.connect(db_file)
+            copy = sqlite3.connect(copy_file)
+            source.backup(copy)
+            source.close()
+            # forget all progress so every review is processed again
+            if books_db.table_exists(copy, 'processing_state'):
+                copy.execute('DELETE FROM processing_state')
+                copy.commit()
+            copy.close()
+
+            time_start = time.perf_counter()
+            extract_features(workers=workers, db_file=copy_file, export=False)
+            results.append((workers, time.perf_counter() - time_start))
+
+    print('{0} CPUs'.format(os.cpu_count()))
+    for workers, elapsed in results:
+        print('{0} workers: {1:.2f}s, {2:.2f}x'.format(workers, elapsed, results[0][1] / elapsed))
+
+def synthetic_reviews(count, seed=0):
+    """Builds count review-like texts for benchmarking: mixed case words, capitalised words,
+    punctuation, digits, accented letters and control characters"""
+    rng = random.Random(seed)
+    vocab = ['good', 'bad', 'book', 'story', "didn't", 'well-written', 'LOVED', 'the', 'a', 'characters',
+        'plot', 'amazing!', 'boring...', 'I', 'OK', 'café', '5/5', 'e-book', 'Tolkien', '(spoilers)', 'WOW!!']
+    return [' '.join(rng.choice(vocab) for i in range(rng.randint(5, 300))) + rng.choice(['', '\t', '\x07'])
+        for j in range(count)]
+
+def benchmark_tokenizer(count=100000):
+    """Times words_to_list and review_features against tokenize_batch on count synthetic reviews
+    and checks that both give the same results"""
+    texts = synthetic_reviews(count)
+
+    time_start = time.perf_counter()
+    words = [words_to_list(text) for text in texts]
+    features = [review_features((i, text)) for i, text in enumerate(texts)]
+    old_time = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    tokens = tokenize_batch(texts)
+    new_time = time.perf_counter() - time_start
+
+    for i in range(count):
+        if (tokens[i][0] != words[i] or tokens[i][1] != features[i]['cap_words_count']
+                or tokens[i][2] != features[i]['exclamation_count']):
+            raise AssertionError('tokenize_batch differs from words_to_list/review_features for: {0!r}'.format(texts[i]))
+
+    print('words_to_list + review_features: {0:.2f}s ({1:.0f} reviews/sec)'.format(old_time, count / old_time))
+    print('tokenize_batch: {0:.2f}s ({1:.0f} reviews/sec), {2:.1f}x faster'.format(new_time, count / new_time, old_time / new_time))
 
 def main():
-    extract_features()
+    parser = argparse.ArgumentParser(description='Extracts review features and sentiment scores into books.db')
+    parser.add_argument('command', nargs='?', default='extract', choices=['extract', 'rescore', 'export', 'benchmark', 'scaling'],
+        help='extract: process new and edited reviews. rescore: also rebuild review_stats from every review, e.g. after '
+        'the lexicon tables are rebuilt. export: write review_stats and review_tokens as Parquet or Arrow datasets, see '
+        'gr_export. benchmark: time the tokenizer. scaling: time a full run with 1, 2, 4 and 8 workers')
+    parser.add_argument('count', nargs='?', type=int, default=100000, help='number of synthetic reviews for benchmark')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default GR_WORKERS, or 1)')
+    parser.add_argument('--db', default=None, help='database file (default data/books.db)')
+    parser.add_argument('--export', action='store_true', default=None, help='export the features after extracting them (default GR_EXPORT)')
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        benchmark_tokenizer(args.count)
+    elif args.command == 'scaling':
+        benchmark_workers(args.db or books_db.db_path())
+    elif args.command == 'export':
+        import gr_export
+        conn = books_db.connect(args.db)
+        gr_export.export_features(conn)
+        conn.close()
+    else:
+        extract_features(rebuild_stats=args.command == 'rescore', workers=args.workers, db_file=args.db, export=args.export)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
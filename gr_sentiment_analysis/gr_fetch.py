@@ -0,0 +1,195 @@
+import random
+import time
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import gr_config
+import gr_cache
+import gr_metrics
+
+# Shared HTTP layer for the scrapers. All pages go through one pooled keep-alive session so
+# connections to Goodreads are reused instead of opened per page. Transient failures are retried
+# with exponential backoff and jitter, limited by a retry budget so a Goodreads outage doesn't
+# turn into a retry storm.
+
+# status codes worth retrying. Anything else is returned to the caller as-is
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter: a random delay between 0 and base * 2^attempt seconds,
+    capped at cap seconds"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class fetch_stats:
+    """Running totals for requests made through a fetcher. Latencies are kept for the most
+    recent requests only, so memory stays constant over long runs. Every request is also recorded
+    in gr_metrics, labelled with fetcher"""
+
+    def __init__(self, latency_window=10000, fetcher='requests'):
+        self.fetcher = fetcher
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.retries = 0
+        self.failures = 0
+        self.bytes = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.latency_total = 0.0
+
+    def connection_opened(self):
+        with self.lock:
+            self.new_connections += 1
+
+    def request_done(self, latency, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.latencies.append(latency)
+            self.latency_total += latency
+        gr_metrics.inc('pages_fetched_total', fetcher=self.fetcher)
+        gr_metrics.inc('fetch_bytes_total', size, fetcher=self.fetcher)
+        gr_metrics.observe('fetch_seconds', latency, fetcher=self.fetcher)
+
+    def retried(self):
+        with self.lock:
+            self.retries += 1
+        gr_metrics.inc('fetch_retries_total', fetcher=self.fetcher)
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+        gr_metrics.inc('fetch_failures_total', fetcher=self.fetcher)
+
+    def reused_connections(self):
+        return max(self.requests - self.new_connections, 0)
+
+    def latency_percentile(self, pct):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(int(len(latencies) * pct / 100), len(latencies) - 1)]
+
+    def report(self):
+        mean = self.latency_total / self.requests if self.requests else 0.0
+        return ('{0} requests over {1} connections ({2} reused), {3} retries, {4} failed. '
+            'Latency mean {5:.3f}s, p50 {6:.3f}s, p95 {7:.3f}s').format(
+            self.requests, self.new_connections, self.reused_connections(), self.retries, self.failures,
+            mean, self.latency_percentile(50), self.latency_percentile(95))
+
+
+class retry_budget:
+    """Allows retries only while they stay under ratio of all requests made, plus a fixed
+    allowance of min_retries for the start of a run"""
+
+    def __init__(self, ratio=0.1, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+
+    def allows(self, stats):
+        return stats.retries < self.min_retries + self.ratio * stats.requests
+
+
+class counting_adapter(HTTPAdapter):
+    """HTTPAdapter that counts each new connection it opens, so reuse can be measured"""
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self.stats
+
+        def counting_pool(base):
+            class pool(base):
+                def _new_conn(self):
+                    stats.connection_opened()
+                    return super()._new_conn()
+            return pool
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': counting_pool(HTTPConnectionPool),
+            'https': counting_pool(HTTPSConnectionPool),
+            }
+
+
+def default_cache():
+    """the shared page cache if caching or replay is turned on in gr_config, else None"""
+    if gr_config.CACHE_PAGES or gr_config.REPLAY:
+        return gr_cache.get_cache()
+    return None
+
+
+class fetcher:
+    """Gets pages over a pooled keep-alive session, with timeouts and retries. Successful pages
+    are saved to the page cache, and in replay mode pages come from the cache only"""
+
+    def __init__(self, pool_size=None, timeout=(5, 30), max_retries=3, backoff_base=1.0, backoff_max=60.0, budget=None,
+                 cache=None, replay=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats = fetch_stats()
+        self.budget = budget or retry_budget()
+        self.cache = cache or default_cache()
+        self.replay = gr_config.REPLAY if replay is None else replay
+        pool_size = pool_size or gr_config.CONCURRENCY
+        self.session = requests.Session()
+        adapter = counting_adapter(self.stats, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url):
+        """gets the page at url and returns its text. Connection errors, timeouts and retryable
+        status codes are retried up to max_retries times while the retry budget allows"""
+        if self.replay:
+            html_source = self.cache.get(url)
+            if html_source is None:
+                raise gr_cache.page_not_cached(url)
+            return html_source
+
+        attempt = 0
+        while True:
+            time_start = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                self.stats.request_done(time.perf_counter() - time_start, len(response.content))
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code == 200 and self.cache is not None:
+                        self.cache.store(url, response.text, final_url=response.url)
+                    return response.text
+                error = requests.exceptions.HTTPError('{0} for {1}'.format(response.status_code, url), response=response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+
+            if attempt >= self.max_retries or not self.budget.allows(self.stats):
+                self.stats.failed()
+                raise error
+            self.stats.retried()
+            time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max))
+            attempt += 1
+
+    def report(self):
+        return self.stats.report()
+
+
+# fetcher shared by every scraper in the process, created on first use
+shared_fetcher = None
+shared_fetcher_lock = threading.Lock()
+
+def get_fetcher():
+    global shared_fetcher
+    with shared_fetcher_lock:
+        if shared_fetcher is None:
+            shared_fetcher = fetcher()
+        return shared_fetcher
+
+def get_html(url):
+    """Gets the page at url through the shared fetcher and returns its text"""
+    return get_fetcher().get(url)
@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import struct
+import time
+import zipfile
+import numpy as np
+
+import books_db
+import gr_config
+
+# Hashed n-gram features of the tokenized reviews, for models that can take sparse input. Every word and
+# every run of up to ngrams words in a review is hashed to one of n_features columns, so the matrices take
+# the same memory however large the vocabulary grows, and counted in a scipy CSR matrix with a row per
+# review_stats row. With alternate_sign on, as in scikit-learn's HashingVectorizer, half the hashes count
+# -1 so that collisions tend to cancel out rather than add up.
+#
+# The matrices are built a chunk of reviews at a time from review_tokens and written to a directory of
+# shards, uncompressed .npz files that scipy.sparse.load_npz reads and load_shard memory maps:
+#
+#   shard-<i>.npz    data, indices, indptr and shape of the CSR matrix, and review_ids, one per row, in
+#                    review_stats order
+#   manifest.json    the hashing parameters, and each shard's file, rows, review ID range and nonzeros
+#
+# A word's hash only depends on its text, so features built on different databases line up.
+
+manifest_format = 1
+
+def hashed_dir():
+    return gr_config.HASHED_DIR
+
+def word_hashes(conn):
+    """64-bit hash of every vocabulary word, indexed by word_id"""
+    words = conn.execute('SELECT word_id, word FROM vocabulary').fetchall()
+    ret = np.zeros(max([word_id for word_id, word in words] or [0]) + 1, dtype=np.uint64)
+    for word_id, word in words:
+        ret[word_id] = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+    return ret
+
+def mix(values):
+    """splitmix64 finalizer, spreading every bit of a uint64 array over the whole result"""
+    with np.errstate(over='ignore'):
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return values ^ (values >> np.uint64(31))
+
+def hash_tokens(token_arrays, hashes, n_features, ngrams=2, alternate_sign=True):
+    """CSR matrix of the hashed 1 to ngrams-word n-gram counts of each word ID array, with hashes the
+    word hashes from word_hashes"""
+    import scipy.sparse
+    lengths = np.array([len(tokens) for tokens in token_arrays], dtype=np.int64)
+    if not len(lengths) or not lengths.sum():
+        return scipy.sparse.csr_matrix((len(lengths), n_features), dtype=np.float32)
+    tokens = np.concatenate(token_arrays).astype(np.int64)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    # how many more words the review has from each position
+    remaining = np.repeat(lengths, lengths) - (np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+
+    token_hashes = hashes[tokens]
+    gram = token_hashes
+    keys = [mix(gram)]
+    key_rows = [rows]
+    with np.errstate(over='ignore'):
+        for n in range(2, ngrams + 1):
+            # fold the next word into the n-grams starting at each position, keeping those that don't run
+            # past the end of their review
+            gram = gram[:-1] * np.uint64(0x9e3779b97f4a7c15) + token_hashes[n - 1:]
+            keep = remaining[:len(gram)] >= n
+            keys.append(mix(gram[keep] + np.uint64(n)))
+            key_rows.append(rows[:len(gram)][keep])
+    keys = np.concatenate(keys)
+    columns = (keys % np.uint64(n_features)).astype(np.int64)
+    values = np.where(keys >> np.uint64(63), -1, 1).astype(np.float32) if alternate_sign else np.ones(len(keys), dtype=np.float32)
+    # duplicates are summed on conversion to CSR
+    matrix = scipy.sparse.coo_matrix((values, (np.concatenate(key_rows), columns)), shape=(len(lengths), n_features)).tocsr()
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    return matrix
+
+def save_shard(path, matrix, review_ids):
+    """Writes a CSR matrix and its review IDs as an uncompressed .npz that scipy.sparse.load_npz reads"""
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, format=np.array(b'csr'), shape=np.array(matrix.shape), data=matrix.data, indices=matrix.indices,
+            indptr=matrix.indptr, review_ids=np.asarray(review_ids, dtype=np.int64))
+    os.replace(path + '.tmp', path)
+
+def npz_arrays(path, memory_map=True):
+    """The arrays of an uncompressed .npz file, as memory maps of the file with memory_map on. np.load
+    ignores mmap_mode for .npz files, so the offset of each array is read from its zip header"""
+    if not memory_map:
+        with np.load(path) as npz:
+            return dict((name, npz[name]) for name in npz.files)
+    ret = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{0} is compressed, and can\'t be memory mapped'.format(path))
+            # the local header's name and extra field lengths can differ from the central directory's
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+            name = info.filename[:-len('.npy')]
+            if dtype.hasobject or not np.prod(shape):
+                file.seek(info.header_offset + 30 + name_length + extra_length)
+                ret[name] = np.lib.format.read_array(file)
+            else:
+                ret[name] = np.memmap(path, dtype=dtype, mode='r', offset=file.tell(), shape=shape,
+                    order='F' if fortran_order else 'C')
+    return ret
+
+def load_shard(path, memory_map=True):
+    """A shard's CSR matrix and review IDs. With memory_map on, the matrix's arrays are read only maps of
+    the file, paged in as they're used"""
+    import scipy.sparse
+    arrays = npz_arrays(path, memory_map)
+    shape = tuple(int(n) for n in arrays['shape'])
+    return scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False), arrays['review_ids']
+
+def read_manifest(path=None):
+    with open(os.path.join(path or hashed_dir(), 'manifest.json')) as file:
+        return json.load(file)
+
+def aligned_tokens(conn, chunk_size):
+    """Reads the word IDs of every review_stats row in review_id order, a chunk of (review_ids, token
+    arrays) at a time. Rows with no tokens get none"""
+    read_conn = books_db.connect_like(conn)
+    cursor = read_conn.execute('''SELECT s.review_id, t.token_ids FROM review_stats s
+        LEFT JOIN review_tokens t ON t.review_id = s.review_id ORDER BY s.review_id''')
+    empty = np.zeros(0, dtype=books_db.token_dtype)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield [row[0] for row in rows], [books_db.unpack_tokens(row[1]) if row[1] else empty for row in rows]
+    read_conn.close()
+
+def build_features(conn=None, out_dir=None, n_features=None, ngrams=None, alternate_sign=True, shard_rows=100000,
+        chunk_size=10000):
+    """Hashes the n-grams of every review_stats row's tokens into CSR shards in out_dir (default
+    gr_config.HASHED_DIR), replacing any earlier build in a single rename once it's complete. Memory use
+    is bounded by shard_rows and n_features, not the number of reviews. Returns the manifest"""
+    import scipy.sparse
+    out_dir = out_dir or hashed_dir()
+    n_features = n_features or gr_config.HASHED_FEATURES
+    ngrams = ngrams or gr_config.HASHED_NGRAMS
+    close = conn is None
+    conn = conn or books_db.connect()
+    hashes = word_hashes(conn)
+    temp_dir = out_dir.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    manifest = {
+        'format': manifest_format,
+        'n_features': n_features,
+        'ngrams': ngrams,
+        'alternate_sign': alternate_sign,
+        'dtype': 'float32',
+        'vocabulary_size': len(hashes) - 1,
+        'shards': [],
+        }
+    time_start = time.perf_counter()
+    pending = []
+    pending_ids = []
+
+    def write_shard():
+        matrix = scipy.sparse.vstack(pending, format='csr')
+        name = 'shard-{0:05d}.npz'.format(len(manifest['shards']))
+        save_shard(os.path.join(temp_dir, name), matrix, pending_ids)
+        manifest['shards'].append({'file': name, 'rows': matrix.shape[0], 'first_review_id': pending_ids[0],
+            'last_review_id': pending_ids[-1], 'nnz': int(matrix.nnz)})
+        del pending[:]
+        del pending_ids[:]
+
+    for review_ids, token_arrays in aligned_tokens(conn, chunk_size):
+        # split chunks at shard boundaries, so every shard but the last has shard_rows rows
+        while review_ids:
+            take = shard_rows - len(pending_ids)
+            pending.append(hash_tokens(token_arrays[:take], hashes, n_features, ngrams, alternate_sign))
+            pending_ids.extend(review_ids[:take])
+            review_ids, token_arrays = review_ids[take:], token_arrays[take:]
+            if len(pending_ids) == shard_rows:
+                write_shard()
+    if pending_ids:
+        write_shard()
+    if close:
+        conn.close()
+    manifest['rows'] = sum(shard['rows'] for shard in manifest['shards'])
+    manifest['nnz'] = sum(shard['nnz'] for shard in manifest['shards'])
+    with open(os.path.join(temp_dir, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(temp_dir, out_dir)
+    elapsed = time.perf_counter() - time_start
+    print('Hashed {0} reviews into {1} shards of {2} features, {3} nonzeros, in {4:.2f} seconds, {5:.0f} reviews/sec'.format(
+        manifest['rows'], len(manifest['shards']), n_features, manifest['nnz'], elapsed,
+        manifest['rows'] / elapsed if elapsed > 0 else 0.0))
+    return manifest
+
+def iter_shards(path=None, memory_map=True):
+    """Yields the (CSR matrix, review IDs) of each shard in review_id order"""
+    path = path or hashed_dir()
+    for shard in read_manifest(path)['shards']:
+        yield load_shard(os.path.join(path, shard['file']), memory_map)
+
+def load_features(path=None, memory_map=True):
+    """All shards as one CSR matrix, with a row per review_stats row at build time, and its review IDs"""
+    import scipy.sparse
+    matrices = []
+    review_ids = []
+    for matrix, ids in iter_shards(path, memory_map):
+        matrices.append(matrix)
+        review_ids.append(ids)
+    if not matrices:
+        manifest = read_manifest(path)
+        return scipy.sparse.csr_matrix((0, manifest['n_features']), dtype=np.float32), np.zeros(0, dtype=np.int64)
+    return scipy.sparse.vstack(matrices, format='csr'), np.concatenate(review_ids)
+
+def feature_rows(review_ids, path=None, memory_map=True):
+    """The hashed rows of review_ids, in the order given, reading only those rows from each shard. Raises
+    KeyError if a review isn't in the build, e.g. one scored after it"""
+    import scipy.sparse
+    review_ids = np.asarray(review_ids, dtype=np.int64)
+    found = np.zeros(len(review_ids), dtype=bool)
+    matrices = []
+    order = []
+    for matrix, ids in iter_shards(path, memory_map):
+        positions = np.minimum(np.searchsorted(ids, review_ids), max(len(ids) - 1, 0))
+        match = np.flatnonzero(ids[positions] == review_ids) if len(ids) else np.zeros(0, dtype=np.int64)
+        if len(match):
+            matrices.append(matrix[positions[match]])
+            order.append(match)
+            found[match] = True
+    if not found.all():
+        raise KeyError('reviews not in the hashed features, rebuild them: {0}'.format(review_ids[~found][:10].tolist()))
+    if not matrices:
+        return scipy.sparse.csr_matrix((0, read_manifest(path)['n_features']), dtype=np.float32)
+    return scipy.sparse.vstack(matrices, format='csr')[np.argsort(np.concatenate(order))]
+
+
+def training_matrix(conn, path=None, dataset=None):
+    """The training rows of gr_train.training_data with their hashed features: the review_stats feature
+    matrix, the hashed CSR matrix and the ratings"""
+    import gr_train
+    X, y, review_ids = gr_train.training_data(conn, dataset, review_ids=True)
+    return X, feature_rows(review_ids, path), y
+
+def evaluate(db_file=None, path=None, dataset=None):
+    """Fits a linear model on 80% of the training rows with the review_stats features alone, then with
+    the hashed n-grams as well, and prints the accuracy of each on the other 20%. Returns the two"""
+    import scipy.sparse
+    from sklearn.feature_extraction.text import TfidfTransformer
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import StandardScaler
+    conn = books_db.connect(db_file)
+    X, H, y = training_matrix(conn, path, dataset)
+    conn.close()
+    print('{0} reviews, {1} review_stats features, {2} hashed features with {3} nonzeros ({4:.1f} MB)'.format(
+        len(y), X.shape[1], H.shape[1], H.nnz, (H.data.nbytes + H.indices.nbytes + H.indptr.nbytes) / 1e6))
+    X_train, X_test, H_train, H_test, y_train, y_test = train_test_split(X, H, y, test_size=0.2, random_state=1)
+    scaler = StandardScaler().fit(X_train)
+    tfidf = TfidfTransformer().fit(H_train)
+    results = {}
+    for name, train, test in [
+            ('review_stats', scaler.transform(X_train), scaler.transform(X_test)),
+            ('review_stats + hashed n-grams',
+                scipy.sparse.hstack([scaler.transform(X_train), tfidf.transform(H_train)], format='csr'),
+                scipy.sparse.hstack([scaler.transform(X_test), tfidf.transform(H_test)], format='csr'))]:
+        model = SGDClassifier(loss='log_loss', alpha=1e-5, max_iter=100, tol=1e-4, random_state=1)
+        time_start = time.perf_counter()
+        model.fit(train, y_train)
+        results[name] = float(model.score(test, y_test))
+        print('{0}: fitted in {1:.2f} seconds, test accuracy {2:.4f}'.format(name, time.perf_counter() - time_start,
+            results[name]))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds hashed n-gram feature matrices of the tokenized reviews')
+    subparsers = parser.add_subparsers(dest='command')
+    build = subparsers.add_parser('build', help='hash every review_stats row\'s tokens into CSR shards')
+    build.add_argument('--features', type=int, default=None, help='number of hashed features (default GR_HASHED_FEATURES)')
+    build.add_argument('--ngrams', type=int, default=None, help='longest n-gram hashed (default GR_HASHED_NGRAMS)')
+    build.add_argument('--no-sign', action='store_true', help='count every n-gram +1 rather than alternating signs')
+    build.add_argument('--shard-rows', type=int, default=100000, help='reviews per shard')
+    info = subparsers.add_parser('info', help='show the manifest of a build')
+    evaluate_parser = subparsers.add_parser('evaluate', help='compare a linear model with and without the hashed features')
+    evaluate_parser.add_argument('--dataset', default=None, help='read review_stats from this gr_export directory')
+    for subparser in (build, evaluate_parser):
+        subparser.add_argument('--db', default=None, help='database file (default data/books.db)')
+    for subparser in (build, info, evaluate_parser):
+        subparser.add_argument('--dir', default=None, help='shard directory (default GR_HASHED_DIR)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        conn = books_db.connect(args.db)
+        build_features(conn, args.dir, args.features, args.ngrams, not args.no_sign, args.shard_rows)
+        conn.close()
+    elif args.command == 'info':
+        manifest = read_manifest(args.dir)
+        for key in ('n_features', 'ngrams', 'alternate_sign', 'vocabulary_size', 'rows', 'nnz'):
+            print('{0}: {1}'.format(key, manifest[key]))
+        for shard in manifest['shards']:
+            print('{0}: {1} rows, review IDs {2} to {3}, {4} nonzeros'.format(shard['file'], shard['rows'],
+                shard['first_review_id'], shard['last_review_id'], shard['nnz']))
+    elif args.command == 'evaluate':
+        evaluate(args.db, args.dir, args.dataset)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
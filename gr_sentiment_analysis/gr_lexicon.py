@@ -0,0 +1,332 @@
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import numpy as np
+
+import gr_config
+
+# Compiled sentiment lexicons. The four lexicons are merged into one binary file that any process can
+# memory map and use in a few milliseconds, rather than parsing the source files or joining against the
+# lexicon tables. The file holds a header followed by three arrays, one row per distinct word:
+#
+#   keys        the words, UTF-8 encoded, as sorted fixed-width byte strings
+#   row_counts  the number of rows a LEFT JOIN of the word against all four lexicon tables gives. A word
+#               listed n times in one lexicon and m times in another gives n * m rows
+#   counts      how many of those joined rows have each score, a column per (lexicon, score) pair
+#
+# The header starts with magic and the format version, followed by the length of a JSON document
+# giving the columns, the array shapes and offsets, and version, a digest of the lexicon contents
+
+magic = b'GRLEXCON'
+format_version = 1
+header_struct = np.dtype([('magic', 'S8'), ('format_version', '<u4'), ('header_length', '<u4')])
+alignment = 64
+
+# lexicon name, table and score column, in review_stats column order
+lexicon_tables = [
+    ('afinn', 'afinn_lexicon', 'score'),
+    ('bing', 'bing_lexicon', 'sentiment'),
+    ('mpqa', 'mpqa_lexicon', 'polarity'),
+    ('inq', 'inquirer_lexicon', 'polarity'),
+    ]
+lexicon_names = [name for name, table, column in lexicon_tables]
+
+
+# Source file readers. Each returns a DataFrame with a word column and a score column named as in the
+# lexicon's table
+
+def read_afinn(data_dir):
+    import pandas as pd
+    afinn = pd.read_csv(os.path.join(data_dir, 'AFINN-111.txt'), sep='\t', names=['word', 'score'])
+    # convert score column to int
+    afinn['score'] = afinn['score'].astype('int')
+    return afinn
+
+def read_bing(data_dir):
+    import pandas as pd
+    positive_words = pd.read_csv(os.path.join(data_dir, 'bing-positive-words.txt'), names=['word'], encoding='latin-1',
+        header=None, skiprows=34)
+    negative_words = pd.read_csv(os.path.join(data_dir, 'bing-negative-words.txt'), names=['word'], encoding='latin-1',
+        header=None, skiprows=34)
+    # set positive words to a score of 1, and negative to 0
+    positive_words['sentiment'] = 1
+    negative_words['sentiment'] = 0
+    # merge positive and negatives into a single DF
+    opinion_lexicon_df = pd.merge(positive_words, negative_words, how='outer')
+    opinion_lexicon_df.sort_values('word', inplace=True)
+    opinion_lexicon_df.reset_index(inplace=True, drop=True)
+    return opinion_lexicon_df
+
+mpqa_word_re = re.compile('.*word1=(.*)\s{1}pos1')
+mpqa_polarity_re = re.compile('.*priorpolarity=(.*)')
+
+def read_mpqa(data_dir):
+    import pandas as pd
+    # extract the words and sentiment polarity score from each line of the input file
+    with open(os.path.join(data_dir, 'subjclueslen1-HLTEMNLP05.tff'), mode='r') as file:
+        lines = file.readlines()
+    return pd.DataFrame({
+        'word': [mpqa_word_re.search(line).group(1) for line in lines],
+        'polarity': [1 if mpqa_polarity_re.search(line).group(1) == 'positive' else 0 for line in lines],
+        }, columns=['word', 'polarity'])
+
+def read_inquirer(data_dir, senses=False):
+    """The Inquirer lists a word once per sense, as WORD#1, WORD#2 and so on. Only the first sense with a
+    polarity is kept, unless senses is set, which keeps one row per distinct polarity among its senses"""
+    import pandas as pd
+    inquirer_df = pd.read_excel(os.path.join(data_dir, 'inquirerbasic.xls'))
+    # 1 for Positiv words, 0 for Negativ ones, and -1 for words that are neither
+    polarity = np.select([inquirer_df['Positiv'] == 'Positiv', inquirer_df['Negativ'] == 'Negativ'], [1, 0], -1)
+    inquirer_df_new = pd.DataFrame({'word': inquirer_df['Entry'].str.lower(), 'polarity': polarity})
+    inquirer_df_new = inquirer_df_new[inquirer_df_new['polarity'] != -1]
+    # get rid of #s in the words and remove duplicates
+    inquirer_df_new['word'] = inquirer_df_new['word'].str.replace(r'#\d+', '', regex=True)
+    inquirer_df_new.drop_duplicates(['word', 'polarity'] if senses else 'word', inplace=True)
+    return inquirer_df_new
+
+lexicon_readers = [read_afinn, read_bing, read_mpqa, read_inquirer]
+
+def read_sources(data_dir=None, inquirer_senses=False):
+    """Parses the four lexicon source files. Returns a list of (word, score) row lists in lexicon_tables
+    order. inquirer_senses keeps the polarities of every Inquirer sense, see read_inquirer"""
+    data_dir = data_dir or os.path.join(os.path.dirname(__file__), 'data')
+    return [frame_rows(read_inquirer(data_dir, inquirer_senses) if reader is read_inquirer else reader(data_dir))
+        for reader in lexicon_readers]
+
+def frame_rows(df):
+    """(word, score) rows of a lexicon DataFrame as they'd read back from its table: words as text, and
+    missing words and scores as None"""
+    ret = []
+    for word, value in zip(df.iloc[:, 0].tolist(), df.iloc[:, 1].tolist()):
+        word = None if word is None or word != word else str(word)
+        value = None if value is None or value != value else int(value)
+        ret.append((word, value))
+    return ret
+
+def read_tables(conn):
+    """Reads the (word, score) rows of the four lexicon tables, in lexicon_tables order"""
+    return [conn.execute('SELECT word, {0} FROM {1} ORDER BY rowid'.format(column, table)).fetchall()
+        for name, table, column in lexicon_tables]
+
+
+def compile_lexicons(lexicon_rows):
+    """Merges the (word, score) rows of each lexicon into the arrays of a compiled lexicon file. Returns
+    keys, row_counts, counts and the (lexicon index, score) pair of each counts column"""
+    values = []
+    for rows in lexicon_rows:
+        values.append({})
+        for word, value in rows:
+            if word is not None:
+                values[-1].setdefault(word, []).append(value)
+
+    # columns, with scores in ascending order within each lexicon
+    columns = []
+    for i, lexicon in enumerate(values):
+        scores = set(v for m in lexicon.values() for v in m if v is not None)
+        columns += [(i, score) for score in sorted(scores)]
+    column_index = dict((column, j) for j, column in enumerate(columns))
+
+    words = sorted(set().union(*values), key=lambda word: word.encode('utf-8'))
+    row_counts = np.ones(len(words), dtype='<i4')
+    counts = np.zeros((len(words), len(columns)), dtype='<i4')
+    for k, word in enumerate(words):
+        matches = [lexicon.get(word, []) for lexicon in values]
+        multiples = [len(m) or 1 for m in matches]
+        row_count = int(np.prod(multiples))
+        row_counts[k] = row_count
+        for i, (m, multiple) in enumerate(zip(matches, multiples)):
+            for value in m:
+                # NULL scores still add joined rows, but no score
+                if value is not None:
+                    counts[k, column_index[(i, value)]] += row_count // multiple
+    keys = np.array([word.encode('utf-8') for word in words], dtype='S{0}'.format(max([len(w.encode('utf-8')) for w in words] or [1])))
+    return keys, row_counts, counts, columns
+
+def align(offset):
+    return -(-offset // alignment) * alignment
+
+def rows_digest(lexicon_rows):
+    """Digest of the (word, score) rows of each lexicon, as read_sources or read_tables return them"""
+    return hashlib.sha1(json.dumps(lexicon_rows).encode('utf-8')).hexdigest()[:16]
+
+def write_lexicons(path, keys, row_counts, counts, columns, source='', source_digest=None):
+    """Writes a compiled lexicon file, replacing any earlier one in a single rename. source_digest is the
+    rows_digest of the rows it was compiled from. Returns its version"""
+    digest = hashlib.sha1()
+    for array in (keys, row_counts, counts):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps(columns).encode('utf-8'))
+
+    header = {
+        'version': digest.hexdigest()[:16],
+        'source': source,
+        'source_digest': source_digest,
+        'compiled_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'lexicons': lexicon_names,
+        'columns': columns,
+        'words': len(keys),
+        'key_width': keys.dtype.itemsize,
+        }
+    # the arrays start on aligned offsets after the header
+    offset = align(header_struct.itemsize + 4096)
+    header['offsets'] = {}
+    for name, array in (('keys', keys), ('row_counts', row_counts), ('counts', counts)):
+        header['offsets'][name] = offset
+        offset = align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    if len(header_bytes) > 4096:
+        raise ValueError('compiled lexicon header is too long: {0} bytes'.format(len(header_bytes)))
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(np.array([(magic, format_version, len(header_bytes))], dtype=header_struct).tobytes())
+        file.write(header_bytes)
+        for name, array in (('keys', keys), ('row_counts', row_counts), ('counts', counts)):
+            file.seek(header['offsets'][name])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(offset)
+    os.replace(temp_path, path)
+    return header['version']
+
+
+class compiled_lexicons:
+    """A compiled lexicon file, memory mapped. Raises ValueError for a file that isn't one, or was
+    written by another format version"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            start = np.frombuffer(file.read(header_struct.itemsize), dtype=header_struct)
+            if len(start) != 1 or start['magic'][0] != magic:
+                raise ValueError('{0} is not a compiled lexicon file'.format(path))
+            if start['format_version'][0] != format_version:
+                raise ValueError('{0} has format version {1}, expected {2}'.format(path, start['format_version'][0], format_version))
+            header = json.loads(file.read(int(start['header_length'][0])).decode('utf-8'))
+        self.version = header['version']
+        self.source = header['source']
+        self.source_digest = header.get('source_digest')
+        self.columns = [tuple(column) for column in header['columns']]
+        n = header['words']
+        offsets = header['offsets']
+        self.keys = np.memmap(path, dtype='S{0}'.format(header['key_width']), mode='r', offset=offsets['keys'], shape=(n,))
+        self.row_counts = np.memmap(path, dtype='<i4', mode='r', offset=offsets['row_counts'], shape=(n,))
+        self.counts = np.memmap(path, dtype='<i4', mode='r', offset=offsets['counts'], shape=(n, len(self.columns)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def words(self):
+        return [key.decode('utf-8') for key in self.keys.tolist()]
+
+    def lookup(self, words):
+        """Returns the row of each of a list of words, or -1 for words in none of the lexicons"""
+        if not words:
+            return np.zeros(0, dtype=np.int64)
+        encoded = [word.encode('utf-8') for word in words]
+        # longer words than the widest key can't match, and would be truncated to one that might
+        fits = np.array([len(word) <= self.keys.itemsize for word in encoded])
+        wanted = np.array(encoded, dtype=self.keys.dtype)
+        rows = np.minimum(np.searchsorted(self.keys, wanted), len(self.keys) - 1)
+        return np.where(fits & (self.keys[rows] == wanted), rows, -1)
+
+
+def lexicon_file():
+    return gr_config.LEXICON_FILE
+
+def compile_sources(path=None, data_dir=None):
+    """Compiles the lexicon source files. Returns the version written"""
+    path = path or lexicon_file()
+    lexicon_rows = read_sources(data_dir)
+    version = write_lexicons(path, *compile_lexicons(lexicon_rows), source='files', source_digest=rows_digest(lexicon_rows))
+    print('Compiled lexicons to {0}, version {1}'.format(path, version))
+    return version
+
+def database_lexicon_file(conn):
+    """The file that lexicons compiled from conn's lexicon tables are kept in, next to its database file,
+    or None for an in-memory database"""
+    db_file = conn.execute('PRAGMA database_list').fetchone()[2]
+    return db_file + '.lexicons.bin' if db_file else None
+
+def load_lexicons(conn=None, path=None):
+    """Memory maps the compiled lexicons. Without conn, a missing or unreadable file is compiled from the
+    source files, but an existing one is used as it is, as checking it would mean parsing the source files
+    every time. Run compile after they change. With conn, the file is only used if it was compiled from
+    the same rows as conn's lexicon tables (as loaded by books_db.build_db). Otherwise the tables are
+    compiled to database_lexicon_file, so the shared file is only ever written by build_db and compile"""
+    path = path or lexicon_file()
+    if conn is None:
+        try:
+            return compiled_lexicons(path)
+        except (OSError, ValueError):
+            compile_sources(path)
+            return compiled_lexicons(path)
+    lexicon_rows = read_tables(conn)
+    digest = rows_digest(lexicon_rows)
+    table_path = database_lexicon_file(conn)
+    for candidate in filter(None, [path, table_path]):
+        try:
+            lexicons = compiled_lexicons(candidate)
+            if lexicons.source_digest == digest:
+                return lexicons
+        except (OSError, ValueError):
+            pass
+    compiled = compile_lexicons(lexicon_rows)
+    if table_path is None:
+        # an in-memory database has nowhere to keep the file, the mapping outlives removing it
+        import tempfile
+        descriptor, temp_path = tempfile.mkstemp(suffix='.bin')
+        os.close(descriptor)
+        try:
+            write_lexicons(temp_path, *compiled, source='tables', source_digest=digest)
+            return compiled_lexicons(temp_path)
+        finally:
+            os.remove(temp_path)
+    version = write_lexicons(table_path, *compiled, source='tables', source_digest=digest)
+    print('Compiled lexicons to {0}, version {1}'.format(table_path, version))
+    return compiled_lexicons(table_path)
+
+def benchmark(repeat=5):
+    """Times parsing the source files, compiling them, and opening the compiled file"""
+    import tempfile
+    timings = []
+    time_start = time.perf_counter()
+    lexicon_rows = read_sources()
+    timings.append(('parse source files', time.perf_counter() - time_start))
+    time_start = time.perf_counter()
+    arrays = compile_lexicons(lexicon_rows)
+    timings.append(('compile', time.perf_counter() - time_start))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'lexicons.bin')
+        write_lexicons(path, *arrays)
+        best = None
+        for i in range(repeat):
+            time_start = time.perf_counter()
+            lexicons = compiled_lexicons(path)
+            lexicons.lookup(['good', 'bad', 'book'])
+            elapsed = time.perf_counter() - time_start
+            best = elapsed if best is None else min(best, elapsed)
+            del lexicons
+        timings.append(('open and look up, best of {0}'.format(repeat), best))
+        size = os.path.getsize(path)
+    print('{0} words, {1} score columns, {2:.1f} KB'.format(len(arrays[0]), len(arrays[3]), size / 1e3))
+    for name, elapsed in timings:
+        print('{0}: {1:.2f} ms'.format(name, elapsed * 1000))
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'compile'
+    if command == 'compile':
+        compile_sources(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif command == 'info':
+        lexicons = compiled_lexicons(sys.argv[2] if len(sys.argv) > 2 else lexicon_file())
+        print('{0}: version {1} from {2}, {3} words, {4} score columns'.format(lexicons.path, lexicons.version,
+            lexicons.source, len(lexicons), len(lexicons.columns)))
+    elif command == 'benchmark':
+        benchmark()
+    else:
+        print('Usage: gr_lexicon.py [compile [file] | info [file] | benchmark]')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+import argparse
+import bisect
+import collections
+import sys
+import time
+import numpy as np
+
+import books_db
+import gr_config
+import gr_features
+import gr_lexicon
+import gr_metrics
+
+# Single pass lexicon matching over raw review text. The four lexicons are compiled into one Aho-Corasick
+# automaton whose alphabet is words, as tokenize_batch splits them, so a review is tokenized in one C-level
+# pass and its words run through the automaton once, giving each review's joined row count and score
+# histogram with no vocabulary, word IDs or review_tokens in between. lexicon_stats turns those into the
+# review_stats columns, as in the stats stage.
+#
+# By default every lexicon entry is a single word, and the features are exactly those of the stats stage.
+# Three options change what is matched:
+#
+#   phrases          multi-word entries, like AFINN's "not good" or "can't stand", are matched too. Where
+#                    matches overlap the leftmost longest one is kept, so "not good" scores as itself
+#                    rather than as "good"
+#   negation_window  an entry with a negation word (not, never, didn't...) at most this many words before
+#                    it has its polarity flipped: AFINN scores change sign, and the other lexicons'
+#                    positive and negative swap
+#   inquirer_senses  Inquirer words keep the polarity of every sense, see gr_lexicon.read_inquirer, rather
+#                    than only the first. Needs the lexicon source files rather than the compiled file
+#
+# The automaton works on words rather than characters because lexicon entries only ever match whole
+# words, and a Python loop per word is far cheaper than one per character.
+
+# words that negate the entry after them, as well as any word ending in n't
+negation_words = frozenset(['not', 'no', 'never', 'none', 'nobody', 'nothing', 'neither', 'nor', 'nowhere', 'hardly',
+    'without', 'cannot', 'dont', 'doesnt', 'didnt', 'isnt', 'wasnt', 'cant', 'wont'])
+
+def is_negation(word):
+    return word in negation_words or word.endswith("n't")
+
+def negated_score(lexicon, score):
+    """AFINN scores change sign, and the other lexicons' 1 for positive and 0 for negative swap"""
+    return -score if lexicon == 0 else 1 - score
+
+
+class lexicon_matcher:
+    """Aho-Corasick automaton over the words of lexicon entries. words, row_counts, counts and columns
+    are the arrays of a compiled lexicon file (see gr_lexicon.compile_lexicons). Safe to share between
+    threads once built"""
+
+    def __init__(self, words, row_counts, counts, columns, phrases=False, negation_window=0, version=None):
+        self.phrases = phrases
+        self.negation_window = negation_window
+        self.version = version
+
+        entries = []
+        for k, word in enumerate(words):
+            parts = tuple(word.split(' '))
+            if (len(parts) == 1 or phrases) and '' not in parts:
+                entries.append((parts, k))
+        keys = np.array([k for parts, k in entries], dtype=np.int64)
+        self.lengths = np.array([len(parts) for parts, k in entries], dtype=np.int64)
+
+        # with negation, the columns also need every negated score, with scores kept ascending within each
+        # lexicon as lexicon_stats expects
+        columns = [tuple(column) for column in columns]
+        all_columns = set(columns)
+        if negation_window:
+            all_columns |= set((lexicon, negated_score(lexicon, score)) for lexicon, score in columns)
+        self.columns = sorted(all_columns)
+        column_index = dict((column, j) for j, column in enumerate(self.columns))
+        entry_counts = np.zeros((len(entries), len(self.columns)), dtype=np.int64)
+        entry_counts[:, [column_index[column] for column in columns]] = np.asarray(counts, dtype=np.int64)[keys]
+        # a matched entry adds its joined rows in place of the words it covers
+        entry_extra = np.asarray(row_counts, dtype=np.int64)[keys] - self.lengths
+        if negation_window:
+            negated = np.zeros_like(entry_counts)
+            for j, (lexicon, score) in enumerate(self.columns):
+                negated[:, column_index[(lexicon, negated_score(lexicon, score))]] += entry_counts[:, j]
+            # entry i negated is entry i + len(entries)
+            entry_counts = np.concatenate([entry_counts, negated])
+            entry_extra = np.concatenate([entry_extra, entry_extra])
+        self.entry_count = len(entries)
+        self.entry_counts = entry_counts
+        self.entry_extra = entry_extra
+
+        self.build([parts for parts, k in entries])
+
+    def build(self, entries):
+        """Builds the trie of entries' words, its failure links, and for each state the merged transitions
+        of its failure chain, so matching takes one dict lookup per word plus one at the root"""
+        goto = [{}]
+        own = [-1]
+        for e, parts in enumerate(entries):
+            state = 0
+            for part in parts:
+                next_state = goto[state].get(part)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto.append({})
+                    own.append(-1)
+                    goto[state][part] = next_state
+                state = next_state
+            own[state] = e
+
+        fail = [0] * len(goto)
+        outputs = [()] * len(goto)
+        delta = [{}] * len(goto)
+        queue = collections.deque(goto[0].values())
+        for state in queue:
+            outputs[state] = (own[state],) if own[state] >= 0 else ()
+        while queue:
+            state = queue.popleft()
+            for word, child in goto[state].items():
+                queue.append(child)
+                f = fail[state]
+                while f and word not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(word, 0) if state else 0
+                # outputs, longest first: the entry ending here, then those ending at the failure state
+                outputs[child] = ((own[child],) if own[child] >= 0 else ()) + outputs[fail[child]]
+            delta[state] = dict(delta[fail[state]], **goto[state]) if state else {}
+        self.root = goto[0]
+        self.outputs = outputs
+        self.delta = delta
+        # with no phrases, every state is a root child with a single output
+        self.word_entry = dict((word, outputs[state][0]) for word, state in self.root.items() if outputs[state])
+        self.deep = any(goto[state] for state in range(1, len(goto)))
+
+    @classmethod
+    def from_lexicons(cls, lexicons=None, **options):
+        """A matcher over the compiled lexicon file, by default the one at gr_config.LEXICON_FILE"""
+        lexicons = lexicons if lexicons is not None else gr_lexicon.load_lexicons()
+        return cls(lexicons.words(), lexicons.row_counts, lexicons.counts, lexicons.columns, version=lexicons.version, **options)
+
+    @classmethod
+    def from_sources(cls, data_dir=None, inquirer_senses=False, **options):
+        """A matcher compiled from the lexicon source files"""
+        keys, row_counts, counts, columns = gr_lexicon.compile_lexicons(gr_lexicon.read_sources(data_dir, inquirer_senses))
+        return cls([key.decode('utf-8') for key in keys.tolist()], row_counts, counts, columns,
+            version='sources' + ('+senses' if inquirer_senses else ''), **options)
+
+    def match(self, words):
+        """The entries found in a list of words, as indexes into the entry arrays, with a negated entry
+        offset by the number of entries"""
+        if not self.deep and not self.negation_window:
+            get = self.word_entry.get
+            return [e for e in map(get, words) if e is not None]
+
+        # (start, end, entry) of every match
+        hits = []
+        lengths = self.lengths
+        if self.deep:
+            root_get = self.root.get
+            delta = self.delta
+            outputs = self.outputs
+            state = 0
+            for end, word in enumerate(words):
+                next_state = delta[state].get(word) if state else None
+                state = next_state if next_state is not None else root_get(word, 0)
+                if state:
+                    for e in outputs[state]:
+                        hits.append((end - int(lengths[e]) + 1, end, e))
+            # keep the leftmost longest of overlapping matches
+            hits.sort(key=lambda hit: (hit[0], hit[0] - hit[1]))
+            kept = []
+            free = 0
+            for hit in hits:
+                if hit[0] >= free:
+                    kept.append(hit)
+                    free = hit[1] + 1
+            hits = kept
+        else:
+            get = self.word_entry.get
+            hits = [(i, i, e) for i, e in enumerate(map(get, words)) if e is not None]
+
+        if not self.negation_window:
+            return [e for start, end, e in hits]
+        negations = [i for i, word in enumerate(words) if is_negation(word)]
+        ret = []
+        for start, end, e in hits:
+            # the last negation word before the entry
+            i = bisect.bisect_left(negations, start)
+            if i and negations[i - 1] >= start - self.negation_window:
+                e += self.entry_count
+            ret.append(e)
+        return ret
+
+    def score_texts(self, texts):
+        """Tokenizes and matches a chunk of texts. Returns each text's number of words, cap_words_count,
+        exclamation_count and joined row count, and its histogram over self.columns, as arrays"""
+        time_start = time.perf_counter()
+        lengths = []
+        cap_counts = []
+        excl_counts = []
+        matches = []
+        review_index = []
+        for i, (words, cap_count, excl_count) in enumerate(gr_features.tokenize_batch(texts)):
+            lengths.append(len(words))
+            cap_counts.append(cap_count)
+            excl_counts.append(excl_count)
+            found = self.match(words)
+            matches += found
+            review_index += [i] * len(found)
+        lengths = np.array(lengths, dtype=np.int64)
+        matches = np.array(matches, dtype=np.int64)
+        review_index = np.array(review_index, dtype=np.int64)
+        word_counts = lengths + np.bincount(review_index, weights=self.entry_extra[matches],
+            minlength=len(lengths)).astype(np.int64)
+        histograms = np.zeros((len(lengths), len(self.columns)), dtype=np.int64)
+        np.add.at(histograms, review_index, self.entry_counts[matches])
+        gr_metrics.observe('match_seconds', time.perf_counter() - time_start)
+        return lengths, np.array(cap_counts), np.array(excl_counts), word_counts, histograms
+
+    def stats(self, word_counts, histograms):
+        return gr_features.lexicon_stats(self.columns, word_counts, histograms)
+
+    def review_stats_rows(self, reviews):
+        """review_stats rows straight from reviews given as (review_id, rating, review_text). As in the stats
+        stage, reviews with no text or fewer than 30 words get no row"""
+        if not reviews:
+            return []
+        lengths, cap_counts, excl_counts, word_counts, histograms = self.score_texts([row[2] for row in reviews])
+        scored = np.array([row[2] is not None for row in reviews]) & (lengths >= 30)
+        stats = self.stats(word_counts[scored], histograms[scored])
+        gr_metrics.inc('reviews_scored_total', int(scored.sum()))
+        return gr_features.stats_rows([(review_id, rating, cap_count, excl_count) for (review_id, rating, review_text),
+            cap_count, excl_count in zip([row for row, keep in zip(reviews, scored) if keep],
+            cap_counts[scored].tolist(), excl_counts[scored].tolist())], word_counts[scored], stats)
+
+def load_matcher(phrases=None, negation_window=None, inquirer_senses=None):
+    """A matcher with the options given, or those in gr_config"""
+    phrases = gr_config.MATCHER_PHRASES if phrases is None else phrases
+    negation_window = gr_config.MATCHER_NEGATION_WINDOW if negation_window is None else negation_window
+    inquirer_senses = gr_config.MATCHER_INQUIRER_SENSES if inquirer_senses is None else inquirer_senses
+    if inquirer_senses:
+        return lexicon_matcher.from_sources(inquirer_senses=True, phrases=phrases, negation_window=negation_window)
+    return lexicon_matcher.from_lexicons(phrases=phrases, negation_window=negation_window)
+
+
+def score_reviews(matcher, db_file=None, table='review_stats_matched', chunk_size=10000):
+    """Writes the review_stats rows of every review, matched from its text, to table, which is replaced.
+    Returns the number of rows written"""
+    conn = books_db.connect(db_file)
+    books_db.migrate(conn)
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS {0}'.format(table))
+        conn.execute(books_db.review_stats_tbl.replace('review_stats', table, 1))
+    read_conn = books_db.connect_like(conn)
+    cursor = read_conn.execute('SELECT review_id, rating, review_text FROM reviews')
+    writer = books_db.bulk_writer(conn, table, books_db.review_stats_columns)
+    time_start = time.perf_counter()
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        writer.add_many(matcher.review_stats_rows(chunk))
+        writer.flush()
+    elapsed = time.perf_counter() - time_start
+    read_conn.close()
+    conn.close()
+    print('Matched reviews in {0:.2f} seconds. {1}'.format(elapsed, writer.report()))
+    return writer.rows
+
+
+def synthetic_reviews(count, lexicons, seed=0):
+    """Synthetic (review_id, rating, review_text) rows with lexicon words, phrases and negations"""
+    import gr_benchmark
+    words = lexicons.words()
+    texts = gr_benchmark.review_texts(count, seed, lexicon_words=words + ['not', "didn't", 'never'] * 20)
+    return [(i, i % 6, text) for i, text in enumerate(texts)]
+
+def same_rows(a, b):
+    """Whether two lists of review_stats rows are equal, to rounding"""
+    if len(a) != len(b):
+        return False
+    for row_a, row_b in zip(a, b):
+        for x, y in zip(row_a, row_b):
+            if (x is None) != (y is None) or (x is not None and abs(x - y) > 1e-9 * max(1.0, abs(x))):
+                return False
+    return True
+
+def token_path_rows(lexicons, reviews):
+    """review_stats rows of reviews through the token path: tokenize, encode to word IDs, pack and unpack
+    the tokens as review_tokens stores them, and score"""
+    import gr_scoring
+    vocab = gr_scoring.lexicon_vocabulary(lexicons)
+    scorer = gr_features.lexicon_scorer(None, vocab, lexicons)
+    scored = []
+    for (review_id, rating, review_text), (words, cap_count, excl_count) in zip(reviews,
+            gr_features.tokenize_batch([row[2] for row in reviews])):
+        if review_text is not None and len(words) >= 30:
+            tokens = books_db.unpack_tokens(books_db.pack_tokens(vocab.encode(words)))
+            scored.append((review_id, rating, tokens, cap_count, excl_count))
+    return gr_features.review_stats_rows(scorer, scored)
+
+def check(count=20000):
+    """Checks that the default matcher gives the same review_stats rows as the token path, and counts the
+    rows the options change. Returns whether they matched"""
+    lexicons = gr_lexicon.load_lexicons()
+    reviews = synthetic_reviews(count, lexicons)
+    expected = token_path_rows(lexicons, reviews)
+    ok = same_rows(expected, lexicon_matcher.from_lexicons(lexicons).review_stats_rows(reviews))
+    print('default matcher: {0} rows, {1}'.format(len(expected), 'same as the token path' if ok else 'DIFFERENT from the token path'))
+    for name, matcher in [('phrases', lexicon_matcher.from_lexicons(lexicons, phrases=True)),
+            ('negation window 3', lexicon_matcher.from_lexicons(lexicons, negation_window=3)),
+            ('Inquirer senses', lexicon_matcher.from_sources(inquirer_senses=True))]:
+        rows = matcher.review_stats_rows(reviews)
+        changed = sum(not same_rows([a], [b]) for a, b in zip(expected, rows))
+        print('{0}: {1} of {2} rows changed'.format(name, changed, len(rows)))
+    return ok
+
+def benchmark(count=20000, repeat=3):
+    """Times review_stats rows from review text through the token path and through the matcher"""
+    lexicons = gr_lexicon.load_lexicons()
+    reviews = synthetic_reviews(count, lexicons)
+    runs = [('token path', lambda: token_path_rows(lexicons, reviews))]
+    for name, options in [('matcher', {}), ('matcher, phrases', {'phrases': True}),
+            ('matcher, phrases and negation window 3', {'phrases': True, 'negation_window': 3})]:
+        matcher = lexicon_matcher.from_lexicons(lexicons, **options)
+        runs.append((name, lambda matcher=matcher: matcher.review_stats_rows(reviews)))
+    results = []
+    for name, run in runs:
+        best = None
+        for i in range(repeat):
+            time_start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - time_start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, best))
+        print('{0}: {1} reviews in {2:.3f} seconds, {3:.0f} reviews/sec'.format(name, count, best, count / best))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Scores review text against the lexicons in a single pass')
+    subparsers = parser.add_subparsers(dest='command')
+    score = subparsers.add_parser('score', help='write the review_stats rows of every review, matched from its text, to a table')
+    score.add_argument('--table', default='review_stats_matched', help='table to write (default review_stats_matched)')
+    score.add_argument('--db', default=None, help='database file (default data/books.db)')
+    score.add_argument('--phrases', action='store_true', default=None, help='match multi-word entries')
+    score.add_argument('--negation-window', type=int, default=None, help='flip entries up to this many words after a negation')
+    score.add_argument('--senses', action='store_true', default=None, help='keep the polarity of every Inquirer sense')
+    check_parser = subparsers.add_parser('check', help='compare the matcher with the token path on synthetic reviews')
+    benchmark_parser = subparsers.add_parser('benchmark', help='time the matcher against the token path')
+    for subparser in (check_parser, benchmark_parser):
+        subparser.add_argument('count', nargs='?', type=int, default=20000, help='synthetic reviews')
+    args = parser.parse_args()
+
+    if args.command == 'score':
+        score_reviews(load_matcher(args.phrases, args.negation_window, args.senses), args.db, args.table)
+    elif args.command == 'check':
+        sys.exit(0 if check(args.count) else 1)
+    elif args.command == 'benchmark':
+        benchmark(args.count)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+
+import gr_config
+
+# Process-wide counters and histograms for the pipeline stages, recorded by the modules that do the work
+# and dumped as Prometheus text or JSON (see dump), e.g. by gr_pipeline after every stage:
+#
+#   pages_fetched_total{fetcher}       pages fetched, and fetch_bytes_total their size
+#   fetch_retries_total{fetcher}       retried requests, and fetch_failures_total requests given up on
+#   fetch_seconds{fetcher}             latency of each successful request
+#   parse_seconds{parser, page}        time to extract the fields of one page
+#   rows_written_total{table}          rows written by books_db.bulk_writer, and write_seconds{table} the
+#                                      time of each flush
+#   tokenize_seconds, score_seconds    time to tokenize and to score each chunk of reviews, and
+#                                      reviews_tokenized_total and reviews_scored_total their reviews
+#   random_books_total{result}         random book pages drawn by the harvester, new, seen or unreadable
+#   stage_seconds{stage}               time of each pipeline stage run
+#
+# Recording takes a lock and a dict update, so it is kept to per page and per chunk events. Worker
+# processes record into their own copy, which they hand back with collect for the parent to merge.
+
+# upper bounds of the histogram buckets, in seconds
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+lock = threading.Lock()
+# (name, labels) to a count, and to a histogram's [bucket counts, sum, count]. labels is a sorted tuple of
+# (label, value) pairs
+counters = {}
+histograms = {}
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, value=1, **labels):
+    """Adds value to a counter"""
+    key = (name, label_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """Records a value, usually seconds, in a histogram"""
+    key = (name, label_key(labels))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * len(default_buckets), 0.0, 0]
+        for i, bound in enumerate(default_buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+class timer:
+    """Records the time spent in a with block in a histogram"""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.time_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.time_start, **self.labels)
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+def snapshot():
+    """All metrics as a JSON serializable dict"""
+    with lock:
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(counters.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'buckets': list(default_buckets),
+                'counts': list(histogram[0]), 'sum': histogram[1], 'count': histogram[2]}
+                for (name, labels), histogram in sorted(histograms.items())],
+            }
+
+def collect():
+    """Returns the metrics recorded so far, as snapshot does, and starts again from zero. For worker
+    processes to pass their metrics to the parent's merge"""
+    ret = snapshot()
+    reset()
+    return ret
+
+def merge(data):
+    """Adds the metrics of a snapshot to this process's"""
+    with lock:
+        for counter in data['counters']:
+            key = (counter['name'], label_key(counter['labels']))
+            counters[key] = counters.get(key, 0) + counter['value']
+        for entry in data['histograms']:
+            key = (entry['name'], label_key(entry['labels']))
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = [[0] * len(default_buckets), 0.0, 0]
+            histogram[0] = [a + b for a, b in zip(histogram[0], entry['counts'])]
+            histogram[1] += entry['sum']
+            histogram[2] += entry['count']
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs) + '}'
+
+def prometheus_text(prefix='gr_'):
+    """All metrics in the Prometheus text exposition format, names prefixed with prefix"""
+    data = snapshot()
+    lines = []
+    typed = set()
+    for counter in data['counters']:
+        name = prefix + counter['name']
+        if name not in typed:
+            lines.append('# TYPE {0} counter'.format(name))
+            typed.add(name)
+        lines.append('{0}{1} {2}'.format(name, format_labels(label_key(counter['labels'])), counter['value']))
+    for entry in data['histograms']:
+        name = prefix + entry['name']
+        if name not in typed:
+            lines.append('# TYPE {0} histogram'.format(name))
+            typed.add(name)
+        labels = label_key(entry['labels'])
+        # bucket counts are cumulative in the exposition format
+        total = 0
+        for bound, count in zip(entry['buckets'], entry['counts']):
+            total += count
+            lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels, [('le', repr(bound))]), total))
+        lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels, [('le', '+Inf')]), entry['count']))
+        lines.append('{0}_sum{1} {2!r}'.format(name, format_labels(labels), entry['sum']))
+        lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), entry['count']))
+    return '\n'.join(lines) + '\n'
+
+def dump(path=None):
+    """Writes all metrics to path (default gr_config.METRICS_FILE), as JSON for a .json file and
+    Prometheus text otherwise, replacing the file in a single rename so a collector never reads half of
+    it. Returns the path"""
+    path = path or gr_config.METRICS_FILE
+    if path.endswith('.json'):
+        text = json.dumps(snapshot(), indent=2)
+    else:
+        text = prometheus_text()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as file:
+        file.write(text)
+    os.replace(path + '.tmp', path)
+    return path
@@ -0,0 +1,386 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+import books_db
+import gr_config
+import gr_scoring
+
+# Nearest neighbour index over the standardized review_stats features of the training reviews, for
+# KNN rating prediction without scikit-learn's fit-time copy and per-query cost growing with the
+# training set. An index directory holds:
+#
+#   manifest.json        columns, rows, nlist and build time
+#   mean.npy, scale.npy  the standardization of each feature column
+#   vectors.npy          the standardized training vectors, grouped by IVF list, and norms.npy their
+#                        squared lengths
+#   ratings.npy          the rating of each vector, and review_ids.npy its review
+#   centroids.npy        the IVF list centroids, and offsets.npy where each list starts in vectors
+#   kd_tree.joblib       scikit-learn KDTree and BallTree over vectors, for exact search
+#   ball_tree.joblib
+#
+# Every array is memory mapped when the index is loaded, so processes share the pages, and the trees
+# are memory mapped by joblib the first time they're used. Search methods:
+#
+#   kd_tree, ball_tree   exact, through the scikit-learn trees
+#   brute                exact, every vector compared with every query in blocks
+#   ivf                  approximate: each query is only compared with the vectors of the nprobe lists
+#                        whose k-means centroids are nearest to it
+#
+# A rating is predicted by a vote of the k nearest training reviews, ties going to the lower rating, as
+# KNeighborsClassifier does. Index and predict with the same lexicons the review_stats came from.
+
+index_format = 1
+search_methods = ['ivf', 'kd_tree', 'ball_tree', 'brute']
+tree_methods = ['kd_tree', 'ball_tree']
+
+def neighbors_dir():
+    return gr_config.NEIGHBORS_DIR
+
+def squared_distances(queries, query_norms, vectors, vector_norms):
+    return np.maximum(query_norms[:, None] - 2 * (queries @ vectors.T) + vector_norms[None, :], 0)
+
+def kmeans(vectors, nlist, iterations=10, sample=100000, seed=1):
+    """k-means centroids of vectors by Lloyd's algorithm, fitted on at most sample of them"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample, replace=False))]
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    norms = (vectors ** 2).sum(axis=1)
+    for i in range(iterations):
+        assignment = nearest_centroids(vectors, norms, centroids)
+        order = np.argsort(assignment, kind='stable')
+        sizes = np.bincount(assignment, minlength=nlist)
+        # an empty list keeps its centroid
+        filled = sizes > 0
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(vectors[order], starts, axis=0) / sizes[filled, None]
+    return centroids
+
+def nearest_centroids(vectors, norms, centroids, count=1, block=65536):
+    """Index of the nearest centroid of each vector, or with count > 1 of the count nearest, unordered"""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    ret = []
+    for start in range(0, len(vectors), block):
+        distances = squared_distances(vectors[start:start + block], norms[start:start + block], centroids, centroid_norms)
+        if count == 1:
+            ret.append(distances.argmin(axis=1))
+        else:
+            ret.append(np.argpartition(distances, count - 1, axis=1)[:, :count])
+    return np.concatenate(ret) if ret else np.zeros((0,) if count == 1 else (0, count), dtype=np.int64)
+
+def merge_nearest(best_distances, best_indices, distances, indices, k):
+    """Keeps the k smallest distances of each row of two (distances, indices) pairs"""
+    distances = np.concatenate([best_distances, distances], axis=1)
+    indices = np.concatenate([best_indices, indices], axis=1)
+    if distances.shape[1] > k:
+        keep = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, keep, axis=1)
+        indices = np.take_along_axis(indices, keep, axis=1)
+    return distances, indices
+
+def sort_nearest(distances, indices):
+    order = np.argsort(distances, axis=1, kind='stable')
+    return np.sqrt(np.take_along_axis(distances, order, axis=1)), np.take_along_axis(indices, order, axis=1)
+
+def vote(neighbor_ratings, valid=None):
+    """The most common rating of each row, the lowest of those tied"""
+    labels = np.arange(neighbor_ratings.max() + 1 if neighbor_ratings.size else 1)
+    counts = (neighbor_ratings[:, :, None] == labels[None, None, :])
+    if valid is not None:
+        counts &= valid[:, :, None]
+    return labels[counts.sum(axis=1).argmax(axis=1)]
+
+
+class neighbor_index:
+    """Standardized training vectors and their ratings, with the IVF lists and exact trees over them.
+    Build with build_index, or load a saved one with load_index"""
+
+    def __init__(self, arrays, manifest, path=None, k=None, method=None, nprobe=None):
+        self.mean = arrays['mean']
+        self.scale = arrays['scale']
+        self.vectors = arrays['vectors']
+        self.norms = arrays['norms']
+        self.ratings = arrays['ratings']
+        self.review_ids = arrays['review_ids']
+        self.centroids = arrays['centroids']
+        self.offsets = arrays['offsets']
+        self.manifest = manifest
+        self.path = path
+        self.k = k or gr_config.NEIGHBORS_K
+        self.method = method or gr_config.NEIGHBORS_METHOD
+        self.nprobe = nprobe or gr_config.NEIGHBORS_NPROBE
+        self.trees = {}
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def standardize(self, inputs):
+        return (np.asarray(inputs, dtype=np.float64) - self.mean) / self.scale
+
+    def tree(self, method):
+        """The KDTree or BallTree over the vectors, memory mapped from the index directory if it has one"""
+        tree = self.trees.get(method)
+        if tree is None:
+            import joblib
+            if self.path and os.path.exists(os.path.join(self.path, method + '.joblib')):
+                tree = joblib.load(os.path.join(self.path, method + '.joblib'), mmap_mode='r')
+            else:
+                from sklearn.neighbors import BallTree, KDTree
+                tree = (KDTree if method == 'kd_tree' else BallTree)(self.vectors)
+            self.trees[method] = tree
+        return tree
+
+    def search(self, queries, k=None, method=None, nprobe=None, block=1024):
+        """The distances and vector indexes of the k nearest vectors to each standardized query, nearest
+        first. IVF can find fewer than k, leaving index -1 at an infinite distance"""
+        k = min(k or self.k, len(self))
+        method = method or self.method
+        queries = np.ascontiguousarray(queries, dtype=np.float64)
+        if method in tree_methods:
+            return self.tree(method).query(queries, k=k)
+        search = self.search_ivf if method == 'ivf' else self.search_brute if method == 'brute' else None
+        if search is None:
+            raise ValueError('unknown search method {0}, choose from {1}'.format(method, ', '.join(search_methods)))
+        results = [search(queries[start:start + block], k, nprobe or self.nprobe) for start in range(0, len(queries), block)]
+        if not results:
+            return np.zeros((0, k)), np.zeros((0, k), dtype=np.int64)
+        return np.concatenate([d for d, i in results]), np.concatenate([i for d, i in results])
+
+    def search_brute(self, queries, k, nprobe=None, block=8192):
+        query_norms = (queries ** 2).sum(axis=1)
+        best_distances = np.full((len(queries), 0), np.inf)
+        best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), block):
+            distances = squared_distances(queries, query_norms, self.vectors[start:start + block], self.norms[start:start + block])
+            count = min(k, distances.shape[1])
+            nearest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+            best_distances, best_indices = merge_nearest(best_distances, best_indices,
+                np.take_along_axis(distances, nearest, axis=1), nearest + start, k)
+        return sort_nearest(best_distances, best_indices)
+
+    def search_ivf(self, queries, k, nprobe):
+        nlist = len(self.centroids)
+        nprobe = min(nprobe, nlist)
+        query_norms = (queries ** 2).sum(axis=1)
+        probes = nearest_centroids(queries, query_norms, self.centroids, nprobe).reshape(len(queries), nprobe)
+        best_distances = np.full((len(queries), k), np.inf)
+        best_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        # the queries probing each list, so each list is compared with all its queries at once
+        probed = probes.ravel()
+        order = np.argsort(probed, kind='stable')
+        probing = np.repeat(np.arange(len(queries)), nprobe)[order]
+        bounds = np.searchsorted(probed[order], np.arange(nlist + 1))
+        for l in range(nlist):
+            start, end = int(self.offsets[l]), int(self.offsets[l + 1])
+            if start == end or bounds[l] == bounds[l + 1]:
+                continue
+            rows = probing[bounds[l]:bounds[l + 1]]
+            distances = squared_distances(queries[rows], query_norms[rows], self.vectors[start:end], self.norms[start:end])
+            count = min(k, end - start)
+            nearest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+            best_distances[rows], best_indices[rows] = merge_nearest(best_distances[rows], best_indices[rows],
+                np.take_along_axis(distances, nearest, axis=1), nearest + start, k)
+        return sort_nearest(best_distances, best_indices)
+
+    def predict(self, inputs, k=None, method=None, nprobe=None):
+        """Predicts the rating of each row of review_stats feature values, in manifest['columns'] order"""
+        distances, indices = self.search(self.standardize(inputs), k, method, nprobe)
+        return vote(np.asarray(self.ratings)[np.maximum(indices, 0)], indices >= 0)
+
+    def save(self, path=None, trees=tree_methods):
+        """Writes the index to path (default gr_config.NEIGHBORS_DIR), with the trees of trees, replacing
+        any earlier index in a single rename"""
+        import joblib
+        path = path or neighbors_dir()
+        temp_path = path.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        for name in ('mean', 'scale', 'vectors', 'norms', 'ratings', 'review_ids', 'centroids', 'offsets'):
+            np.save(os.path.join(temp_path, name + '.npy'), np.asarray(getattr(self, name)))
+        for method in trees:
+            joblib.dump(self.tree(method), os.path.join(temp_path, method + '.joblib'))
+        manifest = dict(self.manifest, trees=list(trees))
+        with open(os.path.join(temp_path, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file, indent=2)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_path, path)
+        self.manifest = manifest
+        self.path = path
+        # the trees just written are the ones to map from now on
+        self.trees = {}
+        return path
+
+def build_index(inputs, ratings, review_ids, columns=None, nlist=None):
+    """Builds an index in memory from the review_stats feature values of training reviews. nlist is the
+    number of IVF lists, by default the square root of the number of reviews"""
+    inputs = np.asarray(inputs, dtype=np.float64)
+    if not len(inputs):
+        raise ValueError('no reviews to index')
+    nlist = min(nlist or max(1, int(np.sqrt(len(inputs)))), len(inputs))
+    mean = inputs.mean(axis=0)
+    scale = inputs.std(axis=0)
+    scale[scale == 0] = 1.0
+    vectors = (inputs - mean) / scale
+    centroids = kmeans(vectors, nlist)
+    assignment = nearest_centroids(vectors, (vectors ** 2).sum(axis=1), centroids)
+    # group the vectors by list, so each list is one slice
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.searchsorted(assignment[order], np.arange(nlist + 1))
+    vectors = np.ascontiguousarray(vectors[order])
+    arrays = {
+        'mean': mean,
+        'scale': scale,
+        'vectors': vectors,
+        'norms': (vectors ** 2).sum(axis=1),
+        'ratings': np.asarray(ratings, dtype=np.int64)[order],
+        'review_ids': np.asarray(review_ids, dtype=np.int64)[order],
+        'centroids': centroids,
+        'offsets': offsets.astype(np.int64),
+        }
+    manifest = {
+        'format': index_format,
+        'columns': list(columns or gr_scoring.feature_columns),
+        'rows': len(vectors),
+        'nlist': nlist,
+        'built_at': datetime.datetime.now().isoformat(),
+        }
+    return neighbor_index(arrays, manifest)
+
+def load_index(path=None, **options):
+    """Loads a saved index with its arrays memory mapped. options are neighbor_index's k, method and nprobe"""
+    path = path or neighbors_dir()
+    with open(os.path.join(path, 'manifest.json')) as file:
+        manifest = json.load(file)
+    if manifest.get('format') != index_format:
+        raise ValueError('{0} is not a neighbour index this version can read'.format(path))
+    arrays = dict((name[:-len('.npy')], np.load(os.path.join(path, name), mmap_mode='r'))
+        for name in os.listdir(path) if name.endswith('.npy'))
+    return neighbor_index(arrays, manifest, path, **options)
+
+def build(db_file=None, dataset=None, out_dir=None, nlist=None):
+    """Builds and saves the index of the training reviews gr_train.training_data gives"""
+    import gr_train
+    conn = books_db.connect(db_file)
+    inputs, ratings, review_ids = gr_train.training_data(conn, dataset, review_ids=True)
+    conn.close()
+    time_start = time.perf_counter()
+    index = build_index(inputs, ratings, review_ids, nlist=nlist)
+    build_time = time.perf_counter() - time_start
+    path = index.save(out_dir)
+    print('Indexed {0} reviews in {1} IVF lists in {2:.2f} seconds, saved with trees in {3:.2f} seconds to {4}'.format(
+        len(index), index.manifest['nlist'], build_time, time.perf_counter() - time_start - build_time, path))
+    return index
+
+def predict(index_dir=None, db_file=None, csv_file=None, k=None, method=None, nprobe=None):
+    """Predicts the rating of every review in review_stats from its neighbours, through gr_train.batch_predict"""
+    import gr_train
+    index = load_index(index_dir, k=k, method=method, nprobe=nprobe)
+    model = {
+        'model': index,
+        'columns': index.manifest['columns'],
+        'version': 'knn-{0}-{1}'.format(index.method, index.manifest['built_at'][:19].replace(':', '').replace('-', '')),
+        }
+    return gr_train.batch_predict(db_file=db_file, csv_file=csv_file, model=model)
+
+
+def synthetic_data(count, columns=len(gr_scoring.feature_columns), clusters=50, seed=1):
+    """Clustered feature vectors with a rating per cluster, for benchmarking without a database"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 3, (clusters, columns))
+    cluster = rng.integers(0, clusters, count)
+    inputs = centers[cluster] + rng.normal(0, 1, (count, columns))
+    ratings = np.where(rng.random(count) < 0.7, cluster % 5 + 1, rng.integers(1, 6, count))
+    return inputs, ratings, np.arange(count)
+
+def recall(found, exact):
+    """Share of the exact nearest neighbours found, over all queries"""
+    hits = sum(len(np.intersect1d(a[a >= 0], b)) for a, b in zip(found, exact))
+    return hits / exact.size if exact.size else 1.0
+
+def benchmark(db_file=None, dataset=None, synthetic=None, queries=2000, k=None, nprobes=(1, 2, 4, 8, 16, 32), repeat=3):
+    """Holds out queries training reviews (or synthetic vectors), indexes the rest, and reports the
+    queries per second, recall against brute force and agreement of predicted ratings with brute force,
+    of each search method"""
+    if synthetic:
+        inputs, ratings, review_ids = synthetic_data(synthetic)
+    else:
+        import gr_train
+        conn = books_db.connect(db_file)
+        inputs, ratings, review_ids = gr_train.training_data(conn, dataset, review_ids=True)
+        conn.close()
+    rng = np.random.default_rng(0)
+    held_out = np.zeros(len(inputs), dtype=bool)
+    held_out[rng.choice(len(inputs), min(queries, len(inputs) // 5), replace=False)] = True
+    time_start = time.perf_counter()
+    index = build_index(inputs[~held_out], ratings[~held_out], review_ids[~held_out])
+    print('{0} reviews indexed in {1} IVF lists in {2:.2f} seconds, {3} queries, k={4}'.format(len(index),
+        index.manifest['nlist'], time.perf_counter() - time_start, held_out.sum(), k or index.k))
+    for method in tree_methods:
+        time_start = time.perf_counter()
+        index.tree(method)
+        print('{0} built in {1:.2f} seconds'.format(method, time.perf_counter() - time_start))
+    query_vectors = index.standardize(inputs[held_out])
+
+    def timed(run):
+        best = None
+        for i in range(repeat):
+            time_start = time.perf_counter()
+            ret = run()
+            elapsed = time.perf_counter() - time_start
+            best = elapsed if best is None else min(best, elapsed)
+        return ret, best
+
+    (exact_distances, exact), brute_time = timed(lambda: index.search(query_vectors, k, 'brute'))
+    exact_predictions = vote(index.ratings[exact])
+    actual = ratings[held_out]
+    runs = [('brute', {}, 'brute')] + [(method, {}, method) for method in tree_methods] + [
+        ('ivf', {'nprobe': nprobe}, 'ivf nprobe={0}'.format(nprobe)) for nprobe in nprobes if nprobe <= index.manifest['nlist']]
+    print('{0:<16} {1:>12} {2:>8} {3:>10} {4:>9}'.format('method', 'queries/sec', 'recall', 'agreement', 'accuracy'))
+    results = []
+    for method, options, name in runs:
+        (distances, indices), elapsed = timed(lambda: index.search(query_vectors, k, method, **options))
+        predictions = vote(index.ratings[np.maximum(indices, 0)], indices >= 0)
+        result = {'method': name, 'qps': len(query_vectors) / elapsed, 'recall': recall(indices, exact),
+            'agreement': float((predictions == exact_predictions).mean()), 'accuracy': float((predictions == actual).mean())}
+        results.append(result)
+        print('{method:<16} {qps:>12,.0f} {recall:>8.4f} {agreement:>10.4f} {accuracy:>9.4f}'.format(**result))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Nearest neighbour index of the training reviews for KNN rating prediction')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help='index the training reviews of review_stats')
+    build_parser.add_argument('--nlist', type=int, default=None, help='IVF lists (default the square root of the reviews)')
+    predict_parser = subparsers.add_parser('predict', help='predict the rating of every review in review_stats')
+    predict_parser.add_argument('--csv', default=None, help='write predictions to this CSV file rather than review_predictions')
+    benchmark_parser = subparsers.add_parser('benchmark', help='recall and queries per second of each search method')
+    benchmark_parser.add_argument('--synthetic', type=int, default=None, help='benchmark on this many synthetic vectors instead')
+    benchmark_parser.add_argument('--queries', type=int, default=2000, help='held out queries')
+    for subparser in (predict_parser, benchmark_parser):
+        subparser.add_argument('--k', type=int, default=None, help='neighbours (default GR_NEIGHBORS_K)')
+    predict_parser.add_argument('--method', choices=search_methods, default=None, help='search method (default GR_NEIGHBORS_METHOD)')
+    predict_parser.add_argument('--nprobe', type=int, default=None, help='IVF lists searched (default GR_NEIGHBORS_NPROBE)')
+    for subparser in (build_parser, predict_parser, benchmark_parser):
+        subparser.add_argument('--db', default=None, help='database file (default data/books.db)')
+    for subparser in (build_parser, benchmark_parser):
+        subparser.add_argument('--dataset', default=None, help='read review_stats from this gr_export directory')
+    for subparser in (build_parser, predict_parser):
+        subparser.add_argument('--index', default=None, help='index directory (default GR_NEIGHBORS_DIR)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.db, args.dataset, args.index, args.nlist)
+    elif args.command == 'predict':
+        predict(args.index, args.db, args.csv, args.k, args.method, args.nprobe)
+    elif args.command == 'benchmark':
+        benchmark(args.db, args.dataset, args.synthetic, args.queries, args.k)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,586 @@
+import functools
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from urllib.parse import unquote
+
+import gr_config
+import gr_metrics
+
+# HTML extraction backends for Goodreads book, shelves and review pages. Every backend returns
+# the same plain dicts, so the scrapers don't care which one is in use. The backend is chosen
+# with gr_config.PARSER (GR_PARSER environment variable):
+#   bs4  - BeautifulSoup with html.parser, one select/find pass over the page per field
+#   lxml - lxml's C parser, collecting every field in a single walk over the document
+
+def rating_text_to_num(rating):
+    """convert the text rating of a book into a numerical 'star' rating"""
+    ret = int()
+    if rating == 'did not like it':
+        ret = 1
+    elif rating == 'it was ok':
+        ret = 2
+    elif rating == 'liked it':
+        ret = 3
+    elif rating == 'really liked it':
+        ret = 4
+    elif rating == 'it was amazing':
+        ret = 5
+    else:
+        ret = 0
+    return ret
+
+def clean_title(title):
+    """Strip out series identifiers in parentheses from a book title"""
+    return re.sub(r'(\(|\[)(.*)(\)|\])','', title).strip()
+
+def clean_book_id(book_id):
+    return re.sub('com.goodreads.https://book/show/', '', book_id).strip()
+
+def clean_pub_date(first_published, published):
+    """Converts the 'first published' text, or the 'published' text if there is no first published
+    date, to a YYYY-MM-DD string. Either argument may be None"""
+    if first_published is not None:
+        pub_date = re.sub('[()]|first published', '', first_published).strip()
+    elif published is not None:
+        pub_date = re.sub('Published|by[\s\S]*$', '', published).strip()
+    else:
+        return ''
+    # convert day from ordinal
+    try:
+        from dateutil.parser import parse
+        pub_date = parse(pub_date)
+        pub_date = datetime.strftime(pub_date, '%Y-%m-%d')
+        return pub_date
+    except (TypeError, ValueError):
+        return ''
+
+def clean_review_text(review_text):
+    """strip control characters from review text"""
+    return ''.join(c for c in review_text.strip() if ord(c) >= 32)
+
+def decode_reviews_page(html_source):
+    """review pages come back as javascript with unicode escaped HTML"""
+    return bytes(html_source, 'utf-8').decode('unicode-escape')
+
+# lookups used for the shelf counts on the shelves page, in the order they appear in the results
+shelf_patterns = {
+    'to-read': re.compile('.shelf=to-read$'),
+    'currently-reading': re.compile('.shelf=currently-reading$'),
+    'favorites': re.compile('.shelf=favorites$'),
+    }
+
+
+def timed_parse(page):
+    """Records the time of each call of a backend's parse method in gr_metrics"""
+    def decorate(method):
+        @functools.wraps(method)
+        def timed(self, html_source):
+            with gr_metrics.timer('parse_seconds', parser=self.name, page=page):
+                return method(self, html_source)
+        return timed
+    return decorate
+
+
+class bs4_backend:
+    """Extracts fields with BeautifulSoup and html.parser"""
+
+    name = 'bs4'
+
+    @timed_parse('book')
+    def parse_book_page(self, html_source):
+        """Gets the book fields from a Goodreads book page. Returns a dict"""
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html_source, 'html.parser')
+        return {
+            'id': self.__extract_book_id(soup),
+            'title': self.__extract_title(soup),
+            'orig_title': self.__extract_orig_title(soup),
+            'author': self.__extract_author(soup),
+            'published': self.__extract_pub_date(soup),
+            'language': self.__extract_book_language(soup),
+            'avg_rating': self.__extract_avg_rating(soup),
+            'ratings_count': self.__extract_ratings_count(soup),
+            'review_count': self.__extract_reviews_count(soup),
+            'genres': self.__extract_top_genres(soup),
+            }
+
+    @timed_parse('shelves')
+    def parse_shelves_page(self, html_source):
+        """Gets the shelf counts and the link to the next page of shelves. Shelves that aren't on
+        the page are returned as empty strings"""
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html_source, 'html.parser')
+        ret = {}
+        for shelf, pattern in shelf_patterns.items():
+            try:
+                count = soup.find('a', attrs={'rel':'nofollow', 'href':pattern}).get_text()
+                ret[shelf] = re.sub('[^\d]', '', count)
+            except AttributeError:
+                ret[shelf] = ''
+        try:
+            ret['next'] = soup.find('a', attrs={'rel':'next'}).get('href')
+        except AttributeError:
+            ret['next'] = None
+        return ret
+
+    @timed_parse('reviews')
+    def parse_reviews_page(self, html_source):
+        """Gets review IDs, dates, ratings and text from a review page. Returns a dict of lists"""
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(decode_reviews_page(html_source), 'html.parser').find('div', attrs={'id':'bookReviews'})
+        if soup is None:
+            raise ValueError('page has no reviews section')
+        return {
+            'review_id': self.__extract_review_ids(soup),
+            'review_date': self.__extract_review_dates(soup),
+            'rating': self.__extract_ratings(soup),
+            'review_text': self.__extract_review_text(soup),
+            }
+
+    def __extract_title(self, soup):
+        """Gets the book title from a Goodreads page BeautifulSoup object"""
+        try:
+            return clean_title((soup.select('#bookTitle'))[0].get_text())
+        except IndexError:
+            return ''
+
+    def __extract_orig_title(self, soup):
+        """gets the book original title from a Goodreads page BeautifulSoup object"""
+        try:
+            box_title = (soup.select('#bookDataBox > div:nth-of-type(1) > div.infoBoxRowTitle'))[0].get_text().strip()
+            if box_title == 'Original Title':
+                orig_title = (soup.select('#bookDataBox > div:nth-of-type(1) > div.infoBoxRowItem'))[0].get_text().strip()
+                return orig_title
+            else:
+                return ''
+        except IndexError:
+            return ''
+
+    def __extract_book_id(self, soup):
+        """Gets the Goodreads book ID from a Goodreads page BeautifulSoup object"""
+        try:
+            return clean_book_id(soup.find('meta', attrs={'property':'al:ios:url'}).get('content'))
+        except AttributeError:
+            return ''
+
+    def __extract_author(self, soup):
+        """Gets the book author from a Goodreads page BeautifulSoup object"""
+        try:
+            author = (soup.select('#bookAuthors > span:nth-of-type(2) > a > span'))[0].get_text()
+            return author.strip()
+        except IndexError:
+            return ''
+
+    def __extract_book_language(self, soup):
+        """Gets the book's language from a Goodreads page BeautifulSoup object"""
+        try:
+            databox = soup.select('#bookDataBox')
+            language = databox[0].find('div', attrs={'class':'infoBoxRowItem', 'itemprop':'inLanguage'}).get_text()
+            return language.strip()
+        except (IndexError, AttributeError):
+            return ''
+
+    def __extract_pub_date(self, soup):
+        """Gets the book's publication date from a Goodreads page BeautifulSoup object"""
+        # check for a First Published date and if none, use the Published date. This is for books
+        # with multiple editions.
+        first_published = soup.select('#details > div:nth-of-type(2) > nobr')
+        published = soup.select('#details > div:nth-of-type(2)')
+        return clean_pub_date(first_published[0].get_text() if first_published else None,
+            published[0].get_text() if published else None)
+
+    def __extract_avg_rating(self, soup):
+        """Gets the book's avearge review score from a Goodreads page BeautifulSoup object"""
+        try:
+            rating = (soup.select('#bookMeta > span.value.rating > span'))[0].get_text()
+            return rating.strip()
+        except IndexError:
+            return ''
+
+    def __extract_ratings_count(self, soup):
+        """Gets the number of reviews a book has from a Goodreads page BeautifulSoup object"""
+        try:
+            ratings_count = soup.find('span', attrs={'class':'votes value-title'}).get('title')
+            return ratings_count.strip()
+        except AttributeError:
+            return ''
+
+    def __extract_reviews_count(self, soup):
+        """Gets the number of reviews a book has from a Goodreads page BeautifulSoup object"""
+        try:
+            review_count = soup.find('span', attrs={'class':'count value-title'}).get('title')
+            return review_count.strip()
+        except AttributeError:
+            return ''
+
+    def __extract_top_genres(self, soup):
+        """Gets the top 3 genres for a book from a Goodreads page Beautiful soup object. Returns
+        a list. If there are less than three top genres, empty strings will be in the position
+        that no value is present"""
+        # create a list of 3 empty strings
+        ret = ['', '', '']
+        try:
+            right_container = soup.select('div.rightContainer')
+            top_genres = right_container[0].find_all('a', attrs={'class':'actionLinkLite bookPageGenreLink'}, limit=3)
+            for i in range(len(top_genres)):
+                ret[i] = top_genres[i].get_text()
+            return ret
+        except (IndexError, AttributeError):
+            return ret
+
+    def __extract_review_text(self, soup):
+        """Gets the review text from the input BeautifulSoup object. Return the reviews as a list"""
+        review_text_tags = soup.find_all('div', attrs={'class':'reviewText stacked'})
+        return [clean_review_text(tag.get_text()) for tag in review_text_tags]
+
+    def __extract_ratings(self, soup):
+        """Gets the review ratings from theinput BeautifulSoup objects. Extract the rating text and convert to a
+        numerical score. Returns a list"""
+        review_ratings = []
+        added_or_rated = soup.find_all('div', attrs={'class':'reviewHeader uitext stacked'})
+        for ar in added_or_rated:
+            if 'added it' in ar.get_text().strip():
+                rating = 0
+            elif 'rated it' in ar.get_text().strip():
+                rating_text = ar.find_next('span', attrs={'class':'staticStars'})
+                rating_text = rating_text.find_next('span').get_text()
+                rating = rating_text_to_num(rating_text)
+            else:
+                rating = 0
+            review_ratings.append(rating)
+        return review_ratings
+
+    def __extract_review_ids(self, soup):
+        """Gets the review IDs from the input BeautifulSoup object. Returns a list"""
+        id_tags = soup.find_all('div', attrs={'class':'review', 'itemprop':'reviews'})
+        return [int(re.sub('review_', '', tag.get('id'))) for tag in id_tags]
+
+    def __extract_review_dates(self, soup):
+        """Gets the review dates from the input BeautifulSoup object. Returns a list"""
+        date_tags = soup.find_all('a', attrs={'class':'reviewDate createdAt right'})
+        date_format = '%b %d, %Y'
+        return [datetime.strptime(tag.get_text(), date_format) for tag in date_tags]
+
+
+def has_class(element, name):
+    """matches class attributes the way BeautifulSoup does: a single name matches any of the
+    element's classes, a space separated list must match the whole attribute"""
+    classes = element.get('class')
+    if classes is None:
+        return False
+    if ' ' in name:
+        return ' '.join(classes.split()) == name
+    return name in classes.split()
+
+def nth_child_of_type(element, tag, n):
+    """the nth (1 based) child of element with the given tag, or None"""
+    for child in element:
+        if child.tag == tag:
+            n -= 1
+            if n == 0:
+                return child
+    return None
+
+def is_descendant(element, ancestor):
+    parent = element.getparent()
+    while parent is not None:
+        if parent is ancestor:
+            return True
+        parent = parent.getparent()
+    return False
+
+
+class lxml_backend:
+    """Extracts fields with lxml. Each page is parsed by the C parser and then walked once,
+    picking up every element of interest on the way instead of running a separate search per field"""
+
+    name = 'lxml'
+
+    def __init__(self):
+        import lxml.html
+        self.lxml_html = lxml.html
+        self.parser = lxml.html.HTMLParser(encoding='utf-8')
+
+    def __parse(self, html_source):
+        return self.lxml_html.fromstring(html_source.encode('utf-8'), parser=self.parser)
+
+    @timed_parse('book')
+    def parse_book_page(self, html_source):
+        """Gets the book fields from a Goodreads book page. Returns a dict"""
+        root = self.__parse(html_source)
+        found = {}
+        genre_links = []
+        for element in root.iter():
+            tag = element.tag
+            if not isinstance(tag, str):
+                # comments and processing instructions
+                continue
+            element_id = element.get('id')
+            if element_id is not None and element_id not in found:
+                found[element_id] = element
+            if tag == 'meta':
+                if element.get('property') == 'al:ios:url' and 'meta' not in found:
+                    found['meta'] = element
+            elif tag == 'span':
+                if 'votes' not in found and has_class(element, 'votes value-title'):
+                    found['votes'] = element
+                elif 'count' not in found and has_class(element, 'count value-title'):
+                    found['count'] = element
+            elif tag == 'div':
+                if 'rightContainer' not in found and has_class(element, 'rightContainer'):
+                    found['rightContainer'] = element
+            elif tag == 'a':
+                if has_class(element, 'actionLinkLite bookPageGenreLink'):
+                    genre_links.append(element)
+
+        ret = {
+            'id': '',
+            'title': '',
+            'orig_title': '',
+            'author': '',
+            'published': '',
+            'language': '',
+            'avg_rating': '',
+            'ratings_count': '',
+            'review_count': '',
+            'genres': ['', '', ''],
+            }
+
+        if 'meta' in found and found['meta'].get('content') is not None:
+            ret['id'] = clean_book_id(found['meta'].get('content'))
+        if 'bookTitle' in found:
+            ret['title'] = clean_title(found['bookTitle'].text_content())
+
+        databox = found.get('bookDataBox')
+        if databox is not None:
+            first_row = nth_child_of_type(databox, 'div', 1)
+            if first_row is not None:
+                row_title = [c for c in first_row if c.tag == 'div' and has_class(c, 'infoBoxRowTitle')]
+                if row_title and row_title[0].text_content().strip() == 'Original Title':
+                    row_item = [c for c in first_row if c.tag == 'div' and has_class(c, 'infoBoxRowItem')]
+                    if row_item:
+                        ret['orig_title'] = row_item[0].text_content().strip()
+            for element in databox.iterdescendants('div'):
+                if element.get('itemprop') == 'inLanguage' and has_class(element, 'infoBoxRowItem'):
+                    ret['language'] = element.text_content().strip()
+                    break
+
+        authors = found.get('bookAuthors')
+        if authors is not None:
+            span = nth_child_of_type(authors, 'span', 2)
+            if span is not None:
+                names = [s for a in span if a.tag == 'a' for s in a if s.tag == 'span']
+                if names:
+                    ret['author'] = names[0].text_content().strip()
+
+        details = found.get('details')
+        if details is not None:
+            row = nth_child_of_type(details, 'div', 2)
+            if row is not None:
+                nobr = [c for c in row if c.tag == 'nobr']
+                ret['published'] = clean_pub_date(nobr[0].text_content() if nobr else None, row.text_content())
+
+        meta = found.get('bookMeta')
+        if meta is not None:
+            rating = [s for c in meta if c.tag == 'span' and has_class(c, 'value') and has_class(c, 'rating')
+                for s in c if s.tag == 'span']
+            if rating:
+                ret['avg_rating'] = rating[0].text_content().strip()
+
+        if 'votes' in found and found['votes'].get('title') is not None:
+            ret['ratings_count'] = found['votes'].get('title').strip()
+        if 'count' in found and found['count'].get('title') is not None:
+            ret['review_count'] = found['count'].get('title').strip()
+
+        if 'rightContainer' in found:
+            genres = [a for a in genre_links if is_descendant(a, found['rightContainer'])][:3]
+            for i in range(len(genres)):
+                ret['genres'][i] = genres[i].text_content()
+
+        return ret
+
+    @timed_parse('shelves')
+    def parse_shelves_page(self, html_source):
+        """Gets the shelf counts and the link to the next page of shelves. Shelves that aren't on
+        the page are returned as empty strings"""
+        root = self.__parse(html_source)
+        ret = {shelf: None for shelf in shelf_patterns}
+        ret['next'] = None
+        for element in root.iter('a'):
+            rel = (element.get('rel') or '').split()
+            href = element.get('href')
+            if 'nofollow' in rel and href is not None:
+                for shelf, pattern in shelf_patterns.items():
+                    if ret[shelf] is None and pattern.search(href):
+                        ret[shelf] = re.sub('[^\d]', '', element.text_content())
+            if 'next' in rel and ret['next'] is None:
+                ret['next'] = href
+        for shelf in shelf_patterns:
+            if ret[shelf] is None:
+                ret[shelf] = ''
+        return ret
+
+    @timed_parse('reviews')
+    def parse_reviews_page(self, html_source):
+        """Gets review IDs, dates, ratings and text from a review page. Returns a dict of lists"""
+        root = self.__parse(decode_reviews_page(html_source))
+        container = None
+        for element in root.iter('div'):
+            if element.get('id') == 'bookReviews':
+                container = element
+                break
+        if container is None:
+            raise ValueError('page has no reviews section')
+
+        ret = {'review_id': [], 'review_date': [], 'rating': [], 'review_text': []}
+        # 'rated it' headers waiting for the next staticStars span, and headers whose stars span
+        # was found and now wait for the span after it, which holds the rating text
+        waiting_for_stars = []
+        waiting_for_rating = []
+        date_format = '%b %d, %Y'
+        for element in container.iter():
+            tag = element.tag
+            if tag == 'div':
+                if has_class(element, 'reviewHeader uitext stacked'):
+                    header_text = element.text_content().strip()
+                    ret['rating'].append(0)
+                    if 'added it' not in header_text and 'rated it' in header_text:
+                        waiting_for_stars.append(len(ret['rating']) - 1)
+                elif has_class(element, 'reviewText stacked'):
+                    ret['review_text'].append(clean_review_text(element.text_content()))
+                if element.get('itemprop') == 'reviews' and has_class(element, 'review'):
+                    ret['review_id'].append(int(re.sub('review_', '', element.get('id'))))
+            elif tag == 'span':
+                if waiting_for_rating:
+                    rating = rating_text_to_num(element.text_content())
+                    for i in waiting_for_rating:
+                        ret['rating'][i] = rating
+                    waiting_for_rating = []
+                if waiting_for_stars and has_class(element, 'staticStars'):
+                    waiting_for_rating = waiting_for_stars
+                    waiting_for_stars = []
+            elif tag == 'a':
+                if has_class(element, 'reviewDate createdAt right'):
+                    ret['review_date'].append(datetime.strptime(element.text_content(), date_format))
+
+        if waiting_for_stars or waiting_for_rating:
+            raise AttributeError('rating text not found for a rated review')
+        return ret
+
+
+backends = {
+    'bs4': bs4_backend,
+    'lxml': lxml_backend,
+    }
+
+# parser instances, created on first use
+parsers = {}
+
+def get_parser(name=None):
+    """Returns the parser backend with the given name, or the one set in gr_config"""
+    name = name or gr_config.PARSER
+    if name not in parsers:
+        if name not in backends:
+            raise ValueError('Unknown parser backend {0}. Must be one of {1}'.format(name, ', '.join(backends)))
+        parsers[name] = backends[name]()
+    return parsers[name]
+
+def page_type(path):
+    """page type of a fixture, from its request path"""
+    if path.startswith('/book/reviews/'):
+        return 'reviews'
+    elif path.startswith('/book/shelves/'):
+        return 'shelves'
+    return 'book'
+
+def load_fixtures(fixture_dir):
+    """Reads the saved pages in fixture_dir, named as by gr_stub_server. Returns a list of
+    (page type, path, html) tuples. Without a fixture_dir, synthetic pages are used instead"""
+    if not os.path.isdir(fixture_dir):
+        return synthetic_fixtures()
+    fixtures = []
+    for file_name in sorted(os.listdir(fixture_dir)):
+        if not file_name.endswith('.html'):
+            continue
+        path = unquote(file_name[:-len('.html')])
+        with open(os.path.join(fixture_dir, file_name), encoding='utf-8') as file:
+            fixtures.append((page_type(path), path, file.read()))
+    return fixtures
+
+def synthetic_fixtures(count=60):
+    """count each of gr_benchmark's synthetic book, shelves and review pages, as load_fixtures returns them"""
+    import gr_benchmark
+    paths = {'book': '/book/show/{0}', 'shelves': '/book/shelves/{0}', 'reviews': '/book/reviews/{0}?page=1'}
+    return [(kind, paths[kind].format(i), html_source) for kind, pages in gr_benchmark.synthetic_pages(count).items()
+        for i, html_source in enumerate(pages, 1)]
+
+def parse_page(parser, kind, html_source):
+    if kind == 'reviews':
+        return parser.parse_reviews_page(html_source)
+    elif kind == 'shelves':
+        return parser.parse_shelves_page(html_source)
+    return parser.parse_book_page(html_source)
+
+def compare_backends(fixture_dir, reference='bs4'):
+    """Parses every fixture with each backend and returns a list of (backend, path) for pages
+    where a backend's output differs from the reference backend"""
+    mismatches = []
+    for kind, path, html_source in load_fixtures(fixture_dir):
+        try:
+            expected = parse_page(get_parser(reference), kind, html_source)
+        except Exception as e:
+            expected = type(e)
+        for name in backends:
+            if name == reference:
+                continue
+            try:
+                result = parse_page(get_parser(name), kind, html_source)
+            except Exception as e:
+                result = type(e)
+            if result != expected:
+                mismatches.append((name, path))
+    return mismatches
+
+def benchmark_backends(fixture_dir, repeat=3):
+    """Parses the fixture corpus repeat times with each backend. Returns a dict of pages parsed
+    per second, by backend and page type"""
+    fixtures = load_fixtures(fixture_dir)
+    results = {}
+    for name in backends:
+        parser = get_parser(name)
+        results[name] = {}
+        for kind in ('book', 'shelves', 'reviews'):
+            pages = [html_source for k, path, html_source in fixtures if k == kind]
+            if not pages:
+                continue
+            time_start = time.perf_counter()
+            for i in range(repeat):
+                for html_source in pages:
+                    try:
+                        parse_page(parser, kind, html_source)
+                    except (ValueError, AttributeError):
+                        pass
+            elapsed = time.perf_counter() - time_start
+            results[name][kind] = len(pages) * repeat / elapsed
+    return results
+
+def main():
+    dir = os.path.dirname(__file__)
+    fixture_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(dir, 'data/fixtures')
+    if not os.path.isdir(fixture_dir):
+        print('No fixtures in {0}, comparing on synthetic pages'.format(fixture_dir))
+    mismatches = compare_backends(fixture_dir)
+    for name, path in mismatches:
+        print('{0} output differs from bs4 for {1}'.format(name, path))
+    print('{0} mismatched pages'.format(len(mismatches)))
+    for name, rates in benchmark_backends(fixture_dir).items():
+        for kind, rate in rates.items():
+            print('{0:<6} {1:<8} {2:8.1f} pages/sec'.format(name, kind, rate))
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+import argparse
+import datetime
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import books_db
+import gr_metrics
+
+# Runs the pipeline's stages in order, keeping each stage's status, time and progress in books.db, so an
+# interrupted run can be resumed from the stage it stopped in rather than from the start:
+#
+#   build_db     create the tables and load and compile the lexicons
+#   book_info    get the info of new random books from Goodreads into book_info
+#   clean_books  filter and dedupe book_info into book_info_clean
+#   reviews      get the reviews of every book in book_info_clean without any yet
+#   features     tokenize and score the new reviews into review_stats
+#
+# Stages pick up where they left off on their own: reviews only fetches books with no reviews saved,
+# features only processes reviews changed since its last run, and book_info's checkpoint holds the
+# number of books it had at the start, so a resumed run only gets the ones still missing. With overlap
+# on, features runs alongside reviews, processing what has been saved every interval seconds, and once
+# more after reviews finishes. With stream on, reviews scores each batch of reviews as it's fetched
+# instead (see gr_reviews.stream_reviews), and features only has what was left over to process.
+#
+# The metrics the stages record (see gr_metrics) are written to gr_config.METRICS_FILE after every stage,
+# and with a profiler set, each stage runs under it, writing <run>-<stage>-<attempt>.* to
+# gr_config.PROFILE_DIR (see gr_profile).
+
+stage_names = ['build_db', 'book_info', 'clean_books', 'reviews', 'features']
+
+# subcommands that run their stages on their own. Each stage imports only the modules it needs when it
+# runs, so a command doesn't pay for loading the scrapers, pandas or the parsers unless it uses them
+stage_commands = {
+    'build-db': ['build_db'],
+    'scrape-books': ['book_info', 'clean_books'],
+    'scrape-reviews': ['reviews'],
+    'features': ['features'],
+    }
+
+# stages that can run alongside the stage before them
+overlapping_stages = {'features': 'reviews'}
+
+def count_rows(conn, table):
+    return conn.execute('SELECT COUNT(*) FROM {0}'.format(table)).fetchone()[0] if books_db.table_exists(conn, table) else 0
+
+def stage_items(conn, stage):
+    """A running count of what a stage has produced, to report its throughput from"""
+    if stage == 'build_db':
+        return sum(count_rows(conn, table) for table in ('afinn_lexicon', 'bing_lexicon', 'mpqa_lexicon', 'inquirer_lexicon'))
+    elif stage == 'book_info':
+        return count_rows(conn, 'book_info')
+    elif stage == 'clean_books':
+        return count_rows(conn, 'book_info_clean')
+    elif stage == 'reviews':
+        return count_rows(conn, 'reviews')
+    elif stage == 'features':
+        if not books_db.table_exists(conn, 'processing_state'):
+            return 0
+        row = conn.execute("SELECT reviews_processed FROM processing_state WHERE stage = 'stats'").fetchone()
+        return row[0] if row else 0
+    raise ValueError('unknown stage {0}'.format(stage))
+
+stage_units = {'build_db': 'lexicon entries', 'book_info': 'books', 'clean_books': 'books', 'reviews': 'reviews',
+    'features': 'reviews'}
+
+def run_stage_function(stage, args, checkpoint, items):
+    """Runs one pass of a stage. checkpoint is the stage's saved progress and items its current count"""
+    if stage == 'build_db':
+        books_db.build_db()
+    elif stage == 'book_info':
+        import gr_book_info
+        # only the books still missing from the target, counting from the rows there were at the start
+        remaining = args['books'] - (items - checkpoint['start_items'])
+        if remaining > 0:
+            gr_book_info.harvest_book_info(remaining)
+    elif stage == 'clean_books':
+        import gr_book_info
+        gr_book_info.clean_book_info()
+    elif stage == 'reviews':
+        import gr_reviews
+        if args.get('stream'):
+            gr_reviews.stream_reviews()
+        else:
+            gr_reviews.get_reviews()
+    elif stage == 'features':
+        import gr_features
+        gr_features.extract_features()
+    else:
+        raise ValueError('unknown stage {0}'.format(stage))
+
+
+def create_tables(conn):
+    with conn:
+        conn.execute(books_db.pipeline_runs_tbl)
+        conn.execute(books_db.pipeline_stages_tbl)
+
+def start_run(conn, args):
+    with conn:
+        cursor = conn.execute('''INSERT INTO pipeline_runs (args, status, started_at) VALUES (?, 'running', datetime('now'))''',
+            (json.dumps(args),))
+        conn.executemany('''INSERT INTO pipeline_stages (run_id, stage, status, attempts, seconds) VALUES (?, ?, 'pending', 0, 0)''',
+            [(cursor.lastrowid, stage) for stage in args['stages']])
+    return cursor.lastrowid
+
+def last_unfinished_run(conn):
+    """The latest run that didn't finish, as (run_id, args), or None"""
+    row = conn.execute("SELECT run_id, args FROM pipeline_runs WHERE status != 'done' ORDER BY run_id DESC LIMIT 1").fetchone()
+    return (row[0], json.loads(row[1])) if row else None
+
+def stage_state(conn, run_id, stage):
+    """A stage's (status, attempts, seconds, checkpoint dict)"""
+    status, attempts, seconds, checkpoint = conn.execute('''SELECT status, attempts, seconds, checkpoint FROM pipeline_stages
+        WHERE run_id = ? AND stage = ?''', (run_id, stage)).fetchone()
+    return status, attempts, seconds, json.loads(checkpoint) if checkpoint else {}
+
+def run_stage(run_id, stage, args, repeat=None, profile=None, metrics_file=None):
+    """Runs a stage with its own connection and records the outcome. repeat is an overlapped stage's
+    loop, a function taking the stage's single pass and running it until the stage before it is done.
+    profile is a gr_profile profiler to run the stage under. Metrics are written to metrics_file
+    (default gr_config.METRICS_FILE) afterwards"""
+    conn = books_db.connect()
+    status, attempts, seconds, checkpoint = stage_state(conn, run_id, stage)
+    if 'start_items' not in checkpoint:
+        checkpoint['start_items'] = stage_items(conn, stage)
+    with conn:
+        conn.execute('''UPDATE pipeline_stages SET status = 'running', attempts = attempts + 1, checkpoint = ?, error = NULL,
+            started_at = IFNULL(started_at, datetime('now')) WHERE run_id = ? AND stage = ?''',
+            (json.dumps(checkpoint), run_id, stage))
+    print('{0}: started at {1}{2}'.format(stage, datetime.datetime.now(), ', resuming' if attempts else ''))
+
+    def run_once():
+        run_stage_function(stage, args, checkpoint, stage_items(conn, stage))
+
+    def run_all():
+        if repeat:
+            repeat(run_once)
+        else:
+            run_once()
+
+    time_start = time.perf_counter()
+    status, error = 'done', None
+    try:
+        if profile:
+            import gr_profile
+            gr_profile.profile_call(run_all, '{0}-{1}-{2}'.format(run_id, stage, attempts + 1), profile)
+        else:
+            run_all()
+    except BaseException as e:
+        status, error = 'failed', '{0}: {1}'.format(type(e).__name__, e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - time_start
+        with conn:
+            conn.execute('''UPDATE pipeline_stages SET status = ?, seconds = seconds + ?, items = ?, error = ?,
+                finished_at = datetime('now') WHERE run_id = ? AND stage = ?''',
+                (status, elapsed, stage_items(conn, stage) - checkpoint['start_items'], error, run_id, stage))
+        conn.close()
+        gr_metrics.observe('stage_seconds', elapsed, stage=stage)
+        gr_metrics.dump(metrics_file)
+        print('{0}: {1} in {2:.2f} seconds'.format(stage, status, elapsed))
+
+def run_overlapped(run_id, first, second, args, interval, profile=None, metrics_file=None):
+    """Runs second in a thread alongside first, a pass every interval seconds while first is running and
+    a last one after it's done. If first fails, second stops and is left to run again on resume"""
+    first_done = threading.Event()
+    first_ok = []
+    errors = []
+
+    def repeat(run_once):
+        while not first_done.wait(interval):
+            run_once()
+        if not first_ok:
+            raise RuntimeError('stopped after {0} failed'.format(first))
+        run_once()
+
+    def run_second():
+        try:
+            run_stage(run_id, second, args, repeat, profile, metrics_file)
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run_second)
+    thread.start()
+    try:
+        run_stage(run_id, first, args, profile=profile, metrics_file=metrics_file)
+        first_ok.append(True)
+    finally:
+        first_done.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def run_pipeline(stages=None, book_count=100000, resume=False, overlap=True, interval=60, stream=False, profile=None,
+        metrics_file=None):
+    """Runs stages (default all) in order as a new run, or with resume, carries on with the last run that
+    didn't finish, skipping the stages it completed. profile and metrics_file are passed on to run_stage.
+    Returns the run ID"""
+    conn = books_db.connect()
+    create_tables(conn)
+    unfinished = last_unfinished_run(conn) if resume else None
+    if unfinished:
+        run_id, args = unfinished
+        print('Resuming run {0}: {1}'.format(run_id, ', '.join(args['stages'])))
+    else:
+        stages = [stage for stage in stage_names if stage in (stages or stage_names)]
+        args = {'stages': stages, 'books': book_count, 'stream': stream}
+        run_id = start_run(conn, args)
+        print('Starting run {0}: {1}'.format(run_id, ', '.join(stages)))
+    todo = [stage for stage in args['stages'] if stage_state(conn, run_id, stage)[0] != 'done']
+
+    status = 'failed'
+    try:
+        i = 0
+        while i < len(todo):
+            stage = todo[i]
+            following = todo[i + 1] if i + 1 < len(todo) else None
+            if overlap and not args.get('stream') and overlapping_stages.get(following) == stage:
+                run_overlapped(run_id, stage, following, args, interval, profile, metrics_file)
+                i += 2
+            else:
+                run_stage(run_id, stage, args, profile=profile, metrics_file=metrics_file)
+                i += 1
+        status = 'done'
+    finally:
+        with conn:
+            conn.execute('''UPDATE pipeline_runs SET status = ?, finished_at = datetime('now') WHERE run_id = ?''',
+                (status, run_id))
+        write_report(conn, run_id)
+        conn.close()
+    return run_id
+
+
+def run_report(conn, run_id):
+    """A dict of the run and the time, items and items/sec of each of its stages"""
+    args, status, started_at, finished_at = conn.execute('''SELECT args, status, started_at, finished_at FROM pipeline_runs
+        WHERE run_id = ?''', (run_id,)).fetchone()
+    stages = []
+    for row in conn.execute('''SELECT stage, status, attempts, seconds, items, error, started_at, finished_at
+            FROM pipeline_stages WHERE run_id = ?''', (run_id,)):
+        stage = dict(zip(['stage', 'status', 'attempts', 'seconds', 'items', 'error', 'started_at', 'finished_at'], row))
+        stage['unit'] = stage_units[stage['stage']]
+        stage['items_per_sec'] = stage['items'] / stage['seconds'] if stage['items'] and stage['seconds'] > 0 else 0.0
+        stages.append(stage)
+    stages.sort(key=lambda stage: stage_names.index(stage['stage']))
+    return {'run_id': run_id, 'args': json.loads(args), 'status': status, 'started_at': started_at,
+        'finished_at': finished_at, 'stages': stages}
+
+def format_report(report):
+    lines = ['Run {0}: {1}, started {2}, finished {3}'.format(report['run_id'], report['status'], report['started_at'],
+        report['finished_at'] or '-')]
+    lines.append('{0:<12} {1:<8} {2:>8} {3:>11} {4:>10} {5:>10}  {6}'.format('stage', 'status', 'attempts', 'seconds', 'items',
+        'items/sec', 'unit'))
+    for stage in report['stages']:
+        lines.append('{0:<12} {1:<8} {2:>8} {3:>11.2f} {4:>10} {5:>10.1f}  {6}'.format(stage['stage'], stage['status'],
+            stage['attempts'], stage['seconds'], stage['items'] if stage['items'] is not None else '-',
+            stage['items_per_sec'], stage['unit']))
+        if stage['error']:
+            lines.append('    {0}'.format(stage['error']))
+    return '\n'.join(lines)
+
+def report_file(conn):
+    return os.path.join(os.path.dirname(os.path.abspath(books_db.database_file(conn))), 'pipeline_report.json')
+
+def write_report(conn, run_id):
+    """Prints a run's report and writes it to data/pipeline_report.json"""
+    report = run_report(conn, run_id)
+    print(format_report(report))
+    path = report_file(conn)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(report, file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the Goodreads pipeline stages with checkpoints in books.db')
+    subparsers = parser.add_subparsers(dest='command')
+    run = subparsers.add_parser('run', help='run the stages, or carry on with the last unfinished run')
+    run.add_argument('stages', nargs='*', help='stages to run, of {0} (default all)'.format(', '.join(stage_names)))
+    run.add_argument('--resume', action='store_true', help='resume the last run that didn\'t finish, with its stages and arguments')
+    run.add_argument('--books', type=int, default=100000, help='random books to get info for')
+    run.add_argument('--no-overlap', dest='overlap', action='store_false', help='run every stage on its own, in order')
+    run.add_argument('--interval', type=float, default=60, help='seconds between feature passes while reviews are fetched')
+    run.add_argument('--stream', action='store_true', help='score reviews as they are fetched, see gr_reviews.stream_reviews')
+    status = subparsers.add_parser('status', help='show the report of a run')
+    status.add_argument('run_id', nargs='?', type=int, default=None, help='run ID (default the latest)')
+    build_db = subparsers.add_parser('build-db', help='create the tables and load and compile the lexicons')
+    scrape_books = subparsers.add_parser('scrape-books', help='get info for random books and clean it up')
+    scrape_books.add_argument('books', nargs='?', type=int, default=100000, help='random books to get info for')
+    scrape_reviews = subparsers.add_parser('scrape-reviews', help='get the reviews of the books without any yet')
+    scrape_reviews.add_argument('--stream', action='store_true', help='score reviews as they are fetched')
+    features = subparsers.add_parser('features', help='tokenize and score the new reviews')
+    for subparser in (run, build_db, scrape_books, scrape_reviews, features):
+        subparser.add_argument('--profile', choices=['cprofile', 'sample'], default=None,
+            help='run each stage under a profiler, writing its output to GR_PROFILE_DIR')
+        subparser.add_argument('--metrics', default=None, help='metrics file, .json for JSON (default GR_METRICS_FILE)')
+    score = subparsers.add_parser('score', help='print the features and predicted rating of texts as JSON')
+    score.add_argument('texts', nargs='*', help='review texts (default lines of stdin)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'score':
+        import gr_scoring
+        texts = args.texts or [line.rstrip('\n') for line in sys.stdin]
+        for result in gr_scoring.review_scorer().score(texts):
+            print(json.dumps(result))
+    elif args.command == 'status':
+        conn = books_db.connect()
+        create_tables(conn)
+        run_id = args.run_id or conn.execute('SELECT MAX(run_id) FROM pipeline_runs').fetchone()[0]
+        print(format_report(run_report(conn, run_id)) if run_id else 'No pipeline runs')
+        conn.close()
+    else:
+        # a terminated run still records how far its stages got
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        for stage in getattr(args, 'stages', None) or []:
+            if stage not in stage_names:
+                parser.error('unknown stage {0}, choose from {1}'.format(stage, ', '.join(stage_names)))
+        if args.command in stage_commands:
+            args.stages = stage_commands[args.command]
+            args.overlap = False
+        # with no command, run every stage as __main__ always has
+        run_pipeline(getattr(args, 'stages', None), getattr(args, 'books', 100000), getattr(args, 'resume', False),
+            getattr(args, 'overlap', True), getattr(args, 'interval', 60), getattr(args, 'stream', False),
+            getattr(args, 'profile', None), getattr(args, 'metrics', None))
+
+if __name__ == '__main__':
+    main()
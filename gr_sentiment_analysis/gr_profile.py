@@ -0,0 +1,117 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+import gr_config
+
+# Profiling of a pipeline stage, for finding hot paths in real runs without changing any code (see
+# gr_pipeline's --profile). Two profilers:
+#
+#   cprofile  deterministic, with every call counted and timed. Writes <name>.prof, readable with pstats
+#             or snakeviz, and <name>.txt, the top functions by cumulative time. Only covers the
+#             thread the stage runs in
+#   sample    a thread that records the stack of the stage's thread, and of threads it starts, every
+#             interval seconds. Much lower overhead. Writes <name>.folded, the stacks in the collapsed
+#             format flamegraph.pl and speedscope read, and <name>.txt, the top functions by samples
+
+profilers = ['cprofile', 'sample']
+
+def profile_dir():
+    return gr_config.PROFILE_DIR
+
+class sampling_profiler:
+    """Samples the stacks of a thread, by default the one creating the profiler, and of every thread
+    started after the profiler"""
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.ignored = set(sys._current_frames()) - {self.thread_id}
+        self.thread = threading.Thread(target=self.run, name='sampling profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        self.ignored.add(threading.get_ident())
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in self.ignored:
+                    self.stacks[frame_stack(frame)] += 1
+            self.samples += 1
+
+    def folded(self):
+        """The stacks as 'root;...;leaf count' lines"""
+        return ''.join('{0} {1}\n'.format(';'.join(stack), count) for stack, count in self.stacks.most_common())
+
+    def summary(self, top=40):
+        """The functions with the most samples at the top of the stack, i.e. running their own code, with
+        their samples anywhere in the stack"""
+        total = collections.Counter()
+        own = collections.Counter()
+        for stack, count in self.stacks.items():
+            for function in set(stack):
+                total[function] += count
+            own[stack[-1]] += count
+        lines = ['{0} samples every {1:.3f} seconds, {2} stacks'.format(self.samples, self.interval, sum(self.stacks.values())),
+            '{0:>8} {1:>8}  function'.format('own', 'total')]
+        for function, count in own.most_common(top):
+            lines.append('{0:>8} {1:>8}  {2}'.format(count, total[function], function))
+        return '\n'.join(lines) + '\n'
+
+def frame_stack(frame):
+    """A frame's stack as a tuple of 'function (file:line)', outermost first"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+def profile_call(function, name, profiler='cprofile', out_dir=None, interval=0.005):
+    """Calls function under profiler, writing its output to out_dir (default gr_config.PROFILE_DIR) as
+    name.* even if function raises. Returns what function returns"""
+    out_dir = out_dir or profile_dir()
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, name)
+    time_start = time.perf_counter()
+    if profiler == 'cprofile':
+        import cProfile
+        import io
+        import pstats
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function)
+        finally:
+            profile.dump_stats(path + '.prof')
+            text = io.StringIO()
+            pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(40)
+            write_text(path + '.txt', text.getvalue())
+            print('Profile of {0} written to {1}.prof'.format(name, path))
+    elif profiler == 'sample':
+        sampler = sampling_profiler(interval)
+        sampler.start()
+        try:
+            return function()
+        finally:
+            sampler.stop()
+            write_text(path + '.folded', sampler.folded())
+            write_text(path + '.txt', sampler.summary())
+            print('{0} samples of {1} over {2:.1f} seconds written to {3}.folded'.format(sampler.samples, name,
+                time.perf_counter() - time_start, path))
+    else:
+        raise ValueError('unknown profiler {0}, choose from {1}'.format(profiler, ', '.join(profilers)))
+
+def write_text(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
@@ -1,49 +1,56 @@
 import pandas as pd
-import requests
-import re
 import os
-import sqlite3
+import queue
+import re
+import sys
+import threading
 from datetime import datetime
-from bs4 import BeautifulSoup
 
 import time
+import books_db
+import gr_config
+import gr_cache
+import gr_features
+import gr_fetch
+import gr_parsers
+from gr_async_fetch import async_fetcher
 from gr_book_info import gr_book_info
 
 class gr_reviews:
 
     reviews = pd.DataFrame()
 
-    def __init__(self, id, count):
-        self.__get_reviews(id, count)
+    def __init__(self, id, count, pages=None, parser=None):
+        """Gets up to count reviews for the book id. pages can hold the already fetched HTML of the
+        review pages, otherwise they are requested from Goodreads one at a time. parser is the name
+        of the gr_parsers backend to use, defaulting to the one in gr_config"""
+        self.parser = gr_parsers.get_parser(parser)
+        self.__get_reviews(id, count, pages)
         self.reviews.reset_index()
         # add the book ID
         self.reviews['book_id'] = id
         # reorder columns
         self.reviews = self.reviews[['review_id', 'book_id', 'review_date', 'rating', 'review_text']]
 
-    def __get_reviews(self, id, count):
+    def __get_reviews(self, id, count, pages):
         """Gets reviews for a given book id"""
-        pages_to_parse = count // 30 + 1 if count % 30 != 0 else count // 30 
-        for i in range(1, int(pages_to_parse + 1)):
-            url = 'https://www.goodreads.com/book/reviews/{0}?page={1}&sort=default&text_only=true'.format(str(id), str(i))
-            soup = self.__get_html_source(url)
-
-            # extract the review IDs 
-            review_ids = self.__extract_review_ids(soup)
-            # extract the review dates
-            review_dates = self.__extract_review_dates(soup)
-            # extract ratings
-            ratings = self.__extract_ratings(soup)
-            # extract the review text
-            review_text = self.__extract_review_text(soup)
+        if pages is None:
+            pages = (self.__get_html_source(url) for url in review_page_urls(id, count))
+
+        for html_source in pages:
+            if html_source is None:
+                raise ValueError('review page could not be retrieved')
+
+            # extract the review IDs, dates, ratings and text
+            page = self.parser.parse_reviews_page(html_source)
             
             # create a DataFrame
             try:
                 page_df = pd.DataFrame({
-                    'review_id':review_ids,
-                    'review_date':review_dates,
-                    'rating':ratings,
-                    'review_text':review_text
+                    'review_id':page['review_id'],
+                    'review_date':page['review_date'],
+                    'rating':page['rating'],
+                    'review_text':page['review_text']
                     })
 
                 # append to reviews DataFrame
@@ -55,134 +62,241 @@ class gr_reviews:
                 with open(fail_file, 'a') as file:
                     file.write('{0}\n'.format(str(id)))
 
-    def __get_html_source(self, url, retries=0):
-        """gets HTML page from URL and returns a BeautifulSoup object"""
-        try:
-            html_source = requests.get(url).text
-            # decode unicode escape characters
-            html_source = bytes(html_source, 'utf-8').decode('unicode-escape')
-            soup = BeautifulSoup(html_source, 'html.parser').find('div', attrs={'id':'bookReviews'})
-            return soup
-        except ConnectionError:
-            # retry up to 3 times
-            if retries <= 3:
-                retry = retries + 1
-                time.sleep(5)
-                self.__get_html_source(url, retries = retry)
-            else:
-                raise
-
-    def __extract_review_text(self, soup):
-        """Gets the review text from the input BeautifulSoup object. Return the reviews as a list"""
-        review_text_tags = soup.find_all('div', attrs={'class':'reviewText stacked'})
-        review_text = [''.join(c for c in tag.get_text().strip() if ord(c) >= 32) for tag in review_text_tags]
-        return review_text
-
-    def __extract_ratings(self, soup):
-        """Gets the review ratings from theinput BeautifulSoup objects. Extract the rating text and convert to a
-        numerical score. Returns a list"""
-        try:
-            review_ratings = []
-            added_or_rated = soup.find_all('div', attrs={'class':'reviewHeader uitext stacked'})
-            for ar in added_or_rated:
-                if 'added it' in ar.get_text().strip():
-                    rating = 0
-                elif 'rated it' in ar.get_text().strip():
-                    rating_text = ar.find_next('span', attrs={'class':' staticStars'})
-                    rating_text = rating_text.find_next('span').get_text()
-                    rating = self.__rating_text_to_num(rating_text)
-                else:
-                    rating = 0
-                review_ratings.append(rating)
-
-            return review_ratings
-        except:
-            raise
-
-    def __extract_review_ids(self, soup):
-        """Gets the review IDs from the input BeautifulSoup object. Returns a list"""
-        try:
-            id_tags = soup.find_all('div', attrs={'class':'review', 'itemprop':'reviews'})
-            review_ids = [int(re.sub('review_', '', tag.get('id'))) for tag in id_tags]
-            return review_ids
-        except:
-            raise
-
-    def __extract_review_dates(self, soup):
-        """Gets the review dates from the input BeautifulSoup object. Returns a list"""
-        try:
-            date_tags = soup.find_all('a', attrs={'class':'reviewDate createdAt right'})
-            date_format = '%b %d, %Y'
-            review_dates = [datetime.strptime(tag.get_text(), date_format) for tag in date_tags]
-            return review_dates
-        except:
-            raise
-
-    def __rating_text_to_num(self, rating):
-        """convert the text rating of a book into a numerical 'star' rating"""
-        ret = int()
-        if rating == 'did not like it':
-            ret = 1
-        elif rating == 'it was ok':
-            ret = 2
-        elif rating == 'liked it':
-            ret = 3
-        elif rating == 'really liked it':
-            ret = 4
-        elif rating == 'it was amazing':
-            ret = 5
-        else:
-            ret = 0
-        return ret
+    def __get_html_source(self, url):
+        """gets HTML page from URL and returns the page text"""
+        return gr_fetch.get_html(url)
 
 
+def review_page_urls(id, count):
+    """Builds the URLs of the review pages needed to get count reviews for a book. Goodreads
+    shows 30 reviews per page"""
+    pages_to_parse = count // 30 + 1 if count % 30 != 0 else count // 30 
+    return ['{0}/book/reviews/{1}?page={2}&sort=default&text_only=true'.format(gr_config.BASE_URL, str(id), str(i))
+        for i in range(1, int(pages_to_parse + 1))]
+
 def get_info(id):
     book_info = gr_book_info(id)
     return book_info.info
 
-def get_reviews():
+# books in book_info_clean with no reviews saved yet. Both lookups on reviews use the reviews_book_id index
+books_without_reviews_sql = '''SELECT id, title, review_count FROM book_info_clean 
+    WHERE id > (SELECT IFNULL(MAX(book_id), 0) FROM reviews)
+    AND id NOT IN (SELECT book_id FROM reviews)'''
+
+review_columns = ['review_id', 'book_id', 'review_date', 'rating', 'review_text']
+
+def review_batches(fetcher, books, books_per_batch):
+    """Fetches the reviews of books, given as (id, title, review_count) rows, books_per_batch books at a
+    time, all of a batch's pages at once. Yields a list with a DataFrame of reviews per book in the batch"""
+    dir = os.path.dirname(__file__)
+    for batch_start in range(0, len(books), books_per_batch):
+        batch = books[batch_start:batch_start + books_per_batch]
+
+        # select the min of 300 or review count for each book, then fetch every page of the batch at once
+        counts = []
+        urls = []
+        for book_id, book_title, review_count in batch:
+            min_val = min([float(review_count), 300])
+            print('Getting {0} reviews for book {1}:{2}. Start time: {3}'.format(int(min_val), book_id, book_title, datetime.now()))
+            counts.append(min_val)
+            urls.append(review_page_urls(book_id, min_val))
+        pages = fetcher.fetch([url for book_urls in urls for url in book_urls])
+
+        frames = []
+        page_start = 0
+        for (book_id, book_title, review_count), min_val, book_urls in zip(batch, counts, urls):
+            book_pages = pages[page_start:page_start + len(book_urls)]
+            page_start += len(book_urls)
+            try:
+                frames.append(gr_reviews(book_id, min_val, book_pages).reviews)
+            except Exception as e:
+                print('Failed to load book info for book ID {0}: {1}'.format(book_id, e))
+                fail_file = os.path.join(dir, 'data/failed.txt')
+                with open(fail_file, 'a') as file:
+                    file.write('{0}\n'.format(str(book_id)))
+        yield frames
+        print(fetcher.report())
+
+def get_reviews(concurrency=None, rate_limit=None, books_per_batch=None, db_file=None):
+    """Gets reviews for all books in book_info_clean that don't have reviews yet. Review pages for
+    books_per_batch books are fetched concurrently, with at most concurrency requests in flight
+    and rate_limit requests per second to Goodreads. Defaults come from gr_config, and db_file
+    defaults to data/books.db. In replay mode every cached review page is parsed again instead, see
+    replay_reviews"""
+    if gr_config.REPLAY:
+        replay_reviews(db_file)
+        return
     time_start = time.time()
+    books_per_batch = books_per_batch or gr_config.BOOKS_PER_BATCH
+    fetcher = async_fetcher(concurrency, rate_limit)
 
     # set up database connection
-    dir = os.path.dirname(__file__)
-    db_file = os.path.join(dir, 'data/books.db')
-    conn = sqlite3.connect(db_file)
+    conn = books_db.connect(db_file)
+    books_db.migrate(conn)
+    writer = books_db.bulk_writer(conn, 'reviews', review_columns)
 
     # load book data from DB 
     #book_info_df = pd.read_csv('./data/book_info_clean.tsv', sep='\t', encoding='utf-8')
-    sql = '''SELECT id, title, review_count FROM book_info_clean 
-        WHERE id > (SELECT IFNULL(MAX(book_id), 0) FROM reviews)
-        AND id NOT IN (SELECT book_id FROM reviews)'''
+    books = conn.execute(books_without_reviews_sql).fetchall()
+
+    for frames in review_batches(fetcher, books, books_per_batch):
+        for frame in frames:
+            writer.add_frame(frame)
+        # commit each batch as a whole, so a restart picks up after the last complete batch
+        writer.flush()
+
+    print(writer.report())
+    time_end = time.time()
+    print('Finished getting reviews at {0}. Completed in {1} seconds'.format(datetime.now(), time_end - time_start))
 
-    books = conn.execute(sql)
+review_page_re = re.compile(r'/book/reviews/(\d+)')
 
-    for row in books:
+def replay_reviews(db_file=None, pages_per_batch=1000):
+    """Parses every cached review page again, e.g. after a parser fix, and rewrites its reviews,
+    including those of books that already have reviews. The rewritten reviews are logged as changed,
+    so the next extract_features run redoes their features. Returns the number of reviews written"""
+    time_start = time.perf_counter()
+    conn = books_db.connect(db_file)
+    books_db.migrate(conn)
+    writer = books_db.bulk_writer(conn, 'reviews', review_columns, replace=True)
+    pages = failed = 0
+    # pages are oldest first, so a page fetched more than once ends up with its latest reviews
+    for url, fetched_at, html_source in gr_cache.get_cache().pages(['%/book/reviews/%']):
+        match = review_page_re.search(url)
+        if match is None:
+            continue
         try:
-            book_id = row[0]
-            review_count = row[2]
-            book_title = row[1]
-            # select the min of 300 or review count
-            min_val = min([float(review_count), 300])
-            
-            print('Getting {0} reviews for book {1}:{2}. Start time: {3}'.format(int(min_val), book_id, book_title, datetime.now()))
-    
-            review_data = gr_reviews(book_id, min_val)
-            review_data.reviews.to_sql(con=conn, name='reviews', index=False, if_exists='append')
-            #with open(file_path, 'a', encoding='utf-8') as file:
-            #    review_data.reviews.to_csv(file, sep='\t', encoding='utf-8', index=False, header=False)
+            frame = gr_reviews(int(match.group(1)), 30, [html_source]).reviews
+        except Exception as e:
+            print('Failed to parse cached page {0}: {1}'.format(url, e))
+            failed += 1
+            continue
+        writer.add_frame(frame)
+        pages += 1
+        if pages % pages_per_batch == 0:
+            writer.flush()
+    writer.flush()
+    conn.close()
+    print(writer.report())
+    print('Replayed {0} cached review pages, {1} failed, in {2:.2f} seconds'.format(pages, failed,
+        time.perf_counter() - time_start))
+    return writer.rows
+
 
+# Streaming mode. A producer thread fetches and parses the review pages a batch of books at a time and
+# puts each batch on a bounded queue, and the main thread takes them off, tokenizes and scores them
+# in memory (see gr_features.review_rows) and writes the reviews together with their review_tokens,
+# review_features and review_stats rows. Fetching waits on the network and scoring on the CPU, so the
+# two overlap, and once the queue is full the producer waits for the scorer, which keeps at most
+# queue_batches batches in memory.
+#
+# The feature stages' watermarks are moved past the streamed reviews' changes as they're written, as
+# long as the stages were caught up, so extract_features doesn't process them again. This assumes
+# nothing else adds reviews during the stream; if something does, its reviews and the streamed ones are
+# simply processed again by the next extract_features run.
+
+def write_scored_batch(conn, writers, vocab, scorer, rows):
+    """Writes a batch of reviews, as tuples in review_columns order, with their features"""
+    tokens_rows, features_rows, stats_rows = gr_features.review_rows(vocab, scorer,
+        [(review_id, rating, review_text) for review_id, book_id, review_date, rating, review_text in rows])
+    before = books_db.last_review_change(conn)
+    # new words first, then the reviews, so the stages' rows never refer to anything missing
+    vocab.flush()
+    reviews_writer, tokens_writer, features_writer, stats_writer = writers
+    reviews_writer.add_many(rows)
+    reviews_writer.flush()
+    for writer, batch_rows in zip((tokens_writer, features_writer, stats_writer), (tokens_rows, features_rows, stats_rows)):
+        writer.add_many(batch_rows)
+        writer.flush()
+    after = books_db.last_review_change(conn)
+    for stage in ('words', 'features', 'stats'):
+        if books_db.stage_watermark(conn, stage) == before:
+            books_db.set_stage_watermark(conn, stage, after, len(rows))
+
+def stream_reviews(concurrency=None, rate_limit=None, books_per_batch=None, queue_batches=None):
+    """Gets reviews for the books without any, like get_reviews, and scores each batch as soon as it's
+    fetched, writing the reviews and their features together. queue_batches is the most fetched batches
+    waiting to be scored, default gr_config.STREAM_QUEUE_BATCHES. Returns the number of reviews written.
+    In replay mode the cached review pages are replayed instead, leaving the features to extract_features"""
+    if gr_config.REPLAY:
+        return replay_reviews()
+    time_start = time.perf_counter()
+    books_per_batch = books_per_batch or gr_config.BOOKS_PER_BATCH
+    queue_batches = queue_batches or gr_config.STREAM_QUEUE_BATCHES
+    fetcher = async_fetcher(concurrency, rate_limit)
+
+    conn = books_db.connect()
+    books_db.migrate(conn)
+    books = conn.execute(books_without_reviews_sql).fetchall()
+    pending = [stage for stage in ('words', 'features', 'stats')
+        if books_db.stage_watermark(conn, stage) != books_db.last_review_change(conn)]
+    if pending:
+        print('Stages {0} have reviews left to process, run extract_features after streaming'.format(', '.join(pending)))
+    conn.execute(books_db.review_stats_tbl)
+    vocab = books_db.vocabulary(conn)
+    scorer = gr_features.lexicon_scorer(conn, vocab)
+    vocab.flush()
+    writers = (books_db.bulk_writer(conn, 'reviews', review_columns),
+        books_db.bulk_writer(conn, 'review_tokens', ['review_id', 'token_ids'], replace=True),
+        books_db.bulk_writer(conn, 'review_features', ['review_id', 'cap_words_count', 'exclamation_count'], replace=True),
+        books_db.bulk_writer(conn, 'review_stats', books_db.review_stats_columns, replace=True))
+
+    batches = queue.Queue(maxsize=queue_batches)
+    producer_errors = []
+    # seconds the producer spent waiting for space in the queue, and the scorer waiting for a batch
+    producer_wait = [0.0]
+    consumer_wait = 0.0
+    max_depth = 0
+
+    def produce():
+        try:
+            for frames in review_batches(fetcher, books, books_per_batch):
+                wait_start = time.perf_counter()
+                batches.put(frames)
+                producer_wait[0] += time.perf_counter() - wait_start
         except Exception as e:
-            print('Failed to load book info for book ID {0}: {1}'.format(book_id, e))
-            dir = os.path.dirname(__file__)
-            fail_file = os.path.join(dir, 'data/failed.txt')
-            with open(fail_file, 'a') as file:
-                file.write('{0}\n'.format(str(book_id)))
+            producer_errors.append(e)
+        finally:
+            batches.put(None)
 
-    time_end = time.time()
-    print('Finished getting reviews at {0}. Completed in {1} seconds'.format(datetime.now(), time_end - time_start))
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    reviews = 0
+    time_scoring = 0.0
+    while True:
+        wait_start = time.perf_counter()
+        max_depth = max(max_depth, batches.qsize())
+        frames = batches.get()
+        consumer_wait += time.perf_counter() - wait_start
+        if frames is None:
+            break
+        rows = [tuple(books_db.to_sql_value(v) for v in row) for frame in frames
+            for row in frame[review_columns].itertuples(index=False, name=None)]
+        scoring_start = time.perf_counter()
+        write_scored_batch(conn, writers, vocab, scorer, rows)
+        time_scoring += time.perf_counter() - scoring_start
+        reviews += len(rows)
+    producer.join()
+    conn.close()
+    if producer_errors:
+        raise producer_errors[0]
+
+    elapsed = time.perf_counter() - time_start
+    for writer in writers:
+        print(writer.report())
+    print('Streamed {0} reviews of {1} books in {2:.2f} seconds, {3:.1f} reviews/sec end to end'.format(
+        reviews, len(books), elapsed, reviews / elapsed if elapsed > 0 else 0.0))
+    print('Scoring and writing {0:.2f} seconds, waiting for pages {1:.2f} seconds. Fetching blocked on a full queue '
+        'for {2:.2f} seconds, deepest queue {3} of {4} batches'.format(time_scoring, consumer_wait, producer_wait[0],
+        max_depth, queue_batches))
+    return reviews
 
 def main():
-    get_reviews()
+    # gr_reviews.py [stream] fetches the reviews, scoring them as they come in with stream
+    if sys.argv[1:2] == ['stream']:
+        stream_reviews()
+    else:
+        get_reviews()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
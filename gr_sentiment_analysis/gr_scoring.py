@@ -0,0 +1,243 @@
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+import books_db
+import gr_config
+import gr_features
+import gr_lexicon
+import gr_matcher
+
+# Online scoring: computes the review_stats features of raw review text as it arrives, without books.db,
+# and predicts the rating with a persisted model. The lexicons are loaded once, memory mapped, and the
+# lexicons are matched in a single pass over the text, see gr_matcher, which gives the same features a
+# text gets in review_stats.
+#
+# The HTTP service takes POST /score with {"text": "..."} or {"texts": ["...", ...]} and returns
+# {"results": [...], "lexicon_version": ..., "model_version": ...}, with a result per text holding its
+# features and predicted_rating, or null for a text with no words.
+
+# review_stats columns computed from the text, i.e. all but review_id and rating
+feature_columns = books_db.review_stats_columns[2:]
+
+
+class lexicon_vocabulary:
+    """Stands in for books_db.vocabulary when there is no database: numbers the lexicon words from 1 in the
+    compiled file's order. Every other word gets the unused ID 0, which scores as a non-lexicon word"""
+
+    def __init__(self, lexicons):
+        self.ids = dict((word, i) for i, word in enumerate(lexicons.words(), 1))
+
+    def word_id(self, word):
+        return self.ids[word]
+
+    def encode(self, words):
+        get = self.ids.get
+        return np.array([get(word, 0) for word in words], dtype=np.int64)
+
+
+def load_model(path=None):
+    """Loads a pickled rating model, a dict with the fitted model, the feature columns it takes in order,
+    and its version. Returns None if there's no model file"""
+    path = path or gr_config.MODEL_FILE
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def model_inputs(features, columns):
+    """Builds a model's input matrix from review_stats rows given as dicts or a DataFrame. The models are
+    trained on reviews with words in every lexicon, so missing values, which the rest can have, are 0"""
+    if hasattr(features, 'columns'):
+        values = features[columns].to_numpy(dtype=np.float64, na_value=np.nan)
+    else:
+        values = np.array([[row[column] for column in columns] for row in features], dtype=np.float64)
+    return np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+class review_scorer:
+    """Scores review texts against the compiled lexicons and predicts their ratings with model, by default
+    the one at gr_config.MODEL_FILE if there is one. Safe to share between threads"""
+
+    def __init__(self, lexicons=None, model=None):
+        if lexicons is None:
+            lexicons = gr_lexicon.load_lexicons()
+        self.matcher = gr_matcher.lexicon_matcher.from_lexicons(lexicons)
+        self.model = model if model is not None else load_model()
+
+    def features(self, texts):
+        """Returns a dict of feature_columns for each text, or None for texts with no words. Unlike
+        extract_features, texts shorter than 30 words are scored too; check word_count to leave them out"""
+        lengths, cap_counts, excl_counts, word_counts, histograms = self.matcher.score_texts(texts)
+        scored = lengths > 0
+        stats = self.matcher.stats(word_counts[scored], histograms[scored])
+        cap_counts, excl_counts = cap_counts.tolist(), excl_counts.tolist()
+        reviews = [(i, None, cap_counts[i], excl_counts[i]) for i in np.flatnonzero(scored).tolist()]
+        ret = [None] * len(texts)
+        for row in gr_features.stats_rows(reviews, word_counts[scored], stats):
+            ret[row[0]] = dict(zip(feature_columns, row[2:]))
+        return ret
+
+    def predict(self, features):
+        """Predicts the rating of each scored text. None where there are no features or no model"""
+        ret = [None] * len(features)
+        scored = [i for i, row in enumerate(features) if row is not None]
+        if not self.model or not scored:
+            return ret
+        predictions = self.model['model'].predict(model_inputs([features[i] for i in scored], self.model['columns']))
+        for i, prediction in zip(scored, predictions.tolist()):
+            ret[i] = prediction
+        return ret
+
+    def score(self, texts):
+        """Returns a result dict per text, with its features and predicted_rating, or None"""
+        features = self.features(texts)
+        return [None if row is None else {'features': row, 'predicted_rating': prediction}
+            for row, prediction in zip(features, self.predict(features))]
+
+    def versions(self):
+        return {'lexicon_version': self.matcher.version,
+            'model_version': self.model['version'] if self.model else None}
+
+
+def make_handler(scorer, max_batch):
+    class scoring_handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # the headers and body go out in separate writes, and with Nagle's algorithm the body waits on the
+        # client's delayed ACK of the headers, adding 40 ms to every response
+        disable_nagle_algorithm = True
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, dict(status='ok', **scorer.versions()))
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                texts = request['texts'] if 'texts' in request else [request['text']]
+                if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                    raise ValueError('texts must be a list of strings')
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': 'bad request: {0}'.format(e)})
+                return
+            if len(texts) > max_batch:
+                self.send_json(413, {'error': 'at most {0} texts per request'.format(max_batch)})
+                return
+            self.send_json(200, dict(results=scorer.score(texts), **scorer.versions()))
+
+        def log_message(self, format, *args):
+            pass
+
+    return scoring_handler
+
+def start_scoring_server(scorer=None, port=0, max_batch=None):
+    """Starts the scoring service in a background thread. Returns the server and its base URL"""
+    scorer = scorer or review_scorer()
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(scorer, max_batch or gr_config.SCORING_MAX_BATCH))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if len(values) else 0.0
+
+def load_test(base_url=None, requests=2000, batch_size=32, clients=4, p99_target_ms=None):
+    """Sends requests batches of batch_size synthetic reviews to the scoring service at base_url from
+    clients keep-alive connections, and reports latency percentiles against the p99 target. Starts a
+    local service if base_url isn't given. Returns True if the p99 latency is within the target"""
+    p99_target_ms = p99_target_ms or gr_config.SCORING_P99_MS
+    server = None
+    if base_url is None:
+        server, base_url = start_scoring_server()
+    host = base_url.split('://', 1)[1].rstrip('/')
+    texts = gr_features.synthetic_reviews(max(batch_size * 16, 1000))
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(index):
+        conn = http.client.HTTPConnection(host)
+        timings = []
+        for i in range(index, requests, clients):
+            start = (i * batch_size) % (len(texts) - batch_size + 1)
+            body = json.dumps({'texts': texts[start:start + batch_size]}).encode('utf-8')
+            time_start = time.perf_counter()
+            conn.request('POST', '/score', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            timings.append(time.perf_counter() - time_start)
+            if response.status != 200:
+                with lock:
+                    errors.append(response.status)
+        conn.close()
+        with lock:
+            latencies.extend(timings)
+
+    time_start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - time_start
+    if server is not None:
+        server.shutdown()
+
+    latencies_ms = np.array(latencies) * 1000
+    p99 = percentile(latencies_ms, 99)
+    print('{0} requests of {1} texts from {2} clients in {3:.2f} seconds: {4:.0f} requests/sec, {5:.0f} texts/sec, {6} errors'.format(
+        len(latencies), batch_size, clients, elapsed, len(latencies) / elapsed, len(latencies) * batch_size / elapsed, len(errors)))
+    print('latency p50 {0:.1f} ms, p95 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms'.format(
+        percentile(latencies_ms, 50), percentile(latencies_ms, 95), p99, latencies_ms.max() if len(latencies_ms) else 0.0))
+    ok = p99 <= p99_target_ms and not errors
+    print('p99 target {0:.0f} ms: {1}'.format(p99_target_ms, 'met' if ok else 'MISSED'))
+    return ok
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if command == 'serve':
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8001
+        scorer = review_scorer()
+        server, base_url = start_scoring_server(scorer, port)
+        print('Scoring reviews at {0}/score, lexicons {1}, model {2}'.format(base_url, *scorer.versions().values()))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif command == 'loadtest':
+        # gr_scoring.py loadtest [base url] [requests] [batch size] [clients]
+        args = sys.argv[2:]
+        ok = load_test(args[0] if len(args) > 0 and args[0] != '-' else None,
+            *[int(arg) for arg in args[1:4]])
+        sys.exit(0 if ok else 1)
+    elif command == 'score':
+        # score the texts given, or lines of stdin
+        texts = sys.argv[2:] or [line.rstrip('\n') for line in sys.stdin]
+        for result in review_scorer().score(texts):
+            print(json.dumps(result))
+    else:
+        print('Usage: gr_scoring.py [serve [port] | loadtest [base url|-] [requests] [batch size] [clients] | score [texts]]')
+
+if __name__ == '__main__':
+    main()
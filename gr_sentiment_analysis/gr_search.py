@@ -0,0 +1,227 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import time
+import warnings
+import numpy as np
+from scipy import stats
+
+import books_db
+import gr_config
+import gr_train
+
+# Hyperparameter search over the rating models, with every fold result cached. A fold result is keyed
+# by a fingerprint of the training data, the model and its parameters, and the exact fold (sample size,
+# number of folds, seed and fold index), so rerunning a search, or a wider search that overlaps an
+# earlier one, only fits what hasn't been fitted before. Folds run in parallel on every core.
+#
+# With halving on, candidates are first scored on a small sample of the data and only the best
+# 1 / factor of them go on to the next round, which has factor times as many reviews, until the last
+# round runs on all of it.
+
+fold_results_tbl = '''CREATE TABLE IF NOT EXISTS fold_results (
+    fingerprint TEXT NOT NULL,
+    model TEXT NOT NULL,
+    params TEXT NOT NULL,
+    n_samples INTEGER NOT NULL,
+    n_folds INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    fold INTEGER NOT NULL,
+    score REAL,
+    fit_time REAL,
+    PRIMARY KEY (fingerprint, model, params, n_samples, n_folds, seed, fold)
+    ) WITHOUT ROWID
+'''
+
+# grids for grid search, and distributions for random search, from the Prediction Models notebooks
+search_spaces = {
+    'nb': (
+        {'var_smoothing': [1e-9, 1e-8, 1e-7, 1e-6]},
+        {'var_smoothing': stats.loguniform(1e-10, 1e-5)}),
+    'knn': (
+        {'n_neighbors': [5, 10, 15, 20], 'leaf_size': [20, 30, 40]},
+        {'n_neighbors': stats.randint(5, 20), 'leaf_size': stats.randint(20, 40)}),
+    'tree': (
+        {'max_depth': [5, 10, None], 'max_features': [10, 20], 'min_samples_leaf': [1, 8], 'criterion': ['gini', 'entropy']},
+        {'max_depth': [5, 10, 15, 20, None], 'max_features': stats.randint(5, 25), 'min_samples_leaf': stats.randint(1, 20),
+            'criterion': ['gini', 'entropy']}),
+    'rf': (
+        {'n_estimators': [10, 18, 30], 'max_depth': [5, 10, None], 'min_samples_split': [2, 10], 'criterion': ['gini', 'entropy']},
+        {'n_estimators': stats.randint(1, 30), 'max_features': ['sqrt', 'log2', None], 'criterion': ['gini', 'entropy'],
+            'min_samples_split': [2, 5, 10], 'max_depth': [3, 5, 10, None], 'bootstrap': [True, False]}),
+    'mlp': (
+        {'hidden_layer_sizes': [(10,), (20,), (40,)], 'activation': ['logistic', 'relu'], 'alpha': [1e-5, 2e-4]},
+        {'hidden_layer_sizes': [(10,), (20,), (30,), (40,)], 'tol': stats.uniform(1e-06, 1e-02),
+            'alpha': stats.uniform(1e-08, 1e-03), 'learning_rate': ['constant', 'invscaling', 'adaptive'],
+            'activation': ['identity', 'logistic', 'relu', 'tanh']}),
+    }
+
+def data_fingerprint(X, y):
+    digest = hashlib.sha1()
+    digest.update(str(X.shape).encode('ascii'))
+    digest.update(np.ascontiguousarray(X, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(y, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+def params_key(params):
+    """Canonical text form of a parameter dict, for the cache key"""
+    def plain(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, tuple):
+            return list(value)
+        return value
+    return json.dumps(dict((key, plain(value)) for key, value in params.items()), sort_keys=True)
+
+def candidates(name, search, n_iter, seed):
+    from sklearn.model_selection import ParameterGrid, ParameterSampler
+    grid, distributions = search_spaces[name]
+    if search == 'grid':
+        return list(ParameterGrid(grid))
+    return list(ParameterSampler(distributions, n_iter=n_iter, random_state=seed))
+
+def fold_splits(y, n_folds, seed):
+    """Stratified folds, as cross_val_score uses for classifiers, unless a rating has too few reviews"""
+    from sklearn.model_selection import KFold, StratifiedKFold
+    if np.unique(y, return_counts=True)[1].min(initial=0) >= n_folds:
+        splitter = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    else:
+        splitter = KFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    return list(splitter.split(np.zeros(len(y)), y))
+
+def fit_fold(name, params, X, y, train_index, test_index):
+    """Fits one fold, in a worker. Returns its test accuracy and fit time"""
+    from sklearn.exceptions import ConvergenceWarning
+    estimator = gr_train.make_model(name, n_jobs=1)
+    estimator.set_params(**params)
+    time_start = time.perf_counter()
+    # candidates with a loose tol or few iterations often stop early, which is what their score measures
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        estimator.fit(X[train_index], y[train_index])
+    fit_time = time.perf_counter() - time_start
+    return float(estimator.score(X[test_index], y[test_index])), fit_time
+
+
+class fold_cache:
+    """Fold results saved in a SQLite file"""
+
+    def __init__(self, path=None):
+        path = path or gr_config.SEARCH_CACHE
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(fold_results_tbl)
+        self.conn.commit()
+
+    def get(self, fingerprint, name, n_samples, n_folds, seed):
+        """Returns a dict of (params, fold) to score for every cached fold of this data and model"""
+        return dict(((params, fold), score) for params, fold, score in self.conn.execute('''SELECT params, fold, score
+            FROM fold_results WHERE fingerprint = ? AND model = ? AND n_samples = ? AND n_folds = ? AND seed = ?''',
+            (fingerprint, name, n_samples, n_folds, seed)))
+
+    def put(self, rows):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO fold_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.conn.close()
+
+
+def cross_validate(name, params_list, X, y, n_samples, n_folds, seed, fingerprint, cache, n_jobs):
+    """Mean cross-validated accuracy of each parameter dict on the first n_samples reviews of X, y,
+    fitting only the folds that aren't cached. Returns the means and the number of folds fitted"""
+    from joblib import Parallel, delayed
+    X_sample, y_sample = X[:n_samples], y[:n_samples]
+    splits = fold_splits(y_sample, n_folds, seed)
+    keys = [params_key(params) for params in params_list]
+    scores = cache.get(fingerprint, name, n_samples, n_folds, seed)
+    tasks = [(key, params, fold) for key, params in zip(keys, params_list) for fold in range(n_folds)
+        if (key, fold) not in scores]
+    if tasks:
+        results = Parallel(n_jobs=n_jobs)(delayed(fit_fold)(name, params, X_sample, y_sample, *splits[fold])
+            for key, params, fold in tasks)
+        cache.put([(fingerprint, name, key, n_samples, n_folds, seed, fold, score, fit_time)
+            for (key, params, fold), (score, fit_time) in zip(tasks, results)])
+        for (key, params, fold), (score, fit_time) in zip(tasks, results):
+            scores[(key, fold)] = score
+    return [float(np.mean([scores[(key, fold)] for fold in range(n_folds)])) for key in keys], len(tasks)
+
+def search_model(name, X, y, search='random', n_iter=20, n_folds=5, halving=False, factor=3, min_samples=None,
+        seed=1, n_jobs=-1, cache=None, fingerprint=None):
+    """Searches one model's parameters. Returns (mean accuracy, params) pairs from the last round, best
+    first, and the number of folds fitted"""
+    fingerprint = fingerprint or data_fingerprint(X, y)
+    params_list = candidates(name, search, n_iter, seed)
+    fitted = 0
+    if halving:
+        # the last round uses all the reviews and each one before it 1 / factor as many, with a round for
+        # each time the candidates can be cut down, as long as the first has at least min_samples reviews
+        min_samples = min_samples or max(n_folds * 40, len(y) // factor ** 4)
+        rounds = max(1, min(1 + int(math.log(max(len(params_list), 1), factor)),
+            1 + int(math.log(max(len(y) / min_samples, 1), factor))))
+    else:
+        rounds = 1
+    for round in range(rounds):
+        n_samples = len(y) // factor ** (rounds - 1 - round)
+        means, fits = cross_validate(name, params_list, X, y, n_samples, n_folds, seed, fingerprint, cache, n_jobs)
+        fitted += fits
+        ranked = sorted(zip(means, range(len(params_list))), key=lambda pair: -pair[0])
+        print('{0} round {1}: {2} candidates on {3} reviews, {4} folds fitted, best {5:.4f}'.format(
+            name, round + 1, len(params_list), n_samples, fits, ranked[0][0]))
+        if round < rounds - 1:
+            params_list = [params_list[i] for mean, i in ranked[:max(1, math.ceil(len(params_list) / factor))]]
+    return [(mean, params_list[i]) for mean, i in ranked], fitted
+
+def run_search(names=None, db_file=None, search='random', n_iter=20, n_folds=5, halving=False, factor=3, seed=1,
+        n_jobs=-1, save=False, cache_file=None):
+    """Searches each model on the cleaned review_stats, see gr_train.training_data. With save set, the best
+    parameters of each model are refitted and saved as gr_train.train_models would. Returns a dict of
+    model name to its best (mean accuracy, params)"""
+    names = names or gr_train.model_names
+    conn = books_db.connect(db_file)
+    X, y = gr_train.training_data(conn)
+    conn.close()
+    # shuffle once, with a fixed seed, so every round's sample is a random one and reruns match
+    order = np.random.RandomState(seed).permutation(len(y))
+    X, y = X[order], y[order]
+    fingerprint = data_fingerprint(X, y)
+    cache = fold_cache(cache_file)
+    print('{0} reviews, data fingerprint {1}'.format(len(y), fingerprint[:12]))
+
+    best = {}
+    time_start = time.perf_counter()
+    for name in names:
+        model_start = time.perf_counter()
+        ranked, fitted = search_model(name, X, y, search, n_iter, n_folds, halving, factor, seed=seed, n_jobs=n_jobs,
+            cache=cache, fingerprint=fingerprint)
+        best[name] = ranked[0]
+        print('{0}: best {1:.4f} with {2}, {3} folds fitted in {4:.2f} seconds'.format(name, ranked[0][0],
+            params_key(ranked[0][1]), fitted, time.perf_counter() - model_start))
+    cache.close()
+    print('Search done in {0:.2f} seconds'.format(time.perf_counter() - time_start))
+    if save:
+        gr_train.train_models(names, db_file=db_file, n_jobs=n_jobs, params=dict((name, best[name][1]) for name in names))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Searches the rating models\' hyperparameters with cached cross-validation')
+    parser.add_argument('models', nargs='*', help='models to search, of {0} (default all)'.format(', '.join(gr_train.model_names)))
+    parser.add_argument('--search', choices=['random', 'grid'], default='random')
+    parser.add_argument('--iter', type=int, default=20, help='candidates per model for random search')
+    parser.add_argument('--cv', type=int, default=5, help='cross-validation folds')
+    parser.add_argument('--halving', action='store_true', help='successive halving: drop the weaker candidates on small samples first')
+    parser.add_argument('--factor', type=int, default=3, help='halving factor')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=-1, help='parallel folds (default all CPUs)')
+    parser.add_argument('--save', action='store_true', help='fit and save each model with its best parameters')
+    parser.add_argument('--db', default=None, help='database file (default data/books.db)')
+    parser.add_argument('--cache', default=None, help='fold results file (default GR_SEARCH_CACHE)')
+    args = parser.parse_args()
+    run_search(args.models, args.db, args.search, args.iter, args.cv, args.halving, args.factor, args.seed, args.jobs,
+        args.save, args.cache)
+
+if __name__ == '__main__':
+    main()
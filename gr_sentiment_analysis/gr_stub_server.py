@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote
+
+# Local HTTP server that serves saved Goodreads HTML pages. Used for exercising the scrapers
+# without hitting Goodreads: start the server, then set gr_config.BASE_URL (or GR_BASE_URL)
+# to the URL it returns.
+
+def fixture_name(path):
+    """Builds the fixture file name for a request path, including the query string,
+    e.g. /book/reviews/123?page=1 -> %2Fbook%2Freviews%2F123%3Fpage%3D1.html"""
+    return quote(path, safe='') + '.html'
+
+def save_fixture(directory, path, html_source):
+    """Saves a page so the stub server will return it for the given request path"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, fixture_name(path)), 'w', encoding='utf-8') as file:
+        file.write(html_source)
+
+def make_handler(directory, delay):
+    class fixture_handler(BaseHTTPRequestHandler):
+        # keep connections open between requests, as Goodreads does
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if delay:
+                time.sleep(delay)
+            fixture_file = os.path.join(directory, fixture_name(self.path))
+            if not os.path.exists(fixture_file):
+                self.send_error(404)
+                return
+            with open(fixture_file, 'rb') as file:
+                body = file.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return fixture_handler
+
+def start_stub_server(directory, port=0, delay=0.0):
+    """Starts serving fixtures from directory in a background thread. delay is added to every
+    response to simulate network latency. Returns the server and its base URL"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(directory, delay))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    return server, base_url
+
+def selftest(books=10, reviews_per_book=60):
+    """Runs gr_reviews.get_reviews against synthetic review pages served by a stub server, writing to a
+    temporary database, and checks that every review was written. Returns whether they were"""
+    import random
+    import tempfile
+    import books_db
+    import gr_benchmark
+    import gr_config
+    import gr_reviews
+    rng = random.Random(0)
+    texts = gr_benchmark.review_texts(books * reviews_per_book, max_words=150)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fixture_dir = os.path.join(temp_dir, 'fixtures')
+        for book_id in range(1, books + 1):
+            for page, url in enumerate(gr_reviews.review_page_urls(book_id, reviews_per_book)):
+                start = ((book_id - 1) * reviews_per_book) + page * 30
+                page_texts = texts[start:min(start + 30, book_id * reviews_per_book)]
+                # review IDs are unique across every page of every book
+                save_fixture(fixture_dir, url[len(gr_config.BASE_URL):],
+                    gr_benchmark.reviews_page(book_id * 100 + page, rng, page_texts))
+        db_file = os.path.join(temp_dir, 'books.db')
+        conn = books_db.connect(db_file)
+        books_db.migrate(conn)
+        with conn:
+            conn.executemany('INSERT INTO book_info_clean (id, title, review_count) VALUES (?, ?, ?)',
+                [(book_id, 'Book {0}'.format(book_id), reviews_per_book) for book_id in range(1, books + 1)])
+
+        server, base_url = start_stub_server(fixture_dir)
+        settings = gr_config.BASE_URL, gr_config.CACHE_PAGES, gr_config.REPLAY
+        # fetch from the stub only, leaving the page cache alone
+        gr_config.BASE_URL, gr_config.CACHE_PAGES, gr_config.REPLAY = base_url, False, False
+        try:
+            gr_reviews.get_reviews(rate_limit=0, db_file=db_file)
+        finally:
+            gr_config.BASE_URL, gr_config.CACHE_PAGES, gr_config.REPLAY = settings
+            server.shutdown()
+        written = conn.execute('SELECT COUNT(*) FROM reviews').fetchone()[0]
+        conn.close()
+    expected = books * reviews_per_book
+    print('selftest: {0} of {1} reviews written for {2} books'.format(written, expected, books))
+    return written == expected
+
+def main():
+    # gr_stub_server.py selftest [books] fetches synthetic review pages from a stub server with get_reviews
+    if sys.argv[1:2] == ['selftest']:
+        sys.exit(0 if selftest(*[int(arg) for arg in sys.argv[2:3]]) else 1)
+    dir = os.path.dirname(__file__)
+    fixture_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(dir, 'data/fixtures')
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    server, base_url = start_stub_server(fixture_dir, port)
+    print('Serving {0} at {1}'.format(fixture_dir, base_url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import csv
+import os
+import pickle
+import time
+import datetime
+import numpy as np
+import pandas as pd
+
+import books_db
+import gr_config
+import gr_scoring
+
+# Trains the rating models from review_stats, as the Prediction Models notebooks do, and saves each one
+# as a pickled dict (see gr_scoring.load_model) so new reviews can be scored without refitting:
+#
+#   model       the fitted estimator
+#   columns     the review_stats feature columns it takes, in order
+#   version     name and training time, e.g. rf-20180601-142501
+#   name, params, trained_at, rows, accuracy, lexicon_version, sklearn_version
+#
+# The models use the parameters the notebooks' searches settled on.
+
+model_format = 1
+
+def make_model(name, n_jobs=-1):
+    """Returns an unfitted estimator for one of model_names"""
+    if name == 'nb':
+        from sklearn.naive_bayes import GaussianNB
+        return GaussianNB()
+    elif name == 'knn':
+        from sklearn.neighbors import KNeighborsClassifier
+        return KNeighborsClassifier(n_neighbors=15, leaf_size=30, n_jobs=n_jobs)
+    elif name == 'tree':
+        from sklearn.tree import DecisionTreeClassifier
+        return DecisionTreeClassifier(max_depth=10, max_features=20, min_samples_leaf=8, criterion='entropy', random_state=1)
+    elif name == 'rf':
+        from sklearn.ensemble import RandomForestClassifier
+        # 'auto' meant 'sqrt' for classifiers, and newer scikit-learn only accepts the latter
+        return RandomForestClassifier(max_depth=10, max_features='sqrt', min_samples_split=10, n_estimators=18,
+            criterion='entropy', bootstrap=True, n_jobs=n_jobs, random_state=1)
+    elif name == 'mlp':
+        from sklearn.neural_network import MLPClassifier
+        return MLPClassifier(activation='logistic', alpha=0.00021652623974721422, hidden_layer_sizes=(20,),
+            learning_rate='constant', tol=0.0053124092561090998, random_state=1)
+    raise ValueError('unknown model {0}'.format(name))
+
+model_names = ['nb', 'knn', 'tree', 'rf', 'mlp']
+
+# counts the notebooks drop outliers on, more than 3 standard deviations from the mean
+outlier_columns = ['pos_afinn_count', 'neg_afinn_count', 'pos_bing_count', 'neg_bing_count',
+    'pos_mpqa_count', 'neg_mpqa_count', 'pos_inq_count', 'neg_inq_count']
+
+# reviews with a rating, and words in every lexicon
+training_sql = '''SELECT * FROM review_stats WHERE rating != 0
+    AND total_afinn_count != 0 AND total_bing_count != 0 AND total_mpqa_count != 0 AND total_inq_count != 0'''
+
+# the same rows as training_sql, as gr_export filters
+training_filters = [('rating', '!=', 0), ('total_afinn_count', '!=', 0), ('total_bing_count', '!=', 0),
+    ('total_mpqa_count', '!=', 0), ('total_inq_count', '!=', 0)]
+
+def training_data(conn, dataset=None, review_ids=False):
+    """Loads review_stats cleaned up as in the notebooks, from conn or, given its directory, the columnar
+    export (see gr_export), reading only the columns and rows needed. Returns the feature matrix and ratings,
+    and with review_ids on the review ID of each row"""
+    if dataset:
+        import gr_export
+        review_stats = gr_export.load_review_stats(['review_id', 'rating'] + list(gr_scoring.feature_columns),
+            training_filters, dataset)
+        # in review_id order like the query, rather than by rating partition, so the split is the same
+        review_stats = review_stats.sort_values('review_id', kind='stable').reset_index(drop=True)
+    else:
+        review_stats = pd.read_sql_query(training_sql, con=conn)
+    counts = review_stats[outlier_columns].to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscores = (counts - counts.mean(axis=0)) / counts.std(axis=0)
+    review_stats = review_stats[(np.abs(zscores) < 3).all(axis=1)]
+    ret = gr_scoring.model_inputs(review_stats, gr_scoring.feature_columns), review_stats['rating'].to_numpy()
+    return ret + (review_stats['review_id'].to_numpy(),) if review_ids else ret
+
+def save_model(path, model):
+    """Pickles a model dict, replacing any earlier file in a single rename"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        pickle.dump(model, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+def lexicon_version():
+    import gr_lexicon
+    try:
+        return gr_lexicon.compiled_lexicons(gr_lexicon.lexicon_file()).version
+    except (OSError, ValueError):
+        return None
+
+def train_models(names=None, db_file=None, out_dir=None, n_jobs=-1, params=None, dataset=None):
+    """Fits each model on 80% of the cleaned review_stats and saves it to out_dir/<name>.pkl. The one
+    with the best accuracy on the other 20% is also saved as gr_config.MODEL_FILE, the model
+    gr_scoring uses. params maps model names to parameters replacing the defaults, e.g. from
+    gr_search. dataset is the export directory to train from instead of db_file. Returns a dict of name to
+    test accuracy"""
+    from sklearn import __version__ as sklearn_version
+    from sklearn.model_selection import train_test_split
+    names = names or model_names
+    out_dir = out_dir or os.path.dirname(gr_config.MODEL_FILE)
+    conn = books_db.connect(db_file)
+    X, y = training_data(conn, dataset)
+    conn.close()
+    print('Training on {0} reviews, {1} features'.format(len(y), X.shape[1]))
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=1)
+
+    results = {}
+    best = None
+    for name in names:
+        estimator = make_model(name, n_jobs)
+        estimator.set_params(**(params or {}).get(name, {}))
+        time_start = time.perf_counter()
+        estimator.fit(X_train, y_train)
+        fit_time = time.perf_counter() - time_start
+        accuracy = float(estimator.score(X_test, y_test))
+        trained_at = datetime.datetime.now()
+        model = {
+            'format': model_format,
+            'model': estimator,
+            'columns': list(gr_scoring.feature_columns),
+            'version': '{0}-{1}'.format(name, trained_at.strftime('%Y%m%d-%H%M%S')),
+            'name': name,
+            'params': estimator.get_params(),
+            'trained_at': trained_at.isoformat(),
+            'rows': len(y_train),
+            'accuracy': accuracy,
+            'lexicon_version': lexicon_version(),
+            'sklearn_version': sklearn_version,
+            }
+        save_model(os.path.join(out_dir, name + '.pkl'), model)
+        results[name] = accuracy
+        print('{0}: fitted in {1:.2f} seconds, test accuracy {2:.4f}'.format(model['version'], fit_time, accuracy))
+        if best is None or accuracy > best['accuracy']:
+            best = model
+    if best is not None:
+        save_model(os.path.join(out_dir, os.path.basename(gr_config.MODEL_FILE)), best)
+        print('{0} saved as {1}'.format(best['version'], os.path.basename(gr_config.MODEL_FILE)))
+    return results
+
+
+def batch_predict(model_file=None, db_file=None, csv_file=None, chunk_size=20000, model=None):
+    """Predicts the rating of every review in review_stats a chunk at a time, so memory use doesn't
+    depend on the number of reviews. Predictions are upserted into review_predictions, or written to
+    csv_file instead. model is a model dict to use rather than loading model_file. Returns the number of
+    reviews predicted"""
+    model = model or gr_scoring.load_model(model_file)
+    if model is None:
+        raise ValueError('no model at {0}, run gr_train.py train first'.format(model_file or gr_config.MODEL_FILE))
+    conn = books_db.connect(db_file)
+    read_conn = books_db.connect_like(conn)
+    columns = ['review_id'] + model['columns']
+    cursor = read_conn.execute('SELECT {0} FROM review_stats'.format(', '.join(columns)))
+
+    if csv_file:
+        out = open(csv_file, 'w', newline='')
+        writer = csv.writer(out)
+        writer.writerow(['review_id', 'model_version', 'predicted_rating'])
+    else:
+        conn.execute(books_db.review_predictions_tbl)
+        writer = books_db.bulk_writer(conn, 'review_predictions', ['review_id', 'model_version', 'predicted_rating'],
+            replace=True)
+    predicted = 0
+    time_start = time.perf_counter()
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        values = np.array(rows, dtype=np.float64)
+        inputs = np.nan_to_num(values[:, 1:], nan=0.0, posinf=0.0, neginf=0.0)
+        predictions = model['model'].predict(inputs)
+        chunk = [(review_id, model['version'], int(rating)) for review_id, rating in
+            zip(values[:, 0].astype(np.int64).tolist(), predictions.tolist())]
+        if csv_file:
+            writer.writerows(chunk)
+        else:
+            writer.add_many(chunk)
+            writer.flush()
+        predicted += len(rows)
+    elapsed = time.perf_counter() - time_start
+    read_conn.close()
+    conn.close()
+    if csv_file:
+        out.close()
+    print('{0}: predicted {1} reviews in {2:.2f} seconds, {3:.0f} reviews/sec'.format(
+        model['version'], predicted, elapsed, predicted / elapsed if elapsed > 0 else 0.0))
+    return predicted
+
+def main():
+    parser = argparse.ArgumentParser(description='Trains the rating models from review_stats and predicts ratings in bulk')
+    subparsers = parser.add_subparsers(dest='command')
+    train = subparsers.add_parser('train', help='fit and save the models')
+    train.add_argument('models', nargs='*', help='models to train, of {0} (default all)'.format(', '.join(model_names)))
+    train.add_argument('--out', default=None, help='directory for the model files (default data/models)')
+    train.add_argument('--jobs', type=int, default=-1, help='parallel jobs for knn and rf (default all CPUs)')
+    train.add_argument('--dataset', default=None, help='train from this gr_export directory rather than the database')
+    predict = subparsers.add_parser('predict', help='predict the rating of every review in review_stats')
+    predict.add_argument('--model', default=None, help='model file (default GR_MODEL_FILE)')
+    predict.add_argument('--csv', default=None, help='write predictions to this CSV file rather than review_predictions')
+    predict.add_argument('--chunk-size', type=int, default=20000, help='reviews read and predicted at a time')
+    info = subparsers.add_parser('info', help='show a model file')
+    info.add_argument('model', nargs='?', default=None)
+    for subparser in (train, predict):
+        subparser.add_argument('--db', default=None, help='database file (default data/books.db)')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train_models(args.models, db_file=args.db, out_dir=args.out, n_jobs=args.jobs, dataset=args.dataset)
+    elif args.command == 'predict':
+        batch_predict(args.model, db_file=args.db, csv_file=args.csv, chunk_size=args.chunk_size)
+    elif args.command == 'info':
+        model = gr_scoring.load_model(args.model)
+        if model is None:
+            print('No model file')
+        else:
+            for key in ('version', 'trained_at', 'rows', 'accuracy', 'lexicon_version', 'sklearn_version'):
+                print('{0}: {1}'.format(key, model.get(key)))
+            print('columns: {0}'.format(', '.join(model['columns'])))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()